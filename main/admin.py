@@ -40,11 +40,21 @@ class AlarmConfigInline(admin.TabularInline):
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
-    list_display = ("alias", "ip_address", "port", "protocol", "is_active")
+    list_display = ("alias", "ip_address", "port", "protocol", "max_read_registers", "max_concurrent_requests", "is_active")
     list_filter = ("protocol", "is_active")
     search_fields = ("alias", "ip_address")
+    readonly_fields = ("capabilities_probed_at",)
+    fieldsets = (
+        (None, {"fields": ("alias", "ip_address", "port", "protocol", "word_order", "is_active")}),
+        ("Capabilities", {"fields": ("max_read_registers", "supports_mask_write", "max_concurrent_requests", "probe_capabilities", "capabilities_probed_at")}),
+    )
+    actions = ["probe_capabilities"]
     inlines = [TagInline]
 
+    @admin.action(description="Probe capabilities again")
+    def probe_capabilities(self, request, queryset):
+        queryset.update(probe_capabilities=True)
+
 
 # Tag admin
 
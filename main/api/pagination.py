@@ -0,0 +1,29 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class ActivatedAlarmPagination(CursorPagination):
+    """ Keyset pagination on activation time, so deep pages cost the same as the first """
+
+    ordering = "-timestamp"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+
+class TagPagination(CursorPagination):
+    """ Keyset pagination on the lowercased alias, for tag pickers on large plants
+
+    Only used when a `cursor`, `page_size` or search query is given, so clients that
+    list every tag keep getting a plain list.
+    """
+
+    ordering = ("alias_key", "id") # alias_key is annotated by TagViewSet
+    page_size = settings.TAG_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.TAG_MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not any(param in request.query_params for param in ("cursor", "page_size", "q")):
+            return None
+        return super().paginate_queryset(queryset, request, view)
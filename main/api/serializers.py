@@ -23,6 +23,20 @@ class DurationSecondsField(serializers.IntegerField):
         return int(value.total_seconds())
     
 
+class PrefetchedSlugRelatedField(serializers.SlugRelatedField):
+    """ Slug field that can resolve from objects fetched up front for a batch, see `BulkMixin` """
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get("prefetched", {}).get(self.field_name)
+        if prefetched is None:
+            return super().to_internal_value(data)
+
+        obj = prefetched.get(str(data))
+        if obj is None:
+            self.fail('does_not_exist', slug_name=self.slug_field, value=str(data))
+        return obj
+
+
 class DeviceSerializer(serializers.ModelSerializer):
     class Meta:
         model = Device
@@ -30,16 +44,46 @@ class DeviceSerializer(serializers.ModelSerializer):
 
 
 class AlarmConfigSerializer(serializers.ModelSerializer):
-    tag = serializers.SlugRelatedField(slug_field='external_id', queryset=Tag.objects.all())
+    tag = PrefetchedSlugRelatedField(slug_field='external_id', queryset=Tag.objects.all())
     notification_cooldown = DurationSecondsField(required=False, allow_null=True)
+    trigger_sustain = DurationSecondsField(required=False)
+    clear_sustain = DurationSecondsField(required=False)
+    window = DurationSecondsField(required=False)
 
     class Meta:
         model = AlarmConfig
         exclude = ["owner", "last_notified"]
 
 
+class TagListSerializer(serializers.ListSerializer):
+    """ Checks a list of tags for memory overlaps as one batch, instead of once per tag """
+
+    def to_internal_value(self, data):
+        # Validated here rather than in validate() so errors keep the per-item list shape
+        attrs = super().to_internal_value(data)
+        if self.context.get("batch_validated"):
+            return attrs
+
+        instances = self.instance or []
+        tags = []
+        for i, item in enumerate(attrs):
+            tag = instances[i] if i < len(instances) else Tag()
+            for attr, value in item.items():
+                setattr(tag, attr, value)
+            tags.append(tag)
+
+        overlaps = Tag.find_overlaps(tags)
+        if any(overlaps):
+            raise serializers.ValidationError([
+                tag.get_overlap_error(other).message_dict if other else {}
+                for tag, other in zip(tags, overlaps)
+            ])
+
+        return attrs
+
+
 class TagSerializer(serializers.ModelSerializer):
-    device = serializers.SlugRelatedField( slug_field='alias',  queryset=Device.objects.all())
+    device = PrefetchedSlugRelatedField( slug_field='alias',  queryset=Device.objects.all())
     history_retention = DurationSecondsField(required=False, allow_null=True)
     history_interval = DurationSecondsField(required=False, allow_null=True)
 
@@ -47,6 +91,13 @@ class TagSerializer(serializers.ModelSerializer):
         model = Tag
         read_only_fields = ["external_id"]
         exclude = ["owner"]
+        list_serializer_class = TagListSerializer
+
+    def get_validators(self):
+        # The batch overlap check also catches tags at the same location, and frees those of deleted tags
+        if self.context.get("batch_validated"):
+            return []
+        return super().get_validators()
 
     def validate(self, attrs):
         instance = self.instance or Tag()
@@ -54,13 +105,24 @@ class TagSerializer(serializers.ModelSerializer):
             setattr(instance, attr, value)
 
         try:
-            instance.clean()
+            # Lists and bulk requests check overlaps for the whole batch
+            if isinstance(self.parent, serializers.ListSerializer) or self.context.get("batch_validated"):
+                instance.clean_bit_index()
+            else:
+                instance.clean()
         except ValidationError as e:
             raise serializers.ValidationError(e.message_dict)
 
         return attrs
 
 
+class TagConfigSerializer(TagSerializer):
+    """ Tag without the fields the poller updates, so responses built from it only change with the configuration """
+
+    class Meta(TagSerializer.Meta):
+        exclude = ["owner", "current_value", "last_updated", "last_history_at"]
+
+
 class TagValueSerializer(serializers.ModelSerializer):
     id = serializers.UUIDField(source='external_id', read_only=True)
     value = serializers.JSONField(source='current_value', read_only=True)
@@ -125,7 +187,7 @@ class DashboardSerializer(serializers.ModelSerializer):
     class Meta:
         model = Dashboard
         exclude = ["preview_image"]
-        read_only_fields = ["alias"]
+        read_only_fields = ["alias", "version"]
 
 
 class DashboardWidgetSerializer(serializers.ModelSerializer):
@@ -133,12 +195,14 @@ class DashboardWidgetSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = DashboardWidget
-        fields = ["tag", "widget_type", "config"]
+        fields = ["external_id", "tag", "widget_type", "config"]
+        read_only_fields = ["external_id"]
 
 
 class DashboardWidgetBulkSerializer(serializers.Serializer):
     """ Used for the Save Dashboard payload """
     
-    tag = serializers.SlugRelatedField(slug_field='external_id', queryset=Tag.objects.all(), required=False, allow_null=True)
+    external_id = serializers.UUIDField(required=False, allow_null=True)
+    tag = PrefetchedSlugRelatedField(slug_field='external_id', queryset=Tag.objects.all(), required=False, allow_null=True)
     widget_type = serializers.ChoiceField(choices=DashboardWidget.WidgetTypeChoices.choices)
     config = serializers.JSONField()
\ No newline at end of file
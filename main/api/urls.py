@@ -19,4 +19,8 @@ urlpatterns = [
     path('tag-options/', views.TagMetadataView.as_view(), name='tag-options'),
     path('device-options/', views.DeviceMetadataView.as_view(), name='device-options'),
     path('alarm-options/', views.AlarmMetadataView.as_view(), name='alarm-options'),
+    path('export/<str:kind>/', views.ExportView.as_view(), name='export'),
+    path('poll-traces/', views.PollTraceView.as_view(), name='poll-traces'),
+    path('poll-traces/chrome/', views.PollTraceExportView.as_view(), name='poll-traces-chrome'),
+    path('poll-traces/<int:number>/', views.PollTraceView.as_view(), name='poll-trace'),
 ]
\ No newline at end of file
@@ -1,5 +1,7 @@
 import json
+import logging
 from datetime import timedelta
+from itertools import islice
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.generics import ListAPIView
 from rest_framework.views import APIView
@@ -7,28 +9,210 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.decorators import action
 from rest_framework.serializers import Serializer
-from .serializers import TagSerializer, TagValueSerializer, TagWriteRequestSerializer, TagHistoryEntrySerializer
+from .serializers import TagSerializer, TagConfigSerializer, TagValueSerializer, TagWriteRequestSerializer, TagHistoryEntrySerializer
 from .serializers import AlarmConfigSerializer, ActivatedAlarmSerializer
 from .serializers import DashboardSerializer, DashboardWidgetSerializer, DashboardWidgetBulkSerializer
-from .serializers import DeviceSerializer
+from .serializers import DeviceSerializer, PrefetchedSlugRelatedField
 from ..models import DashboardWidget, Dashboard, Tag, Device, AlarmConfig, ActivatedAlarm, TagWriteRequest, TagHistoryEntry
-from rest_framework.exceptions import PermissionDenied, ValidationError
+from ..services.alarm_counter import alarm_counter
+from ..services.alarm_engine import alarm_engine
+from ..services.config_version import config_version
+from ..services.cycle_trace import cycle_tracer, chrome_trace
+from ..services.io_csv import DeviceExporter, TagExporter, AlarmConfigExporter
+from .pagination import ActivatedAlarmPagination, TagPagination
+from rest_framework.exceptions import PermissionDenied, ValidationError, NotFound, APIException
 from django.utils import timezone
-from django.db import transaction
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.utils.dateparse import parse_datetime
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q
+from django.db.models.functions import Lower
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from asgiref.sync import sync_to_async
 from rest_framework.request import HttpRequest
 
+logger = logging.getLogger(__name__)
+
 #TODO should the metadata views all be one class?
 #TODO better docstrings
 
+class Conflict(APIException):
+    status_code = 409
+    default_detail = "The resource was changed by another request."
+    default_code = "conflict"
+
+
 class ReadOnlyViewSet(ModelViewSet):
     """ Restrict write perms to staff """
 
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update', 'destroy']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'bulk']:
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
 
+class BulkMixin:
+    """ Adds a `bulk/` endpoint that creates, updates and deletes many objects in one transaction
+
+    Takes `{"create": [...], "update": [...], "delete": [...]}`, where updates are partial and
+    carry the `lookup_field` of the object to change, and deletes are lookup values. Every item
+    is validated before anything is written; if any fail, nothing is applied and a 400 lists
+    the errors of each item in request order.
+    """
+
+    bulk_max_items = 5000
+
+    def get_bulk_queryset(self):
+        return self.get_queryset()
+
+    def validate_bulk(self, created: list, updated: list, deleted: list) -> tuple[list, list]:
+        """ Override for checks across the whole batch. Returns the errors of each created and updated object """
+        return [{}] * len(created), [{}] * len(updated)
+
+    def after_bulk(self):
+        """ Override to react to the bulk writes, which skip model save signals """
+        pass
+
+    def prefetch_related_slugs(self, items: list) -> dict[str, dict]:
+        """ Fetch the objects referenced by slug fields of all items with one query per field """
+
+        prefetched = {}
+        for name, field in self.get_serializer_class()().fields.items():
+            if not isinstance(field, PrefetchedSlugRelatedField):
+                continue
+
+            slugs = {str(item[name]) for item in items if isinstance(item, dict) and name in item}
+            try:
+                objs = field.get_queryset().filter(**{f"{field.slug_field}__in": slugs})
+                prefetched[name] = {str(getattr(obj, field.slug_field)): obj for obj in objs}
+            except DjangoValidationError:
+                prefetched[name] = {} # Malformed slugs, like an invalid UUID
+
+        return prefetched
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        lookup = self.lookup_field
+        creates = request.data.get("create", [])
+        updates = request.data.get("update", [])
+        deletes = request.data.get("delete", [])
+
+        if not all(isinstance(items, list) for items in [creates, updates, deletes]):
+            raise ValidationError("'create', 'update' and 'delete' must be lists")
+        if len(creates) + len(updates) + len(deletes) > self.bulk_max_items:
+            raise ValidationError(f"At most {self.bulk_max_items} items per request")
+
+        update_keys = [str(item.get(lookup)) if isinstance(item, dict) else None for item in updates]
+        existing = {
+            str(getattr(obj, lookup)): obj
+            for obj in self.get_bulk_queryset().filter(**{f"{lookup}__in": [k for k in update_keys + deletes if k]})
+        }
+
+        # Validate each item without overlap style checks, which run once for the batch below
+        context = {
+            **self.get_serializer_context(),
+            "batch_validated": True,
+            "prefetched": self.prefetch_related_slugs(creates + updates),
+        }
+
+        create_serializers = [self.get_serializer_class()(data=item, context=context) for item in creates]
+        create_errors = [{} if s.is_valid() else s.errors for s in create_serializers]
+
+        update_serializers = []
+        update_errors = []
+        for key, item in zip(update_keys, updates):
+            instance = existing.get(key)
+            if instance is None:
+                update_serializers.append(None)
+                update_errors.append({lookup: [f"Not found: {key}"]})
+                continue
+
+            data = {k: v for k, v in item.items() if k != lookup}
+            serializer = self.get_serializer_class()(instance, data=data, partial=True, context=context)
+            update_serializers.append(serializer)
+            update_errors.append({} if serializer.is_valid() else serializer.errors)
+
+        delete_errors = [{} if str(key) in existing else {lookup: [f"Not found: {key}"]} for key in deletes]
+
+        model = self.get_serializer_class().Meta.model
+        created = [model(**s.validated_data) for s, e in zip(create_serializers, create_errors) if not e]
+        updated = []
+        for serializer, errors in zip(update_serializers, update_errors):
+            if not errors:
+                for attr, value in serializer.validated_data.items():
+                    setattr(serializer.instance, attr, value)
+                updated.append(serializer.instance)
+        deleted = [existing[str(key)] for key, errors in zip(deletes, delete_errors) if not errors]
+
+        # Batch checks only apply to items that passed on their own
+        batch_create_errors, batch_update_errors = self.validate_bulk(created, updated, deleted)
+        names = [f"create[{i}]" for i, e in enumerate(create_errors) if not e] + [f"update[{i}]" for i, e in enumerate(update_errors) if not e]
+        duplicates = _duplicate_errors(model, created + updated, names)
+        batch_create_errors = [{**d, **e} for d, e in zip(duplicates, batch_create_errors)]
+        batch_update_errors = [{**d, **e} for d, e in zip(duplicates[len(created):], batch_update_errors)]
+        create_errors = _merge_errors(create_errors, batch_create_errors)
+        update_errors = _merge_errors(update_errors, batch_update_errors)
+
+        if any(create_errors + update_errors + delete_errors):
+            return Response({"create": create_errors, "update": update_errors, "delete": delete_errors}, status=400)
+
+        update_fields = {attr for s in update_serializers for attr in s.validated_data}
+        try:
+            with transaction.atomic():
+                if deleted:
+                    model.objects.filter(pk__in=[obj.pk for obj in deleted]).delete()
+                if updated and update_fields:
+                    model.objects.bulk_update(updated, list(update_fields))
+                if created:
+                    model.objects.bulk_create(created)
+        except IntegrityError:
+            # Such as updates that swap unique values, which conflict while they are applied
+            logger.exception("Bulk write failed")
+            raise ValidationError("The changes conflict with each other or with saved data")
+
+        self.after_bulk()
+        config_version.changed()
+
+        serializer_class = self.get_serializer_class()
+        return Response({
+            "create": serializer_class(created, many=True, context=context).data,
+            "update": serializer_class(updated, many=True, context=context).data,
+            "delete": [str(getattr(obj, lookup)) for obj in deleted],
+        })
+
+
+def _duplicate_errors(model, objs: list, names: list[str]) -> list[dict]:
+    """ Errors for objects with the same unique fields as an earlier object of the batch, which the per item
+    validators can't see. `names` identifies each object in the messages """
+
+    unique_sets = [tuple(fields) for fields in model._meta.unique_together]
+    unique_sets += [(f.name,) for f in model._meta.concrete_fields if f.unique and not f.primary_key]
+
+    errors = [{} for _ in objs]
+    for fields in unique_sets:
+        attnames = [model._meta.get_field(name).attname for name in fields]
+        seen: dict[tuple, int] = {}
+        for i, obj in enumerate(objs):
+            key = tuple(getattr(obj, attname) for attname in attnames)
+            if None in key:
+                continue # NULLs never conflict
+            if key in seen:
+                errors[i].setdefault(fields[0], []).append(f"Same {', '.join(fields)} as {names[seen[key]]} in this request")
+            else:
+                seen[key] = i
+    return errors
+
+
+def _merge_errors(errors: list[dict], batch_errors: list[dict]) -> list[dict]:
+    """ Place batch errors, which cover only the items that were valid alone, back in request order """
+
+    batch_errors = iter(batch_errors)
+    return [e if e else next(batch_errors) for e in errors]
+
+
 class DeviceViewSet(ReadOnlyViewSet):
     queryset = Device.objects.all()
     serializer_class = DeviceSerializer
@@ -39,24 +223,100 @@ class DeviceMetadataView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        return Response({
+        return Response(self.get_choices())
+
+    @staticmethod
+    def get_choices() -> dict:
+        return {
             "protocols": [{"value": k, "label": v} for k, v in Device.ProtocolChoices.choices],
             "word_orders": [{"value": k, "label": v} for k, v in Device.WordOrderChoices.choices],
-        })
+        }
 
 
-class TagViewSet(ReadOnlyViewSet):
+class TagViewSet(BulkMixin, ReadOnlyViewSet):
     serializer_class = TagSerializer
     lookup_field = 'external_id'
+    pagination_class = TagPagination
+
+    def get_bulk_queryset(self):
+        return Tag.objects.select_related("device")
+
+    def validate_bulk(self, created: list[Tag], updated: list[Tag], deleted: list[Tag]):
+        tags = created + updated
+        overlaps = Tag.find_overlaps(tags, ignore=[tag.external_id for tag in deleted])
+        errors = [tag.get_overlap_error(other).message_dict if other else {} for tag, other in zip(tags, overlaps)]
+        return errors[:len(created)], errors[len(created):]
 
     def get_queryset(self):
-        qs = Tag.objects.all()
+        params = self.request.query_params
+        qs = Tag.objects.annotate(alias_key=Lower("alias"))
 
-        device_alias: str = self.request.query_params.get("device")
+        device_alias: str = params.get("device")
         if device_alias:
             qs = qs.filter(device__alias=device_alias)
 
+        ids: str = params.get("ids")
+        if ids:
+            try:
+                qs = qs.filter(external_id__in=ids.split(","))
+            except DjangoValidationError:
+                raise ValidationError({"ids": "Expected a comma separated list of tag ids"})
+
+        for name in ("channel", "data_type"):
+            if params.get(name):
+                qs = qs.filter(**{f"{name}__in": params[name].split(",")})
+
+        query = params.get("q", "").strip()
+        if query:
+            qs = TagViewSet.search(qs, query)
+
+        # Only load the columns that will be serialized
+        fields = self.get_requested_fields()
+        if fields is None or "device" in fields:
+            qs = qs.select_related("device")
+        if fields:
+            qs = qs.only(*["device__alias" if f == "device" else f for f in fields])
+
         return qs
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+
+        fields = self.get_requested_fields()
+        if fields:
+            child = getattr(serializer, "child", serializer)
+            for name in set(child.fields) - fields:
+                child.fields.pop(name)
+
+        return serializer
+
+    def get_requested_fields(self) -> set[str] | None:
+        """ The fields listed in the `fields` query parameter of a read, or None for all of them """
+
+        fields: str = self.request.query_params.get("fields")
+        if not fields or self.request.method != "GET":
+            return None
+
+        requested = set(fields.split(","))
+        unknown = requested - set(TagSerializer().fields)
+        if unknown:
+            raise ValidationError({"fields": f"Unknown fields: {', '.join(sorted(unknown))}"})
+        return requested
+
+    @staticmethod
+    def search(qs, query: str):
+        """ Tags whose alias starts with the query, or for queries of `TAG_SEARCH_MIN_SUBSTRING` characters
+        or more, whose alias, description or device alias contains it.
+
+        Prefix matches are a range scan of the lowercased alias index. Substring matches can't use the
+        index to filter, but pages are read in index order, so the scan stops once a page is full.
+        """
+
+        if len(query) < settings.TAG_SEARCH_MIN_SUBSTRING:
+            key = query.lower()
+            return qs.filter(alias_key__gte=key, alias_key__lt=key + "\U0010ffff", alias_key__startswith=key)
+
+        return qs.filter(Q(alias__icontains=query) | Q(description__icontains=query) | Q(device__alias__icontains=query))
     
 
 class TagMetadataView(APIView):
@@ -64,10 +324,14 @@ class TagMetadataView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        return Response({
+        return Response(self.get_choices())
+
+    @staticmethod
+    def get_choices() -> dict:
+        return {
             "channels": [{"value": k, "label": v} for k, v in Tag.ChannelChoices.choices],
             "data_types": [{"value": k, "label": v} for k, v in Tag.DataTypeChoices.choices],
-        })
+        }
     
 
 class TagWriteRequestViewSet(ModelViewSet):
@@ -100,52 +364,153 @@ class DashboardViewSet(ModelViewSet):
 
     @action(detail=True, methods=['post'], url_path='save-data')
     def save_data(self, request: HttpRequest, alias=None):
-        dashboard = DashboardViewSet.update_dashboard(dashboard=self.get_object(), data=request.data, files=request.FILES, request=request)
-        return Response({"new_alias": dashboard.alias})
-    
+        dashboard, widget_ids = DashboardViewSet.update_dashboard(dashboard=self.get_object(), data=request.data, files=request.FILES, request=request)
+        return Response({"new_alias": dashboard.alias, "version": dashboard.version, "widgets": widget_ids})
+
+    @action(detail=True, methods=['get'])
+    def bootstrap(self, request: HttpRequest, alias=None):
+        """ Everything the dashboard page needs to render in one response: the dashboard, its widgets,
+        the tags and alarm configs they reference, the devices, and the choice lists.
+
+        Live values aren't included, the tag stream sends them on subscribe. That keeps the response
+        a function of the configuration alone, so it carries an ETag and repeat loads get a 304.
+        """
+
+        dashboard = self.get_object()
+
+        etag = config_version.etag(dashboard.pk, dashboard.version)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = Response(status=304)
+        else:
+            widgets = list(dashboard.widgets.select_related("tag").order_by("pk"))
+            tag_ids = {w.tag_id for w in widgets if w.tag_id is not None}
+            tags = Tag.objects.filter(id__in=tag_ids).select_related("device").order_by("pk")
+            alarms = AlarmConfig.objects.filter(tag_id__in=tag_ids).select_related("tag").order_by("pk")
+
+            response = Response({
+                "dashboard": DashboardSerializer(dashboard).data,
+                "widgets": DashboardWidgetSerializer(widgets, many=True).data,
+                "tags": TagConfigSerializer(tags, many=True).data,
+                "alarms": AlarmConfigSerializer(alarms, many=True).data,
+                "devices": DeviceSerializer(Device.objects.order_by("pk"), many=True).data,
+                "tag_options": TagMetadataView.get_choices(),
+                "alarm_options": AlarmMetadataView.get_choices(),
+                "device_options": DeviceMetadataView.get_choices(),
+            })
+
+        response["ETag"] = etag
+        patch_cache_control(response, private=True, no_cache=True) # Always revalidate
+        return response
+
     @staticmethod #TODO figure out best place for this
-    def update_dashboard(*, dashboard: Dashboard, data: dict, files: dict | None = None, request=None) -> Dashboard:
-        # --- Meta ---
+    def update_dashboard(*, dashboard: Dashboard, data: dict, files: dict | None = None, request=None) -> tuple[Dashboard, list[str] | None]:
+        """ Apply meta and widget changes. Widgets are matched to existing ones by external id, so only
+        added, changed and removed widgets are written. A missing or empty `widgets` leaves them as they are,
+        as it always has; the editor sends a JSON string, so "[]" removes them all. If `version` is given and
+        the dashboard has been saved since, nothing is changed and Conflict is raised.
+
+        Returns the dashboard, and the external ids of the saved widgets in the given order """
+
+        # --- Validate ---
         meta_serializer = DashboardSerializer(dashboard, data=data, partial=True, context={"request": request})
         meta_serializer.is_valid(raise_exception=True)
-        dashboard = meta_serializer.save()
 
-        # --- Preview image ---
-        if files and "preview_image" in files:
-            dashboard.preview_image = files["preview_image"]
-            dashboard.save(update_fields=["preview_image"])
+        expected_version = data.get("version")
+        if expected_version is not None:
+            try:
+                expected_version = int(expected_version)
+            except (TypeError, ValueError):
+                raise ValidationError({"version": "Expected an integer"})
 
-        # --- Widgets ---
         raw_widgets = data.get("widgets")
-        if not raw_widgets:
-            return dashboard
+        widgets_data = None
+
+        if raw_widgets:
+            if isinstance(raw_widgets, str):
+                try:
+                    raw_widgets = json.loads(raw_widgets)
+                except json.JSONDecodeError:
+                    raise ValidationError("Invalid JSON format in 'widgets'")
 
-        if isinstance(raw_widgets, str):
+            tag_ids = {w.get("tag") for w in raw_widgets if isinstance(w, dict) and w.get("tag")}
             try:
-                widgets_data = json.loads(raw_widgets)
-            except json.JSONDecodeError:
-                raise ValidationError("Invalid JSON format in 'widgets'")
-        else:
-            widgets_data = raw_widgets
+                tags = {str(tag.external_id): tag for tag in Tag.objects.filter(external_id__in=tag_ids)}
+            except DjangoValidationError:
+                tags = {}
 
-        widget_serializer = DashboardWidgetBulkSerializer(data=widgets_data, many=True)
-        widget_serializer.is_valid(raise_exception=True)
+            widget_serializer = DashboardWidgetBulkSerializer(data=raw_widgets, many=True, context={"prefetched": {"tag": tags}})
+            widget_serializer.is_valid(raise_exception=True)
+            widgets_data = widget_serializer.validated_data
 
         with transaction.atomic():
-            dashboard.widgets.all().delete()
-            DashboardWidget.objects.bulk_create(
-                [
-                    DashboardWidget(
-                    dashboard=dashboard,
-                    tag=item.get("tag"),
-                    widget_type=item["widget_type"],
-                    config=item["config"],
-                    )
-                    for item in widget_serializer.validated_data
-                ]
-            )
-
-        return dashboard
+            # --- Version ---
+            versions = Dashboard.objects.filter(pk=dashboard.pk)
+            if expected_version is not None:
+                versions = versions.filter(version=expected_version)
+            if not versions.update(version=F("version") + 1):
+                raise Conflict("This dashboard was saved somewhere else since it was loaded. Reload it to get the latest version.")
+            dashboard.refresh_from_db(fields=["version"])
+
+            # --- Meta ---
+            dashboard = meta_serializer.save()
+
+            # --- Preview image ---
+            if files and "preview_image" in files:
+                dashboard.preview_image = files["preview_image"]
+                dashboard.save(update_fields=["preview_image"])
+
+            # --- Widgets ---
+            widget_ids = None
+            if widgets_data is not None:
+                widget_ids = DashboardViewSet._save_widgets(dashboard, widgets_data)
+
+        return dashboard, widget_ids
+
+    @staticmethod
+    def _save_widgets(dashboard: Dashboard, widgets_data: list[dict]) -> list[str]:
+        """ Diff the given widgets against the saved ones and write only the differences """
+
+        existing = {w.external_id: w for w in dashboard.widgets.all()}
+
+        # Ids from elsewhere, such as a config imported from another dashboard, can't be reused
+        unknown_ids = [w["external_id"] for w in widgets_data if w.get("external_id") and w["external_id"] not in existing]
+        taken = set(DashboardWidget.objects.filter(external_id__in=unknown_ids).values_list("external_id", flat=True))
+
+        to_create: list[DashboardWidget] = []
+        to_update: list[DashboardWidget] = []
+        kept = set()
+        widget_ids = []
+
+        for item in widgets_data:
+            external_id = item.get("external_id")
+            widget = existing.get(external_id)
+
+            if widget is None or external_id in kept:
+                widget = DashboardWidget(dashboard=dashboard, tag=item.get("tag"), widget_type=item["widget_type"], config=item["config"])
+                if external_id and external_id not in taken and external_id not in kept:
+                    widget.external_id = external_id
+                to_create.append(widget)
+            else:
+                kept.add(external_id)
+                tag = item.get("tag")
+                if (widget.tag_id, widget.widget_type, widget.config) != (tag.id if tag else None, item["widget_type"], item["config"]):
+                    widget.tag = tag
+                    widget.widget_type = item["widget_type"]
+                    widget.config = item["config"]
+                    to_update.append(widget)
+
+            widget_ids.append(str(widget.external_id))
+
+        to_delete = [w.pk for external_id, w in existing.items() if external_id not in kept]
+
+        if to_delete:
+            DashboardWidget.objects.filter(pk__in=to_delete).delete()
+        if to_update:
+            DashboardWidget.objects.bulk_update(to_update, ["tag", "widget_type", "config"])
+        if to_create:
+            DashboardWidget.objects.bulk_create(to_create)
+
+        return widget_ids
 
 
 class DashboardWidgetViewSet(ModelViewSet):
@@ -176,10 +541,17 @@ class DashboardWidgetViewSet(ModelViewSet):
         serializer.save()
 
 
-class AlarmConfigViewSet(ReadOnlyViewSet):
+class AlarmConfigViewSet(BulkMixin, ReadOnlyViewSet):
     serializer_class = AlarmConfigSerializer
     lookup_field = 'external_id'
 
+    def get_bulk_queryset(self):
+        return AlarmConfig.objects.select_related("tag")
+
+    def after_bulk(self):
+        alarm_engine.invalidate()
+        alarm_counter.invalidate()
+
     def get_queryset(self):
         qs = AlarmConfig.objects.all()
 
@@ -195,9 +567,32 @@ class ActivatedAlarmViewSet(ModelViewSet):
     queryset = ActivatedAlarm.objects.all()
     serializer_class = ActivatedAlarmSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = ActivatedAlarmPagination
 
     def get_queryset(self):
-        return super().get_queryset().select_related('config', 'config__tag', 'acknowledged_by')
+        qs = super().get_queryset().select_related('config', 'config__tag', 'acknowledged_by')
+
+        is_active = self.request.query_params.get("is_active")
+        if is_active is not None:
+            qs = qs.filter(is_active=parse_bool(is_active, "is_active"))
+
+        acknowledged = self.request.query_params.get("acknowledged")
+        if acknowledged is not None:
+            qs = qs.filter(acknowledged=parse_bool(acknowledged, "acknowledged"))
+
+        threat_levels: str = self.request.query_params.get("threat_level")
+        if threat_levels:
+            qs = qs.filter(config__threat_level__in=threat_levels.split(","))
+
+        since = self.request.query_params.get("since")
+        if since:
+            qs = qs.filter(timestamp__gte=parse_time(since, "since"))
+
+        until = self.request.query_params.get("until")
+        if until:
+            qs = qs.filter(timestamp__lt=parse_time(until, "until"))
+
+        return qs
 
     @action(detail=True, methods=['post'])
     def acknowledge(self, request, pk=None):
@@ -213,12 +608,39 @@ class ActivatedAlarmViewSet(ModelViewSet):
         
         return Response(self.get_serializer(alarm).data)
 
+    @action(detail=False, methods=['post'], url_path='acknowledge')
+    def acknowledge_many(self, request):
+        """ Acknowledges the alarms listed in `ids`, or with `all`, every alarm matching the query filters """
+
+        ids = request.data.get("ids")
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                raise ValidationError({"ids": "Expected a list of alarm ids"})
+            qs = ActivatedAlarm.objects.filter(id__in=ids)
+        elif request.data.get("all") is True:
+            qs = self.filter_queryset(self.get_queryset())
+        else:
+            raise ValidationError("Provide 'ids' or 'all'")
+
+        count = qs.filter(acknowledged=False).update(
+            acknowledged=True,
+            acknowledged_at=timezone.now(),
+            acknowledged_by=request.user,
+        )
+
+        # Queryset updates skip the save signal, so update the counts here
+        if ids is not None:
+            alarm_counter.acknowledge(ids)
+        else:
+            alarm_counter.invalidate()
+        alarm_counter.broadcast()
+
+        return Response({"acknowledged": count})
+
     @action(detail=False, methods=['get'])
     def active_count(self, request):
-        """ Returns count of active, unacknowledged alarms for the badge """
-
-        count = ActivatedAlarm.objects.filter(is_active=True, acknowledged=False).count()
-        return Response({"count": count})
+        """ Returns count of active, unacknowledged alarms for the badge, along with counts by threat level """
+        return Response(alarm_counter.snapshot())
 
 
 class AlarmMetadataView(APIView):
@@ -226,10 +648,14 @@ class AlarmMetadataView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        return Response({
+        return Response(self.get_choices())
+
+    @staticmethod
+    def get_choices() -> dict:
+        return {
             "threat_levels": [{"value": k, "label": v} for k, v in AlarmConfig.ThreatLevelChoices.choices],
             "operator_choices": [{"value": k, "label": v} for k, v in AlarmConfig.OperatorChoices.choices],
-        })
+        }
     
     
 class TagMultiValueView(APIView):
@@ -259,4 +685,98 @@ class TagHistoryView(ListAPIView):
             cutoff = timezone.now() - timedelta(seconds=int(seconds))
             qs = qs.filter(timestamp__gte=cutoff)
 
-        return qs
\ No newline at end of file
+        return qs
+
+
+class ExportView(APIView):
+    """ Streams the plant configuration as CSV, in the format the importers read """
+    permission_classes = [IsAdminUser]
+
+    exporters = {
+        "devices": DeviceExporter,
+        "tags": TagExporter,
+        "alarms": AlarmConfigExporter,
+    }
+
+    def get(self, request, kind: str):
+        exporter_class = self.exporters.get(kind)
+        if exporter_class is None:
+            raise NotFound(f"Unknown export '{kind}'")
+
+        response = StreamingHttpResponse(stream_lines(exporter_class().lines()), content_type="text/csv")
+        response["Content-Disposition"] = f'attachment; filename="{kind}.csv"'
+        return response
+
+
+class PollTraceView(APIView):
+    """ Phase timings of recent poll cycles, or with a cycle number, all the spans of that cycle """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, number: int = None):
+        if number is not None:
+            trace = cycle_tracer.get(number)
+            if trace is None:
+                raise NotFound(f"Cycle {number} is no longer kept")
+            return Response(trace.to_dict())
+
+        slow = parse_bool(request.query_params.get("slow", "false"), "slow")
+        # Copied first, since the poller keeps appending from the event loop
+        traces = list(cycle_tracer.slow if slow else cycle_tracer.recent)
+        return Response([trace.summary() for trace in reversed(traces) if trace.end is not None])
+
+
+class PollTraceExportView(APIView):
+    """ Downloads poll cycles in Chrome trace format, the slow ones unless `cycles` lists cycle numbers """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        cycles = request.query_params.get("cycles")
+        if cycles:
+            try:
+                numbers = [int(n) for n in cycles.split(",")]
+            except ValueError:
+                raise ValidationError({"cycles": "Expected a comma separated list of cycle numbers"})
+            traces = [t for t in map(cycle_tracer.get, numbers) if t is not None and t.end is not None]
+        else:
+            traces = list(cycle_tracer.slow)
+
+        response = Response(chrome_trace(traces))
+        response["Content-Disposition"] = 'attachment; filename="poll-trace.json"'
+        return response
+
+
+async def stream_lines(lines, chunk_lines=500):
+    """ Serve a synchronous line generator to ASGI without collecting it in memory first.
+    The generator runs in the shared sync thread, since it holds a database cursor """
+
+    def next_chunk():
+        return "".join(islice(lines, chunk_lines))
+
+    while chunk := await sync_to_async(next_chunk)():
+        yield chunk
+
+
+def parse_bool(value: str, name: str) -> bool:
+    """ Parse a boolean query parameter """
+
+    match value.lower():
+        case "true" | "1":
+            return True
+        case "false" | "0":
+            return False
+    raise ValidationError({name: "Expected true or false"})
+
+
+def parse_time(value: str, name: str):
+    """ Parse an ISO 8601 query parameter """
+
+    try:
+        time = parse_datetime(value)
+    except ValueError:
+        time = None
+
+    if time is None:
+        raise ValidationError({name: "Expected an ISO 8601 datetime"})
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time)
+    return time
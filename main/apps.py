@@ -5,4 +5,4 @@ class ModbusTilesConfig(AppConfig):
     name = 'main'
 
     def ready(self):
-        pass
\ No newline at end of file
+        from . import signals
\ No newline at end of file
@@ -1,5 +1,27 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from .models import Tag, ActivatedAlarm
+from .api.serializers import TagValueSerializer
+from .services.tag_journal import tag_journal
+from .services.alarm_counter import alarm_counter
+from .services.tag_subscriptions import tag_subscriptions
+from .services.metrics import registry
+
+
+def send_queue_sizes():
+    """ Messages waiting in each consumer's channel layer queue, which grow when a client can't keep up """
+
+    queues = getattr(get_channel_layer(), "channels", {}) # Only the in-memory layer keeps its queues here
+    return [queue.qsize() for queue in list(queues.values())]
+
+
+ws_clients = registry.gauge("modbus_tiles_ws_clients", "Connected dashboard websocket clients")
+ws_messages = registry.counter("modbus_tiles_ws_messages_total", "Messages sent to dashboard websocket clients", ["type"])
+registry.gauge("modbus_tiles_ws_send_queue_max", "Largest backlog of undelivered messages for one websocket client", function=lambda: max(send_queue_sizes(), default=0))
+registry.gauge("modbus_tiles_ws_send_queue_total", "Undelivered messages for all websocket clients", function=lambda: sum(send_queue_sizes()))
+
 
 class DashboardConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -7,14 +29,18 @@ class DashboardConsumer(AsyncWebsocketConsumer):
 
         self.group_name = "poller_broadcast"
         self.subscribed_tags = set()
+        self.send_alarm_counts = False
 
         await self.channel_layer.group_add(
             self.group_name,
             self.channel_name
         )
         await self.accept()
+        ws_clients.inc()
 
     async def disconnect(self, close_code):
+        ws_clients.dec()
+        tag_subscriptions.remove(self.subscribed_tags)
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
@@ -24,21 +50,72 @@ class DashboardConsumer(AsyncWebsocketConsumer):
         """ Handle widget subscriptions """
 
         data = json.loads(text_data)
-        
+
         if data.get("type") == "subscribe":
             new_tags = set(data.get("tags", []))
+            tag_subscriptions.add(new_tags - self.subscribed_tags)
             self.subscribed_tags.update(new_tags)
+            await self.send_missed_updates(new_tags, data.get("epoch"), data.get("seq"))
+
+        elif data.get("type") == "subscribe_alarm_counts":
+            self.send_alarm_counts = True
+            counts = await database_sync_to_async(alarm_counter.snapshot)()
+            await self.send(text_data=json.dumps({"type": "alarm_counts", "data": counts}))
+            ws_messages.labels("alarm_counts").inc()
+
+    async def send_missed_updates(self, tag_ids: set[str], epoch, seq):
+        """ Catch the client up from its last seen sequence number, or send a full snapshot if the journal can't """
+
+        @database_sync_to_async
+        def get_snapshot():
+            tags = list(Tag.objects.filter(external_id__in=tag_ids))
+            return TagValueSerializer(tags, many=True, context={"alarm_map": ActivatedAlarm.get_tag_map(tags)}).data
+
+        if not tag_ids:
+            return
+
+        current_seq = tag_journal.seq
+
+        # A position the client can't have been sent gets a snapshot, like one the journal no longer holds
+        valid = isinstance(epoch, str) and isinstance(seq, int) and not isinstance(seq, bool)
+        updates = tag_journal.since(epoch, seq) if valid else None
+
+        if updates is None:
+            updates = await get_snapshot()
+        else:
+            updates = [u for u in updates if u["id"] in tag_ids]
+
+        await self.send(text_data=json.dumps({
+            "type": "tag_update",
+            "data": updates,
+            "epoch": tag_journal.epoch,
+            "seq": current_seq,
+        }))
+        ws_messages.labels("tag_update").inc()
 
     async def tag_update(self, event):
         """ Handle update message from poller """
 
         all_updates = event["updates"]
-        
+
         # Send updates for this user's subscription
         relevant_updates = [u for u in all_updates if u["id"] in self.subscribed_tags]
 
         if relevant_updates:
             await self.send(text_data=json.dumps({
                 "type": "tag_update",
-                "data": relevant_updates
-            }))
\ No newline at end of file
+                "data": relevant_updates,
+                "epoch": tag_journal.epoch,
+                "seq": event["seq"],
+            }))
+            ws_messages.labels("tag_update").inc()
+
+    async def alarm_counts(self, event):
+        """ Handle alarm count changes """
+
+        if self.send_alarm_counts:
+            await self.send(text_data=json.dumps({
+                "type": "alarm_counts",
+                "data": event["counts"],
+            }))
+            ws_messages.labels("alarm_counts").inc()
@@ -0,0 +1,111 @@
+""" Dashboard websocket clients for `manage.py benchmark websocket`, run in a separate process
+
+Doesn't import Django, so the clients' CPU stays out of the server's numbers. Reads its settings
+as JSON from the first line of stdin, prints "ready" once every client has subscribed, runs until
+"stop" is read from stdin, then prints its results as JSON.
+
+    {"url": "ws://127.0.0.1:8001/ws/dashboard/", "subscriptions": [["<tag id>", ...], ...]}
+"""
+
+import sys
+import json
+import time
+import asyncio
+from collections import Counter
+from datetime import datetime
+import websockets
+
+
+class Client:
+    """ One dashboard connection, counting updates per tag and measuring their delay from the PLC read """
+
+    def __init__(self, url: str, tags: list[str], latencies: Counter):
+        self.url = url
+        self.tags = tags
+        self.latencies = latencies # Tenths of a millisecond -> count, shared by the process
+        self.base_seq: int | None = None
+        self.messages = 0
+        self.updates = 0
+        self.out_of_order = 0
+        self.last_seq: dict[str, int] = {}
+        self.error: str | None = None
+
+    async def connect(self):
+        self.connection = await websockets.connect(self.url, max_size=None, open_timeout=30, ping_interval=None)
+        await self.connection.send(json.dumps({"type": "subscribe", "tags": self.tags}))
+
+        # The first reply is the snapshot, stamped with the sequence number it's current to
+        snapshot = json.loads(await self.connection.recv())
+        self.base_seq = snapshot["seq"]
+
+    async def receive(self):
+        try:
+            async for text in self.connection:
+                received = time.time()
+                message = json.loads(text)
+                if message.get("type") != "tag_update":
+                    continue
+
+                self.messages += 1
+                for update in message["data"]:
+                    self.updates += 1
+
+                    # Each update has its own global sequence number, so per tag they only go up
+                    seq = update["seq"]
+                    if seq <= self.last_seq.get(update["id"], self.base_seq):
+                        self.out_of_order += 1
+                    self.last_seq[update["id"]] = seq
+
+                    if update["time"]:
+                        read = datetime.fromisoformat(update["time"]).timestamp()
+                        self.latencies[round((received - read) * 10000)] += 1
+
+        except websockets.ConnectionClosed as e:
+            self.error = f"Connection closed: {e}"
+
+    def result(self) -> dict:
+        return {
+            "base_seq": self.base_seq,
+            "messages": self.messages,
+            "updates": self.updates,
+            "out_of_order": self.out_of_order,
+            "error": self.error,
+        }
+
+
+async def main():
+    config = json.loads(sys.stdin.readline())
+    loop = asyncio.get_running_loop()
+
+    latencies = Counter()
+    clients = [Client(config["url"], tags, latencies) for tags in config["subscriptions"]]
+
+    # Connect in batches, since a burst of thousands of handshakes overflows the listen backlog
+    connected = []
+    for i in range(0, len(clients), 100):
+        batch = clients[i : i + 100]
+        results = await asyncio.gather(*(client.connect() for client in batch), return_exceptions=True)
+        for client, result in zip(batch, results):
+            if isinstance(result, Exception):
+                client.error = f"Couldn't connect: {result!r}"
+            else:
+                connected.append(client)
+
+    tasks = [asyncio.create_task(client.receive()) for client in connected]
+    print("ready", flush=True)
+
+    # Wait for the stop line without blocking the event loop
+    await loop.run_in_executor(None, sys.stdin.readline)
+
+    for client in connected:
+        await client.connection.close()
+    await asyncio.gather(*tasks)
+
+    print(json.dumps({
+        "clients": [client.result() for client in clients],
+        "latencies": list(latencies.items()),
+    }), flush=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
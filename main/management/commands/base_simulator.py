@@ -1,11 +1,21 @@
+import re
+import json
 import time
+import math
+import random
 import struct
+import asyncio
+import fnmatch
 import threading
 import logging
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field, fields
 from types import SimpleNamespace
-from django.core.management.base import BaseCommand
-from pymodbus.server import StartTcpServer
+from django.core.management.base import BaseCommand, CommandError
+from pymodbus.constants import ExcCodes
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.server import ModbusTcpServer
+from pymodbus.server.requesthandler import ServerRequestHandler
 from pymodbus.datastore import (
     ModbusSequentialDataBlock,
     ModbusDeviceContext,
@@ -16,6 +26,342 @@ from ...models import Tag # Imported for Channel/DataType constants only
 
 logger = logging.getLogger(__name__)
 
+
+def create_device_store(size=2**13) -> ModbusDeviceContext:
+    """ Zeroed memory of one simulated device, for all four channels """
+
+    return ModbusDeviceContext(
+        di=ModbusSequentialDataBlock(0, [0] * size),
+        co=ModbusSequentialDataBlock(0, [0] * size),
+        hr=ModbusSequentialDataBlock(0, [0] * size),
+        ir=ModbusSequentialDataBlock(0, [0] * size),
+    )
+
+
+def noise(tag: Tag):
+    """ A random value for the tag's type, following a sine wave offset by address for floats """
+
+    if tag.data_type == Tag.DataTypeChoices.BOOL:
+        return random.choice([True, False])
+    
+    elif tag.data_type in [Tag.DataTypeChoices.FLOAT32, Tag.DataTypeChoices.FLOAT64]:
+        # Simple sine wave based on address to desynchronize them
+        base = math.sin(time.time() + tag.address) * 10
+        return base + random.uniform(-1, 1)
+    
+    elif tag.data_type == Tag.DataTypeChoices.STRING:
+        return "" #TODO
+        
+    return random.randint(0, 10) #TODO base off int type?
+
+
+# Big endian struct formats, matching convert_to_registers with word_order="big"
+STRUCT_FORMATS = {
+    Tag.DataTypeChoices.INT16: "h",
+    Tag.DataTypeChoices.UINT16: "H",
+    Tag.DataTypeChoices.INT32: "i",
+    Tag.DataTypeChoices.UINT32: "I",
+    Tag.DataTypeChoices.INT64: "q",
+    Tag.DataTypeChoices.UINT64: "Q",
+    Tag.DataTypeChoices.FLOAT32: "f",
+    Tag.DataTypeChoices.FLOAT64: "d",
+}
+
+
+@dataclass
+class RegisterRange:
+    """ Tags filling a contiguous range of one channel, written with one setValues per tick """
+
+    function_code: int
+    start: int
+    end: int
+    runs: list[tuple[str, list[int]]] = field(default_factory=list) # (data type, addresses) of consecutive tags of the same type
+
+
+class TagLayout:
+    """ Where a device's animated tags live in memory, worked out once so each tick generates the
+    values of a whole run of same-typed tags at once and writes each contiguous range in one call.
+    Bit-indexed and string tags share registers or vary in size, so they're still written one by one """
+
+    def __init__(self, tags: list[Tag]):
+        self.ranges: list[RegisterRange] = []
+        self.single: list[Tag] = []
+        self.tag_count = len(tags)
+
+        batched = []
+        for tag in tags:
+            if tag.is_bit_indexed or tag.read_amount != 1 or (tag.data_type not in STRUCT_FORMATS and tag.data_type != Tag.DataTypeChoices.BOOL):
+                self.single.append(tag)
+            else:
+                batched.append(tag)
+
+        batched.sort(key=lambda t: (t.modbus_function_code, t.address))
+        current: RegisterRange | None = None
+        for tag in batched:
+            code, count = tag.modbus_function_code, tag.get_read_count()
+            if current is None or code != current.function_code or tag.address != current.end:
+                # Overlapping tags start a new range, and the later one wins
+                current = RegisterRange(code, tag.address, tag.address)
+                self.ranges.append(current)
+
+            if current.runs and current.runs[-1][0] == tag.data_type:
+                current.runs[-1][1].append(tag.address)
+            else:
+                current.runs.append((tag.data_type, [tag.address]))
+            current.end = tag.address + count
+
+    def animate(self, store: ModbusDeviceContext):
+        """ Write new noise values for every tag """
+
+        now = time.time()
+        for memory in self.ranges:
+            registers = []
+            for data_type, addresses in memory.runs:
+                registers.extend(_noise_registers(data_type, addresses, now))
+            store.setValues(memory.function_code, memory.start, registers)
+
+        for tag in self.single:
+            registers = ModbusBaseClient.convert_to_registers(noise(tag), data_type=tag.pymodbus_datatype, word_order="big")
+            store.setValues(tag.modbus_function_code, tag.address, registers)
+
+
+def _noise_registers(data_type: str, addresses: list[int], now: float) -> list[int]:
+    """ Register values for a run of tags of one type, with the same distribution as `noise` """
+
+    count = len(addresses)
+    if data_type == Tag.DataTypeChoices.BOOL:
+        return [random.getrandbits(1) for _ in addresses]
+
+    if data_type in [Tag.DataTypeChoices.FLOAT32, Tag.DataTypeChoices.FLOAT64]:
+        uniform = random.uniform
+        values = [math.sin(now + address) * 10 + uniform(-1, 1) for address in addresses]
+    else:
+        randint = random.randint
+        values = [randint(0, 10) for _ in addresses]
+
+    fmt = STRUCT_FORMATS[data_type]
+    data = struct.pack(f">{count}{fmt}", *values)
+    return list(struct.unpack(f">{len(data) // 2}H", data))
+
+
+class TickRate:
+    """ Logs how many ticks per second a simulation keeps up, since a slow simulator skews anything polling it """
+
+    def __init__(self, interval: float, report_interval: float):
+        self.interval = interval
+        self.report_interval = report_interval
+        self.started = time.monotonic()
+        self.ticks = 0
+        self.busy = 0.0
+
+    def add(self, elapsed: float):
+        self.ticks += 1
+        self.busy += elapsed
+
+        now = time.monotonic()
+        if now - self.started < self.report_interval:
+            return
+
+        rate = self.ticks / (now - self.started)
+        msg = f"Simulation tick rate: {rate:.2f}/s, target {1 / self.interval:.2f}/s, average tick {self.busy / self.ticks * 1000:.1f}ms"
+        if self.busy / self.ticks > self.interval:
+            logger.warning(msg)
+        else:
+            logger.info(msg)
+
+        self.started, self.ticks, self.busy = now, 0, 0.0
+
+
+@dataclass
+class AddressFault:
+    """ Requests touching these addresses get an exception response """
+
+    function_code: int | None # None for any function
+    start: int
+    end: int # Inclusive
+    code: ExcCodes
+
+    @classmethod
+    def parse(cls, text: str) -> "AddressFault":
+        """ From FUNCTION:START-END:CODE, e.g. `3:100-119:2`, with `*` for any function """
+
+        match = re.fullmatch(r"(\*|\d+):(\d+)(?:-(\d+))?:(\d+)", text.strip())
+        if match is None:
+            raise ValueError(f"Expected FUNCTION:START-END:CODE, got '{text}'")
+        function, start, end, code = match.groups()
+        return cls(
+            function_code=None if function == "*" else int(function),
+            start=int(start),
+            end=int(end if end is not None else start),
+            code=ExcCodes(int(code)),
+        )
+
+    def matches(self, function_code: int, start: int, count: int) -> bool:
+        if self.function_code is not None and self.function_code != function_code:
+            return False
+        return start <= self.end and start + count - 1 >= self.start
+
+
+@dataclass
+class FaultProfile:
+    """ Adverse conditions for a simulated device. Rates are fractions of requests, times are in seconds """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    distribution: str = "normal" # fixed, uniform (latency +- jitter), normal, or lognormal (jitter relative to latency)
+    drop_rate: float = 0.0 # Requests never answered
+    reset_rate: float = 0.0 # Requests that get the connection closed instead of an answer
+    bandwidth: float | None = None # Bytes per second per connection
+    exceptions: list[AddressFault] = field(default_factory=list)
+
+    DISTRIBUTIONS = ["fixed", "uniform", "normal", "lognormal"]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "FaultProfile":
+        names = {f.name for f in fields(cls)}
+        unknown = set(data) - names
+        if unknown:
+            raise ValueError(f"Unknown fault settings: {', '.join(sorted(unknown))}")
+
+        profile = cls(**{**data, "exceptions": [AddressFault.parse(e) for e in data.get("exceptions", [])]})
+        if profile.distribution not in cls.DISTRIBUTIONS:
+            raise ValueError(f"Unknown delay distribution '{profile.distribution}'")
+        return profile
+
+    @property
+    def is_clean(self) -> bool:
+        return self == FaultProfile()
+
+    def delay(self) -> float:
+        """ A response delay drawn from the distribution """
+
+        match self.distribution:
+            case "fixed":
+                delay = self.latency
+            case "uniform":
+                delay = random.uniform(self.latency - self.jitter, self.latency + self.jitter)
+            case "normal":
+                delay = random.gauss(self.latency, self.jitter)
+            case "lognormal":
+                delay = self.latency * math.exp(random.gauss(0, self.jitter / self.latency)) if self.latency else 0.0
+        return max(0.0, delay)
+
+    def transfer_time(self, function_code: int, request_bytes: int, count: int) -> float:
+        """ Time to move a request and its response over the capped link """
+
+        if not self.bandwidth:
+            return 0.0
+
+        match function_code:
+            case 1 | 2:
+                response_bytes = 2 + math.ceil(count / 8)
+            case 3 | 4:
+                response_bytes = 2 + 2 * count
+            case _:
+                response_bytes = 5
+        return (request_bytes + response_bytes + 14) / self.bandwidth # Plus both MBAP headers
+
+
+def add_fault_arguments(parser):
+    """ Options for a `FaultProfile` applied to every simulated device """
+
+    group = parser.add_argument_group("fault injection")
+    group.add_argument("--latency", type=float, default=0.0, help="Median response delay in seconds")
+    group.add_argument("--jitter", type=float, default=0.0, help="Spread of the response delay in seconds")
+    group.add_argument("--distribution", choices=FaultProfile.DISTRIBUTIONS, default="normal")
+    group.add_argument("--drop-rate", type=float, default=0.0, help="Fraction of requests never answered")
+    group.add_argument("--reset-rate", type=float, default=0.0, help="Fraction of requests answered by closing the connection")
+    group.add_argument("--bandwidth", type=float, default=None, help="Bytes per second per connection")
+    group.add_argument("--exception", action="append", default=[], metavar="FUNCTION:START-END:CODE",
+                       help="Answer requests touching these addresses with a Modbus exception code, e.g. 3:100-119:2. Repeatable")
+
+
+def fault_profile(options: dict) -> FaultProfile:
+    try:
+        return FaultProfile.from_dict({
+            "latency": options["latency"],
+            "jitter": options["jitter"],
+            "distribution": options["distribution"],
+            "drop_rate": options["drop_rate"],
+            "reset_rate": options["reset_rate"],
+            "bandwidth": options["bandwidth"],
+            "exceptions": options["exception"],
+        })
+    except ValueError as e:
+        raise CommandError(str(e))
+
+
+def load_fault_profiles(path: str) -> dict[str, FaultProfile]:
+    """ Profiles by device alias pattern, from a JSON object like {"sim-00*": {"latency": 0.05, "drop_rate": 0.01}} """
+
+    with open(path) as file:
+        data = json.load(file)
+    try:
+        return {pattern: FaultProfile.from_dict(profile) for pattern, profile in data.items()}
+    except (ValueError, TypeError) as e:
+        raise CommandError(f"Invalid fault profiles in {path}: {e}")
+
+
+def match_fault_profile(alias: str, profiles: dict[str, FaultProfile], default: FaultProfile) -> FaultProfile:
+    """ The profile of the first pattern matching the alias """
+
+    for pattern, profile in profiles.items():
+        if fnmatch.fnmatchcase(alias, pattern):
+            return profile
+    return default
+
+
+class FaultyRequestHandler(ServerRequestHandler):
+    """ Delays, drops or fails requests according to the fault profile of the unit they're for """
+
+    async def handle_request(self):
+        pdu, addr = self.last_pdu, self.last_addr
+        if not pdu:
+            return
+
+        faults = self.server.faults.get(pdu.dev_id, self.server.default_faults)
+        if faults.is_clean:
+            return await super().handle_request()
+
+        if random.random() < faults.reset_rate:
+            self.transport.abort()
+            return
+        if random.random() < faults.drop_rate:
+            return
+
+        function_code = pdu.function_code
+        start = getattr(pdu, "address", 0)
+        count = max(getattr(pdu, "count", 0), len(getattr(pdu, "registers", None) or getattr(pdu, "bits", None) or []), 1)
+
+        delay = faults.delay() + faults.transfer_time(function_code, len(pdu.encode()) + 1, count)
+        if delay:
+            await asyncio.sleep(delay)
+
+        for fault in faults.exceptions:
+            if fault.matches(function_code, start, count):
+                response = ExceptionResponse(function_code, fault.code)
+                response.transaction_id = pdu.transaction_id
+                response.dev_id = pdu.dev_id
+                self.server_send(response, addr)
+                return
+
+        # Another request may have arrived on the connection while this one waited
+        self.last_pdu, self.last_addr = pdu, addr
+        await super().handle_request()
+
+
+class SimulatorServer(ModbusTcpServer):
+    """ Modbus TCP server with per-unit fault injection """
+
+    def __init__(self, context: ModbusServerContext, address: tuple[str, int], faults: dict[int, FaultProfile] = None, default_faults: FaultProfile = None):
+        super().__init__(context, address=address)
+        self.faults = faults or {}
+        self.default_faults = default_faults or FaultProfile()
+
+    def callback_new_connection(self):
+        return FaultyRequestHandler(self, self.trace_packet, self.trace_pdu, self.trace_connect)
+
+
 class BaseModbusSimulator(BaseCommand, ABC):
     help = 'Runs a Modbus TCP simulator'
 
@@ -23,20 +369,17 @@ class BaseModbusSimulator(BaseCommand, ABC):
         parser.add_argument("--port", type=int, default=502)
         parser.add_argument("--interval", type=float, default=0.5)
         parser.add_argument("--size", type=int, default=2**13)
+        parser.add_argument("--report-interval", type=float, default=30, help="Seconds between tick rate reports")
+        add_fault_arguments(parser)
 
     def handle(self, *args, **options): #TODO word order
         self.port = options["port"]
         self.interval = options["interval"]
-        size = options["size"]
+        self.report_interval = options["report_interval"]
+        faults = fault_profile(options)
         
         # Memory
-        store = ModbusDeviceContext(
-            di=ModbusSequentialDataBlock(0, [0] * size),
-            co=ModbusSequentialDataBlock(0, [0] * size),
-            hr=ModbusSequentialDataBlock(0, [0] * size),
-            ir=ModbusSequentialDataBlock(0, [0] * size),
-        )
-        self.context = ModbusServerContext(devices=store, single=True)
+        self.context = ModbusServerContext(devices=create_device_store(options["size"]), single=True)
 
         # Setup
         logger.info("Setting up simulation...")
@@ -49,9 +392,14 @@ class BaseModbusSimulator(BaseCommand, ABC):
 
         # Server
         logger.info(f"Simulator running on port {self.port}")
-        StartTcpServer(context=self.context, address=("0.0.0.0", self.port))
+        server = SimulatorServer(self.context, address=("0.0.0.0", self.port), default_faults=faults)
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
 
     def _loop(self):
+        tick_rate = TickRate(self.interval, self.report_interval)
         while True:
             start_time = time.monotonic()
             try:
@@ -59,6 +407,7 @@ class BaseModbusSimulator(BaseCommand, ABC):
             except Exception as e:
                 logger.error(f"Simulation tick error: {e}")
             elapsed = time.monotonic() - start_time
+            tick_rate.add(elapsed)
             time.sleep(max(0, self.interval - elapsed))
 
     @abstractmethod
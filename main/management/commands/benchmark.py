@@ -0,0 +1,621 @@
+import io
+import csv
+import json
+import time
+import uuid
+import sys
+import random
+import asyncio
+import logging
+import threading
+import statistics
+import subprocess
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from pymodbus.datastore import ModbusServerContext
+from channels.layers import get_channel_layer
+from uvicorn import Config, Server
+from ...models import Device, Tag, TagHistoryEntry, AlarmConfig, ActivatedAlarm
+from ...api.serializers import TagValueSerializer
+from ...consumers import send_queue_sizes
+from ...services import poll_devices
+from ...services.cycle_trace import cycle_tracer
+from ...services.tag_encoder import TagValueEncoder
+from ...services.io_csv import DeviceImporter, TagImporter, AlarmConfigImporter
+from .base_simulator import create_device_store, TagLayout, SimulatorServer, FaultProfile, add_fault_arguments, fault_profile
+
+
+class Command(BaseCommand):
+    help = "Runs a performance benchmark and prints the results as JSON"
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+        encoder = subparsers.add_parser("encoder", help="Compare the poller's value encoder with TagValueSerializer")
+        encoder.add_argument("--tags", type=int, default=10000, help="Updated tags per cycle")
+        encoder.add_argument("--rounds", type=int, default=20)
+        encoder.add_argument("--alarmed", type=float, default=0.05, help="Fraction of tags with an active alarm")
+
+        importer = subparsers.add_parser("import", help="Time the CSV importers on a generated plant, in a temporary test database")
+        importer.add_argument("--rows", type=int, default=100000, help="Tag rows to import, with one alarm per 10 tags")
+        importer.add_argument("--devices", type=int, default=100)
+        importer.add_argument("--chunk-size", type=int, default=None)
+
+        poller = subparsers.add_parser("poller", help="Run the poller against simulated devices served in this process, in a temporary test database")
+        poller.add_argument("--devices", type=int, default=10)
+        poller.add_argument("--tags", type=int, default=100, help="Tags per device")
+        poller.add_argument("--duration", type=float, default=10, help="Seconds to poll for")
+        poller.add_argument("--interval", type=float, default=0.25, help="Poll interval, 0 to poll as fast as possible")
+        poller.add_argument("--data-type", choices=POLLER_DATA_TYPES, default=Tag.DataTypeChoices.FLOAT32)
+        poller.add_argument("--base-port", type=int, default=15020, help="Port of the first simulated device")
+        poller.add_argument("--concurrency", type=int, default=1, help="Concurrent read requests per device")
+        add_fault_arguments(poller)
+
+        websocket = subparsers.add_parser("websocket", help="Feed dashboard websocket clients from a poller and uvicorn in this process, in a temporary test database")
+        websocket.add_argument("--clients", type=int, default=100)
+        websocket.add_argument("--processes", type=int, default=1, help="Processes to run the clients in")
+        websocket.add_argument("--subscription", type=int, default=50, help="Tags each client subscribes to")
+        websocket.add_argument("--overlap", type=float, default=0.5, help="Fraction of each subscription that every client shares")
+        websocket.add_argument("--devices", type=int, default=10)
+        websocket.add_argument("--tags", type=int, default=100, help="Tags per device, all changing every interval")
+        websocket.add_argument("--duration", type=float, default=10, help="Seconds to poll for")
+        websocket.add_argument("--interval", type=float, default=0.25, help="Poll interval")
+        websocket.add_argument("--port", type=int, default=8765, help="Port for uvicorn")
+        websocket.add_argument("--base-port", type=int, default=15020, help="Port of the first simulated device")
+
+    def handle(self, *args, **options):
+        benchmark = getattr(self, f"bench_{options['benchmark']}")
+        result = benchmark(options)
+        self.stdout.write(json.dumps(result, indent=2))
+
+    def bench_encoder(self, options):
+        """ Time one broadcast's worth of updated tags through both serializers """
+
+        now = timezone.now()
+        tags = [
+            Tag(id=i, external_id=uuid.uuid4(), current_value=random.uniform(0, 100), last_updated=now)
+            for i in range(options["tags"])
+        ]
+
+        # The DRF serializer takes activated alarms, the encoder takes config ids
+        alarmed = random.sample(tags, int(len(tags) * options["alarmed"]))
+        alarm_objects = {tag.id: ActivatedAlarm(config=AlarmConfig(external_id=uuid.uuid4())) for tag in alarmed}
+        alarm_ids = {tag_id: str(alarm.config.external_id) for tag_id, alarm in alarm_objects.items()}
+
+        def run_serializer():
+            return TagValueSerializer(tags, many=True, context={"alarm_map": alarm_objects}).data
+
+        encoder = TagValueEncoder()
+        def run_encoder():
+            return encoder.encode(tags, alarm_ids)
+
+        # Warm up and compare output, ignoring age which depends on when it was computed
+        def strip_age(rows):
+            return [{k: v for k, v in row.items() if k != "age"} for row in rows]
+
+        matches = strip_age(run_serializer()) == strip_age(run_encoder())
+
+        serializer_times = _time_rounds(run_serializer, options["rounds"])
+        encoder_times = _time_rounds(run_encoder, options["rounds"])
+
+        return {
+            "benchmark": "encoder",
+            "tags": len(tags),
+            "rounds": options["rounds"],
+            "output_matches": matches,
+            "serializer": _summarize(serializer_times, len(tags)),
+            "encoder": _summarize(encoder_times, len(tags)),
+            "speedup": statistics.median(serializer_times) / statistics.median(encoder_times),
+        }
+
+
+    def bench_import(self, options):
+        """ Import a generated CSV plant twice, once creating and once updating every row """
+
+        rows, devices = options["rows"], options["devices"]
+        chunk_size = options["chunk_size"]
+
+        device_csv = _write_csv(["alias", "ip_address", "port"], (
+            [f"device-{d}", "127.0.0.1", 502 + d] for d in range(devices)
+        ))
+        tag_ids = [uuid.uuid4() for _ in range(rows)]
+        tag_csv = _write_csv(["device", "alias", "channel", "data_type", "address", "history_interval", "external_id"], (
+            [f"device-{i % devices}", f"tag-{i}", "hr", "float32", (i // devices) * 2, "0:00:01", tag_ids[i]] for i in range(rows)
+        ))
+        alarm_csv = _write_csv(["tag", "trigger_value", "operator", "alias", "threat_level", "notification_cooldown"], (
+            [tag_ids[i], 50.5, "greater_than", "high", "high", "0:01:00"] for i in range(0, rows, 10)
+        ))
+
+        def run_import(importer_class, text):
+            start = time.perf_counter()
+            result = importer_class(io.StringIO(text), chunk_size=chunk_size).run()
+            elapsed = time.perf_counter() - start
+            return {
+                "rows": result.saved,
+                "errors": len(result.errors),
+                "seconds": elapsed,
+                "rows_per_second": result.saved / elapsed if elapsed else None,
+            }
+
+        with _test_database():
+            results = {"devices": run_import(DeviceImporter, device_csv)}
+            for phase in ["create", "update"]:
+                results[f"tags_{phase}"] = run_import(TagImporter, tag_csv)
+                results[f"alarms_{phase}"] = run_import(AlarmConfigImporter, alarm_csv)
+
+        return {"benchmark": "import", "rows": rows, **results}
+
+    def bench_poller(self, options):
+        """ Poll generated devices for a fixed time and report cycle times and throughput """
+
+        with _quiet_logs(options["verbosity"]), _test_database():
+            result = poller_benchmark(
+                devices=options["devices"],
+                tags_per_device=options["tags"],
+                duration=options["duration"],
+                interval=options["interval"],
+                data_type=options["data_type"],
+                base_port=options["base_port"],
+                faults=fault_profile(options),
+                concurrency=options["concurrency"],
+            )
+
+        return {"benchmark": "poller", "commit": _git_commit(), **result}
+
+    def bench_websocket(self, options):
+        """ Measure delivery of polled values to many dashboard clients """
+
+        if not 0 <= options["overlap"] <= 1:
+            raise CommandError("--overlap must be between 0 and 1")
+        if options["subscription"] > options["devices"] * options["tags"]:
+            raise CommandError("--subscription can't be larger than the plant")
+
+        with _quiet_logs(options["verbosity"]), _test_database():
+            result = websocket_benchmark(
+                clients=options["clients"],
+                processes=options["processes"],
+                subscription=options["subscription"],
+                overlap=options["overlap"],
+                devices=options["devices"],
+                tags_per_device=options["tags"],
+                duration=options["duration"],
+                interval=options["interval"],
+                port=options["port"],
+                base_port=options["base_port"],
+            )
+
+        return {"benchmark": "websocket", "commit": _git_commit(), **result}
+
+
+# Data types the poller benchmark can generate values for
+POLLER_DATA_TYPES = [
+    Tag.DataTypeChoices.INT16, Tag.DataTypeChoices.UINT16,
+    Tag.DataTypeChoices.INT32, Tag.DataTypeChoices.UINT32,
+    Tag.DataTypeChoices.FLOAT32, Tag.DataTypeChoices.FLOAT64,
+]
+
+
+class SimulatedPlant:
+    """ Modbus TCP servers for a set of devices, run on their own event loop in a background thread.
+    Every interval, all the tags of each device get new random values """
+
+    def __init__(self, devices: list[Device], tags: list[Tag], interval: float, faults: FaultProfile = None):
+        self.devices = devices
+        self.interval = interval
+        self.faults = faults
+        self.stores = {device.alias: create_device_store() for device in devices}
+        device_tags = defaultdict(list)
+        for tag in tags:
+            device_tags[tag.device.alias].append(tag)
+        self.layouts = {alias: TagLayout(tags) for alias, tags in device_tags.items()}
+
+        self.cpu_seconds = 0.0
+        self.ticks = 0
+        self._ready = threading.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stop: asyncio.Event | None = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        if not self._ready.wait(timeout=30):
+            raise RuntimeError("Simulated devices didn't start")
+        return self
+
+    def __exit__(self, *exc):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+
+    def _run(self):
+        start = time.thread_time()
+        asyncio.run(self._serve())
+        self.cpu_seconds = time.thread_time() - start
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+
+        servers = []
+        for device in self.devices:
+            context = ModbusServerContext(devices=self.stores[device.alias], single=True)
+            server = SimulatorServer(context, address=(device.ip_address, device.port), default_faults=self.faults)
+            await server.serve_forever(background=True)
+            servers.append(server)
+
+        self.tick()
+        self._ready.set()
+
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), timeout=self.interval or 0.1)
+            except asyncio.TimeoutError:
+                self.tick()
+
+        for server in servers:
+            await server.shutdown()
+
+    def tick(self):
+        for alias, layout in self.layouts.items():
+            layout.animate(self.stores[alias])
+        self.ticks += 1
+
+
+def create_plant(devices: int, tags_per_device: int, data_type: str, base_port: int, concurrency: int = 1) -> tuple[list[Device], list[Tag]]:
+    """ Devices on consecutive localhost ports, each with contiguous holding register tags that keep history """
+
+    device_objects = Device.objects.bulk_create([
+        Device(alias=f"bench-{d}", ip_address="127.0.0.1", port=base_port + d, max_concurrent_requests=concurrency)
+        for d in range(devices)
+    ])
+
+    tags = []
+    for device in device_objects:
+        address = 0
+        for t in range(tags_per_device):
+            tag = Tag(
+                device=device, alias=f"{device.alias}-tag-{t}", channel=Tag.ChannelChoices.HOLDING_REGISTER,
+                data_type=data_type, address=address, history_retention=timedelta(days=1),
+            )
+            address += tag.get_read_count()
+            tags.append(tag)
+
+    return device_objects, Tag.objects.bulk_create(tags)
+
+
+def poller_benchmark(devices: int, tags_per_device: int, duration: float, interval: float, data_type: str, base_port: int,
+                     faults: FaultProfile = None, concurrency: int = 1) -> dict:
+    """ Run the real poll loop against simulated devices in the current database, and measure it.
+    CPU time of the simulated devices is measured on their thread and left out of the poller's """
+
+    device_objects, tags = create_plant(devices, tags_per_device, data_type, base_port, concurrency)
+    errors_before = sum(series.value for series in poll_devices.errors.series.values())
+
+    with SimulatedPlant(device_objects, tags, interval, faults) as plant, cycle_tracer.keeping_all() as traces:
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+
+        async def run():
+            try:
+                await poll_devices.poll_devices(poll_interval=interval, duration=duration)
+            finally:
+                poll_devices.close_clients()
+
+        asyncio.run(run())
+
+        elapsed = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+        traces = [trace for trace in traces if trace.end is not None]
+
+    poller_cpu = cpu_seconds - plant.cpu_seconds
+    cycle_times = sorted(trace.duration for trace in traces)
+
+    tags_read = sum(span.args.get("tags", 0) for trace in traces for span in trace.spans if span.name == "decode")
+    tag_rows = sum(span.args.get("rows", 0) for trace in traces for span in trace.spans if span.name.startswith("flush "))
+    history_rows = TagHistoryEntry.objects.count()
+
+    phases = defaultdict(float)
+    for trace in traces:
+        for name, seconds in trace.phase_totals().items():
+            phases[name] += seconds
+
+    return {
+        "devices": devices,
+        "tags": len(tags),
+        "data_type": data_type,
+        "interval": interval,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "cycles": len(traces),
+        "overruns": sum(1 for t in cycle_times if interval and t > interval),
+        "simulator_ticks": plant.ticks,
+        "errors": sum(series.value for series in poll_devices.errors.series.values()) - errors_before,
+        "cycle_ms": {
+            **{f"p{p}": _percentile(cycle_times, p) * 1000 for p in (50, 90, 99)},
+            "max": cycle_times[-1] * 1000 if cycle_times else None,
+        },
+        "phase_ms_per_cycle": {name: seconds / len(traces) * 1000 for name, seconds in phases.items()} if traces else {},
+        "tags_per_second": tags_read / elapsed,
+        "db_rows_per_second": (tag_rows + history_rows) / elapsed,
+        "history_rows": history_rows,
+        "cpu": {
+            "poller_seconds": poller_cpu,
+            "simulator_seconds": plant.cpu_seconds,
+            "poller_us_per_tag": poller_cpu / tags_read * 1e6 if tags_read else None,
+        },
+    }
+
+
+def _write_csv(header: list[str], rows) -> str:
+    file = io.StringIO()
+    writer = csv.writer(file)
+    writer.writerow(header)
+    writer.writerows(rows)
+    return file.getvalue()
+
+
+@contextmanager
+def _test_database():
+    """ Run against freshly migrated test databases, so benchmarks never touch real data """
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        teardown_test_environment()
+
+
+class BroadcastRecorder:
+    """ Joins the poller's broadcast group like a dashboard client would, to record which
+    updates were sent for each tag and so how many every subscription should have received """
+
+    def __init__(self):
+        self.seqs: dict[str, list[int]] = defaultdict(list)
+
+    async def __aenter__(self):
+        self.layer = get_channel_layer()
+        self.channel = await self.layer.new_channel()
+        await self.layer.group_add("poller_broadcast", self.channel)
+        self.task = asyncio.create_task(self._receive())
+        return self
+
+    async def __aexit__(self, *exc):
+        self.task.cancel()
+        await self.layer.group_discard("poller_broadcast", self.channel)
+
+    async def _receive(self):
+        while True:
+            message = await self.layer.receive(self.channel)
+            if message["type"] == "tag_update":
+                for update in message["updates"]:
+                    self.seqs[update["id"]].append(update["seq"])
+
+    def expected(self, tags: list[str], after_seq: int) -> int:
+        """ Updates sent for the given tags after a sequence number """
+        return sum(len(seqs) - bisect_right(seqs, after_seq) for tag in tags if (seqs := self.seqs.get(tag)))
+
+
+def websocket_benchmark(clients: int, processes: int, subscription: int, overlap: float, devices: int,
+                        tags_per_device: int, duration: float, interval: float, port: int, base_port: int) -> dict:
+    """ Serve dashboard websocket clients running in subprocesses from the real poller and consumer,
+    with every simulated tag changing each interval, and measure what reaches them.
+
+    Latency is from the PLC read to the client receiving the message. Lost updates are those the
+    poller broadcast for a client's tags after its snapshot that never reached it. Server CPU is
+    this process's, minus the simulated devices' thread. The clients are left out.
+    """
+
+    device_objects, tags = create_plant(devices, tags_per_device, Tag.DataTypeChoices.FLOAT32, base_port)
+    tag_ids = [str(tag.external_id) for tag in tags]
+
+    # Every client gets the shared tags, plus its own random pick of the rest
+    shared_count = round(subscription * overlap)
+    rng = random.Random(0)
+    shared = rng.sample(tag_ids, shared_count)
+    rest = sorted(set(tag_ids) - set(shared))
+    subscriptions = [shared + rng.sample(rest, subscription - shared_count) for _ in range(clients)]
+
+    async def run():
+        server = Server(Config("modbus_tiles.asgi:application", host="127.0.0.1", port=port, lifespan="off", log_level="warning"))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            if server_task.done():
+                await server_task
+                raise CommandError(f"Couldn't start uvicorn on port {port}")
+            await asyncio.sleep(0.05)
+
+        workers = []
+        try:
+            async with BroadcastRecorder() as recorder:
+                # Start the clients and wait until all of them have subscribed
+                config = {"url": f"ws://127.0.0.1:{port}/ws/dashboard/"}
+                for part in range(processes):
+                    worker = await asyncio.create_subprocess_exec(
+                        sys.executable, "-m", "main.management.commands._ws_clients",
+                        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, cwd=settings.BASE_DIR,
+                    )
+                    worker.stdin.write(json.dumps({**config, "subscriptions": subscriptions[part::processes]}).encode() + b"\n")
+                    await worker.stdin.drain()
+                    workers.append(worker)
+
+                for worker in workers:
+                    if (await worker.stdout.readline()).strip() != b"ready":
+                        raise CommandError("A websocket client process exited before connecting, see its output above")
+
+                # Poll, sampling the largest backlog of any client while it runs
+                queue_max = 0
+                async def sample_queues():
+                    nonlocal queue_max
+                    while True:
+                        queue_max = max(queue_max, max(send_queue_sizes(), default=0))
+                        await asyncio.sleep(0.1)
+
+                sampler = asyncio.create_task(sample_queues())
+                cpu_start = time.process_time()
+                start = time.perf_counter()
+                try:
+                    await poll_devices.poll_devices(poll_interval=interval, duration=duration)
+                finally:
+                    poll_devices.close_clients()
+                elapsed = time.perf_counter() - start
+
+                # Let the clients drain their queues before stopping them
+                drain_until = time.monotonic() + 5
+                while sum(send_queue_sizes()) and time.monotonic() < drain_until:
+                    await asyncio.sleep(0.1)
+                await asyncio.sleep(0.5)
+
+                cpu = (time.process_time() - cpu_start, time.perf_counter() - start)
+                sampler.cancel()
+
+                reports = []
+                for worker in workers:
+                    worker.stdin.write(b"stop\n")
+                    await worker.stdin.drain()
+                    reports.append(json.loads(await worker.stdout.readline()))
+                    await worker.wait()
+
+                for part, report in enumerate(reports):
+                    for client, tags in zip(report["clients"], subscriptions[part::processes]):
+                        client["expected"] = recorder.expected(tags, client["base_seq"]) if client["base_seq"] is not None else 0
+
+                return reports, elapsed, cpu, queue_max
+
+        finally:
+            for worker in workers:
+                if worker.returncode is None:
+                    worker.kill()
+            server.should_exit = True
+            await server_task
+
+    with SimulatedPlant(device_objects, tags, interval) as plant, cycle_tracer.keeping_all() as traces:
+        reports, elapsed, (cpu_seconds, cpu_elapsed), queue_max = asyncio.run(run())
+        cycle_times = sorted(trace.duration for trace in traces if trace.end is not None)
+
+    results = [client for report in reports for client in report["clients"]]
+    latencies = Counter()
+    for report in reports:
+        latencies.update({int(tenths): count for tenths, count in report["latencies"]})
+
+    connected = [client for client in results if client["base_seq"] is not None]
+    updates = sum(client["updates"] for client in connected)
+    expected = sum(client["expected"] for client in connected)
+    server_cpu = cpu_seconds - plant.cpu_seconds
+
+    return {
+        "clients": clients,
+        "processes": processes,
+        "subscription": subscription,
+        "overlap": overlap,
+        "tags": len(tags),
+        "interval": interval,
+        "seconds": elapsed,
+        "connected": len(connected),
+        "disconnected": sum(1 for client in connected if client["error"]),
+        "messages": sum(client["messages"] for client in connected),
+        "messages_per_second": sum(client["messages"] for client in connected) / elapsed,
+        "updates": updates,
+        "expected_updates": expected,
+        "lost_updates": max(0, expected - updates),
+        "loss_ratio": max(0, expected - updates) / expected if expected else 0.0,
+        "out_of_order": sum(client["out_of_order"] for client in connected),
+        "latency_ms": {
+            **{f"p{p}": _histogram_percentile(latencies, p) / 10 for p in (50, 90, 99)},
+            "max": max(latencies) / 10,
+        } if latencies else None,
+        "send_queue_max": queue_max,
+        "poll_cycle_ms": {f"p{p}": _percentile(cycle_times, p) * 1000 for p in (50, 99)} if cycle_times else None,
+        "server": {
+            "cpu_seconds": server_cpu,
+            "cpu_percent": server_cpu / cpu_elapsed * 100,
+            "max_rss_mb": _max_rss_mb(),
+        },
+    }
+
+
+@contextmanager
+def _quiet_logs(verbosity: int):
+    """ Only show errors below verbosity 2, since every slow poll cycle logs a warning """
+
+    loggers = [logging.getLogger(name) for name in ["main", "pymodbus"]]
+    levels = [logger.level for logger in loggers]
+    if verbosity < 2:
+        for logger in loggers:
+            logger.setLevel(logging.ERROR)
+    try:
+        yield
+    finally:
+        for logger, level in zip(loggers, levels):
+            logger.setLevel(level)
+
+
+def _max_rss_mb() -> float | None:
+    """ Peak memory of this process, where the platform reports it """
+
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024 # Bytes on macOS, KiB on Linux
+
+
+def _git_commit() -> str | None:
+    """ The checked out commit, so results can be compared between commits """
+
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=5)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def _percentile(values: list[float], percent: float) -> float | None:
+    """ Nearest rank percentile of sorted values """
+
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(percent / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def _histogram_percentile(counts: Counter, percent: float) -> float:
+    """ Nearest rank percentile of values given as value -> count """
+
+    total = sum(counts.values())
+    rank = max(1, round(percent / 100 * total))
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= rank:
+            return value
+    return max(counts)
+
+
+def _time_rounds(func, rounds: int) -> list[float]:
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _summarize(times: list[float], items: int) -> dict:
+    """ Timing stats for a list of round durations in seconds """
+
+    median = statistics.median(times)
+    return {
+        "median_ms": median * 1000,
+        "min_ms": min(times) * 1000,
+        "max_ms": max(times) * 1000,
+        "per_item_us": median / items * 1e6,
+    }
@@ -0,0 +1,174 @@
+import io
+import os
+import csv
+import time
+import uuid
+import asyncio
+import logging
+from dataclasses import dataclass
+from django.core.management.base import BaseCommand, CommandError
+from pymodbus.datastore import ModbusDeviceContext, ModbusServerContext
+from ...models import Device, Tag
+from ...services.io_csv import DeviceImporter, TagImporter
+from .base_simulator import create_device_store, TagLayout, TickRate, SimulatorServer, FaultProfile
+from .base_simulator import add_fault_arguments, fault_profile, load_fault_profiles, match_fault_profile
+
+
+logger = logging.getLogger(__name__)
+
+# Namespace for the external ids of generated tags, so regenerating the same plant updates its tags on import
+PLANT_NAMESPACE = uuid.UUID("6f1c2a8e-4b4d-4a55-9a43-0c5b8f3e2d17")
+
+
+@dataclass
+class VirtualDevice:
+    alias: str
+    port: int
+    unit_id: int
+    store: ModbusDeviceContext
+
+
+class Command(BaseCommand):
+    help = "Simulates a plant of many devices in one process, each a copy of a tag template on its own port or unit ID"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--template", default="test_data/TestTags.csv", help="Tags of one device, in the tag importer's CSV format. The device, unit_id and external_id columns are replaced")
+        parser.add_argument("--devices", type=int, default=100)
+        parser.add_argument("--units-per-port", type=int, default=1, help="Devices to serve on each port, under unit IDs 1, 2, ...")
+        parser.add_argument("--prefix", default="sim", help="Device alias prefix")
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--base-port", type=int, default=5020)
+        parser.add_argument("--interval", type=float, default=0.5)
+        parser.add_argument("--size", type=int, default=2**13)
+        parser.add_argument("--report-interval", type=float, default=30, help="Seconds between tick rate reports")
+        parser.add_argument("--csv", metavar="DIR", help="Write the plant's devices and tags as importer CSVs to this directory")
+        parser.add_argument("--load", action="store_true", help="Import the plant's devices and tags into the database")
+        parser.add_argument("--no-serve", action="store_true", help="Exit after writing or loading the plant")
+        add_fault_arguments(parser)
+        parser.add_argument("--fault-profiles", metavar="FILE", help='JSON of fault settings by device alias pattern, e.g. {"sim-00*": {"latency": 0.05}}. Devices matching none use the options above')
+
+    def handle(self, *args, **options):
+        self.interval = options["interval"]
+        self.report_interval = options["report_interval"]
+        self.default_faults = fault_profile(options)
+        self.fault_profiles = load_fault_profiles(options["fault_profiles"]) if options["fault_profiles"] else {}
+        units_per_port = options["units_per_port"]
+        if not 1 <= units_per_port <= 247:
+            raise CommandError("--units-per-port must be between 1 and 247")
+
+        with open(options["template"], newline="") as file:
+            template = list(csv.DictReader(file))
+        if not template:
+            raise CommandError(f"No tags in {options['template']}")
+
+        self.template = [self.template_tag(row) for row in template]
+        self.layout = TagLayout([tag for tag in self.template if tag.channel in [Tag.ChannelChoices.INPUT_REGISTER, Tag.ChannelChoices.DISCRETE_INPUT]])
+
+        size = options["size"]
+        top = max(tag.address + tag.get_read_count() for tag in self.template)
+        if top > size:
+            raise CommandError(f"The template uses addresses up to {top}, increase --size")
+
+        self.devices = [
+            VirtualDevice(
+                alias=f"{options['prefix']}-{i:03d}",
+                port=options["base_port"] + i // units_per_port,
+                unit_id=1 + i % units_per_port,
+                store=create_device_store(size),
+            )
+            for i in range(options["devices"])
+        ]
+
+        # Devices connect to the simulator, so a wildcard bind address isn't usable for them
+        device_host = "127.0.0.1" if options["host"] in ["0.0.0.0", "::"] else options["host"]
+        device_csv, tag_csv = self.plant_csv(template, device_host)
+
+        if options["csv"]:
+            os.makedirs(options["csv"], exist_ok=True)
+            for name, text in [("PlantDevices.csv", device_csv), ("PlantTags.csv", tag_csv)]:
+                path = os.path.join(options["csv"], name)
+                with open(path, "w", newline="") as file:
+                    file.write(text)
+                self.stdout.write(f"Wrote {path}")
+
+        if options["load"]:
+            for importer_class, text in [(DeviceImporter, device_csv), (TagImporter, tag_csv)]:
+                result = importer_class(io.StringIO(text)).run()
+                self.stdout.write(f"Imported {result.saved} {importer_class.model._meta.verbose_name_plural}, {len(result.errors)} errors")
+                for error in result.errors[:10]:
+                    self.stderr.write(f"  {error}")
+
+        if options["no_serve"]:
+            return
+
+        try:
+            asyncio.run(self.serve(options["host"]))
+        except KeyboardInterrupt:
+            pass
+
+    def template_tag(self, row: dict) -> Tag:
+        """ Unsaved tag with the memory layout of a template row """
+
+        try:
+            return Tag(
+                alias=row["alias"],
+                channel=row["channel"],
+                data_type=row["data_type"],
+                address=int(row["address"]),
+                bit_index=int(row.get("bit_index") or 0),
+            )
+        except (KeyError, ValueError) as e:
+            raise CommandError(f"Invalid template row {row}: {e}")
+
+    def plant_csv(self, template: list[dict], host: str) -> tuple[str, str]:
+        """ Device and tag CSVs for the importers, matching the simulated devices """
+
+        devices = io.StringIO()
+        writer = csv.writer(devices)
+        writer.writerow(DeviceImporter.fields)
+        for device in self.devices:
+            writer.writerow([device.alias, host, device.port, Device.ProtocolChoices.MODBUS_TCP, Device.WordOrderChoices.BIG, True])
+
+        tags = io.StringIO()
+        writer = csv.DictWriter(tags, TagImporter.fields, extrasaction="ignore")
+        writer.writeheader()
+        for device in self.devices:
+            for i, row in enumerate(template):
+                writer.writerow({
+                    **row,
+                    "device": device.alias,
+                    "unit_id": device.unit_id,
+                    "external_id": uuid.uuid5(PLANT_NAMESPACE, f"{device.alias}/{row.get('external_id') or i}"),
+                })
+
+        return devices.getvalue(), tags.getvalue()
+
+    async def serve(self, host: str):
+        ports: dict[int, dict[int, ModbusDeviceContext]] = {}
+        faults: dict[int, dict[int, FaultProfile]] = {}
+        for device in self.devices:
+            ports.setdefault(device.port, {})[device.unit_id] = device.store
+            faults.setdefault(device.port, {})[device.unit_id] = match_fault_profile(device.alias, self.fault_profiles, self.default_faults)
+
+        for port, units in ports.items():
+            server = SimulatorServer(ModbusServerContext(devices=units, single=False), address=(host, port), faults=faults[port])
+            await server.serve_forever(background=True)
+
+        logger.info(f"Simulating {len(self.devices)} devices on ports {min(ports)}-{max(ports)}")
+
+        tick_rate = TickRate(self.interval, self.report_interval)
+        while True:
+            start_time = time.monotonic()
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Simulation tick error: {e}")
+            elapsed = time.monotonic() - start_time
+            tick_rate.add(elapsed)
+            await asyncio.sleep(max(0, self.interval - elapsed))
+
+    def tick(self):
+        """ Animate the read-only tags of every device """
+
+        for device in self.devices:
+            self.layout.animate(device.store)
@@ -1,11 +1,9 @@
-import random
-import math
-import time
 import json
+import time
 from ...models import Tag, Dashboard
 from ...services.io_csv import DeviceImporter, TagImporter, AlarmConfigImporter
 from ...api.views import DashboardViewSet
-from .base_simulator import BaseModbusSimulator
+from .base_simulator import BaseModbusSimulator, TagLayout
 from django.contrib.auth import get_user_model
 import logging
 
@@ -15,30 +13,26 @@ User = get_user_model()
 class Command(BaseModbusSimulator):
     help = 'Animates read-only tags found in the database with random noise'
 
-    def tick(self):
-        # Fetch active input tags from DB
-        tags = Tag.objects.filter(
-            is_active=True, 
-            channel__in=[Tag.ChannelChoices.INPUT_REGISTER, Tag.ChannelChoices.DISCRETE_INPUT]
-        )
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument("--reload-interval", type=float, default=10, help="Seconds between reloads of the tags to animate")
 
-        for tag in tags:
-            val = self._noise(tag)
-            self.write_tag(tag, val)
+    def handle(self, *args, **options):
+        self.reload_interval = options["reload_interval"]
+        self.layout: TagLayout | None = None
+        self.layout_expires = 0.0
+        super().handle(*args, **options)
 
-    def _noise(self, tag: Tag):
-        if tag.data_type == Tag.DataTypeChoices.BOOL:
-            return random.choice([True, False])
-        
-        elif tag.data_type in [Tag.DataTypeChoices.FLOAT32, Tag.DataTypeChoices.FLOAT64]:
-            # Simple sine wave based on address to desynchronize them
-            base = math.sin(time.time() + tag.address) * 10
-            return base + random.uniform(-1, 1)
-        
-        elif tag.data_type == Tag.DataTypeChoices.STRING:
-            return "" #TODO
-            
-        return random.randint(0, 10) #TODO base off int type?
+    def tick(self):
+        # Fetch active input tags from DB, now and then rather than every tick
+        if time.monotonic() >= self.layout_expires:
+            self.layout = TagLayout(list(Tag.objects.filter(
+                is_active=True, 
+                channel__in=[Tag.ChannelChoices.INPUT_REGISTER, Tag.ChannelChoices.DISCRETE_INPUT]
+            )))
+            self.layout_expires = time.monotonic() + self.reload_interval
+
+        self.layout.animate(self.context[0])
     
     def setup_simulation(self):
         user = User.objects.filter(username="testuser").first()
@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-19 14:02
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alarmconfig',
+            name='clear_sustain',
+            field=models.DurationField(default=datetime.timedelta(0), help_text='How long the value must stay back to normal before the alarm resolves'),
+        ),
+        migrations.AddField(
+            model_name='alarmconfig',
+            name='deadband',
+            field=models.FloatField(default=0, help_text='How far back past the trigger value the tag must go before the alarm resolves'),
+        ),
+        migrations.AddField(
+            model_name='alarmconfig',
+            name='trigger_sustain',
+            field=models.DurationField(default=datetime.timedelta(0), help_text='How long the trigger condition must hold before the alarm activates'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.0 on 2026-10-19 15:10
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_alarmconfig_debounce'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='alarmconfig',
+            name='window',
+            field=models.DurationField(default=datetime.timedelta(seconds=60), help_text='Time span used by the rate of change, average and stuck value operators'),
+        ),
+        migrations.AlterField(
+            model_name='alarmconfig',
+            name='operator',
+            field=models.TextField(choices=[('equals', 'Equals'), ('greater_than', 'Greater Than'), ('less_than', 'Less Than'), ('rate_of_change', 'Rate of Change Above'), ('average_above', 'Average Above'), ('average_below', 'Average Below'), ('stuck', 'Stuck Value')], default='equals'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-19 09:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_alarmconfig_window'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activatedalarm',
+            index=models.Index(fields=['-timestamp'], name='main_activa_timesta_8a600f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activatedalarm',
+            index=models.Index(fields=['is_active', 'acknowledged', '-timestamp'], name='main_activa_is_acti_146c7b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='activatedalarm',
+            index=models.Index(fields=['acknowledged', '-timestamp'], name='main_activa_acknowl_12eff2_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-19 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_activatedalarm_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dashboard',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Incremented on every save, so editors can detect concurrent changes'),
+        ),
+    ]
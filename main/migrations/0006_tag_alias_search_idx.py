@@ -0,0 +1,20 @@
+# Generated by Django 6.0 on 2026-10-19 11:20
+
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_dashboard_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tag',
+            index=models.Index(django.db.models.functions.text.Lower('alias'), models.F('id'), name='tag_alias_search_idx'),
+        ),
+    ]
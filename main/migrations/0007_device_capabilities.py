@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:58
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_tag_alias_search_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='capabilities_probed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='max_concurrent_requests',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Read requests to have in flight at once, each on its own connection', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(16)]),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='max_read_registers',
+            field=models.PositiveSmallIntegerField(default=125, help_text='Most registers or bits to read in one request', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(125)]),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='probe_capabilities',
+            field=models.BooleanField(default=False, help_text='Find the limits above by testing the device the next time it is polled'),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='supports_mask_write',
+            field=models.BooleanField(default=True, help_text='Handles mask write register (FC22). Without it, bits in holding registers are set by reading and rewriting the whole register'),
+        ),
+    ]
@@ -1,13 +1,18 @@
 import uuid
 import os
+import heapq
 import logging
 from datetime import timedelta
-from typing import Self
+from collections import defaultdict
+from typing import Self, Any, Callable
+from operator import eq, gt, lt, ge, le
 from django.db import models
+from django.db.models.functions import Lower
 from django.utils import timezone
 from django.utils.text import slugify
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator, MaxValueValidator
 from pymodbus.client.base import ModbusBaseClient
 
 
@@ -34,6 +39,13 @@ class Device(models.Model):
     word_order = models.TextField(choices=WordOrderChoices.choices, default=WordOrderChoices.BIG)
     #poll_rate = models.FloatField(default=0.5)
 
+    # What the device can handle, set by hand or found by probing it on first connect
+    max_read_registers = models.PositiveSmallIntegerField(default=125, validators=[MinValueValidator(1), MaxValueValidator(125)], help_text="Most registers or bits to read in one request")
+    supports_mask_write = models.BooleanField(default=True, help_text="Handles mask write register (FC22). Without it, bits in holding registers are set by reading and rewriting the whole register")
+    max_concurrent_requests = models.PositiveSmallIntegerField(default=1, validators=[MinValueValidator(1), MaxValueValidator(16)], help_text="Read requests to have in flight at once, each on its own connection")
+    probe_capabilities = models.BooleanField(default=False, help_text="Find the limits above by testing the device the next time it is polled")
+    capabilities_probed_at = models.DateTimeField(null=True, blank=True)
+
     is_active = models.BooleanField(default=True)
 
     #created_at = models.DateTimeField(auto_now_add=True)
@@ -92,6 +104,9 @@ class Tag(models.Model):
 
     class Meta:
         unique_together = ("device", "channel", "address", "unit_id", "bit_index")
+        indexes = [
+            models.Index(Lower("alias"), "id", name="tag_alias_search_idx"), # Tag search and pagination
+        ]
 
     def get_read_count(self):
         from math import ceil
@@ -163,35 +178,116 @@ class Tag(models.Model):
             self.ChannelChoices.INPUT_REGISTER: 4,
         }[self.channel]
     
-    def clean(self):
-        super().clean()
+    @classmethod
+    def read_count_expression(cls):
+        """ Database expression matching `get_read_count` """
+
+        types = cls.DataTypeChoices
+        return models.Case(
+            models.When(data_type__in=[types.INT32, types.UINT32, types.FLOAT32], then=models.F("read_amount") * 2),
+            models.When(data_type__in=[types.INT64, types.UINT64, types.FLOAT64], then=models.F("read_amount") * 4),
+            models.When(data_type=types.STRING, then=(models.F("read_amount") + 1) / 2),
+            default=models.F("read_amount"),
+            output_field=models.IntegerField(),
+        )
+
+    @classmethod
+    def find_overlaps(cls: Self, tags: list[Self], identity: Callable[[Self], Any] = None, ignore=()) -> list[Self | None]:
+        """ Check new or changed tags for memory overlaps with each other and with saved tags
+
+        Returns the tag that each given tag overlaps, or None. Saved tags with the same identity
+        as a given tag (its external id by default) are treated as replaced by it, and saved tags
+        with an identity in `ignore` are treated as deleted. Candidates are
+        fetched by address range in one query, then each device channel is swept in address order,
+        testing each tag against every range still open at its address. A batch costs O(n log n)
+        plus the number of overlapping pairs.
+        """
+
+        if not tags:
+            return []
+
+        identity = identity or (lambda tag: tag.external_id)
+        checked = [_AddressRange(tag, index) for index, tag in enumerate(tags)]
+
+        groups: dict[tuple, list[_AddressRange]] = defaultdict(list)
+        for entry in checked:
+            groups[entry.group].append(entry)
+
+        # Saved tags that could overlap, found through the address index
+        query = models.Q()
+        for (device_id, channel, unit_id), entries in groups.items():
+            query |= models.Q(
+                device_id=device_id, channel=channel, unit_id=unit_id,
+                address__lt=max(e.end for e in entries),
+                end__gt=min(e.start for e in entries),
+            )
+
+        replaced = {identity(tag) for tag in tags} | set(ignore)
+        saved = (cls.objects
+            .annotate(end=models.ExpressionWrapper(models.F("address") + cls.read_count_expression(), output_field=models.IntegerField()))
+            .filter(query)
+            .only("id", "external_id", "device_id", "alias", "channel", "unit_id", "data_type", "address", "bit_index", "read_amount"))
 
+        for tag in saved:
+            if identity(tag) not in replaced:
+                entry = _AddressRange(tag)
+                groups[entry.group].append(entry)
+
+        overlaps: list[Tag | None] = [None] * len(tags)
+
+        def conflict(entry: _AddressRange, other: _AddressRange):
+            for a, b in [(entry, other), (other, entry)]:
+                if a.index is not None and overlaps[a.index] is None:
+                    overlaps[a.index] = b.tag
+                    return
+
+        for entries in groups.values():
+            entries.sort(key=lambda e: e.start)
+
+            # Ranges that reach the current address, ordered by where they end
+            active: list[tuple[int, int, _AddressRange]] = []
+
+            for position, entry in enumerate(entries):
+                while active and active[0][0] <= entry.start:
+                    heapq.heappop(active)
+
+                for _, _, other in active:
+                    if entry.index is None and other.index is None:
+                        continue # Saved tags are only checked against the batch
+
+                    # Bit indexed tags may share their register, on different bits
+                    if entry.bit_indexed and other.bit_indexed and entry.start == other.start and entry.tag.bit_index != other.tag.bit_index:
+                        continue
+
+                    conflict(entry, other)
+
+                heapq.heappush(active, (entry.end, position, entry))
+
+        return overlaps
+
+    def get_overlap_error(self, other: Self) -> ValidationError:
+        self_start = self.address
+        self_end = self_start + self.get_read_count()
+        other_start = other.address
+        other_end = other_start + other.get_read_count()
+
+        return ValidationError({
+            "address": f"Memory overlap with tag '{other}' "
+            f"Range [{self_start}-{self_end}] conflicts with [{other_start}-{other_end}]."
+        })
+
+    def clean_bit_index(self):
         if not (0 <= self.bit_index <= 15):
             raise ValidationError({ "bit_index": "Bit index must be between 0 and 15" })
-        
-        self_size = self.get_read_count()
-        self_start = self.address
-        self_end = self_start + self_size
 
-        siblings = Tag.objects.filter(device=self.device, channel=self.channel, unit_id=self.unit_id).exclude(pk=self.pk)
+    def clean(self):
+        super().clean()
+        self.clean_bit_index()
 
         # Check memory overlaps
-        for sibling in siblings:
-            sib_size = sibling.get_read_count()
-            sib_start = sibling.address
-            sib_end = sib_start + sib_size
-            
-            has_overlap = max(self_start, sib_start) < min(self_end, sib_end)
-            
-            if has_overlap:
-                # Allow same register if bit indexed
-                if self.is_bit_indexed and sibling.is_bit_indexed and (self_start == sib_start):
-                    continue 
-
-                raise ValidationError({
-                    "address": f"Memory overlap with tag '{sibling}' "
-                    f"Range [{self_start}-{self_end}] conflicts with [{sib_start}-{sib_end}]."
-                })
+        other = Tag.find_overlaps([self])[0]
+        if other:
+            raise self.get_overlap_error(other)
     
     def __str__(self):
         bit = f":{self.bit_index}" if self.bit_index is not None else ""
@@ -199,6 +295,20 @@ class Tag(models.Model):
         return f"{self.alias} [{location}]"
 
 
+class _AddressRange:
+    """ The registers a tag reads, for overlap checks """
+
+    __slots__ = ("tag", "index", "group", "start", "end", "bit_indexed")
+
+    def __init__(self, tag: Tag, index: int | None = None):
+        self.tag = tag
+        self.index = index # Position in the checked batch, None for saved tags
+        self.group = (tag.device_id, tag.channel, tag.unit_id)
+        self.start = tag.address
+        self.end = tag.address + tag.get_read_count()
+        self.bit_indexed = tag.is_bit_indexed
+
+
 class TagHistoryEntry(models.Model):
     """ A log entry for a tag, used for querying value history """
 
@@ -238,6 +348,17 @@ class AlarmConfig(models.Model):
         EQUALS = "equals", "Equals"
         GREATER_THAN  = "greater_than", "Greater Than"
         LESS_THAN = "less_than", "Less Than"
+        RATE_OF_CHANGE = "rate_of_change", "Rate of Change Above"
+        AVERAGE_ABOVE = "average_above", "Average Above"
+        AVERAGE_BELOW = "average_below", "Average Below"
+        STUCK = "stuck", "Stuck Value"
+    
+    WINDOWED_OPERATORS = [
+        OperatorChoices.RATE_OF_CHANGE,
+        OperatorChoices.AVERAGE_ABOVE,
+        OperatorChoices.AVERAGE_BELOW,
+        OperatorChoices.STUCK,
+    ]
     
     ALARM_PRIORITY = {
         ThreatLevelChoices.LOW: 1,
@@ -248,7 +369,10 @@ class AlarmConfig(models.Model):
     external_id = models.UUIDField(default=uuid.uuid4, unique=True)
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE, related_name="alarm_configs")
     trigger_value = models.JSONField(help_text="Value that triggers this alarm")
-    #trigger_sustain = models.DurationField(default=timedelta(seconds=3))
+    trigger_sustain = models.DurationField(default=timedelta(seconds=0), help_text="How long the trigger condition must hold before the alarm activates")
+    clear_sustain = models.DurationField(default=timedelta(seconds=0), help_text="How long the value must stay back to normal before the alarm resolves")
+    deadband = models.FloatField(default=0, help_text="How far back past the trigger value the tag must go before the alarm resolves")
+    window = models.DurationField(default=timedelta(seconds=60), help_text="Time span used by the rate of change, average and stuck value operators")
     operator = models.TextField(default="equals", choices=OperatorChoices.choices)
     owner = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     enabled = models.BooleanField(default=True)
@@ -262,66 +386,71 @@ class AlarmConfig(models.Model):
     notification_cooldown = models.DurationField(default=timedelta(minutes=1), help_text="Don't resend email for this long") #TODO should this be part of subscription instead?
     last_notified = models.DateTimeField(null=True, blank=True)
 
-    @classmethod
-    def update_alarms(cls, tags: list[Tag]):
-        """ Activate or deactivate alarms for the given tags """
+    OPERATORS = {
+        OperatorChoices.EQUALS: eq,
+        OperatorChoices.GREATER_THAN: gt,
+        OperatorChoices.LESS_THAN: lt,
+        OperatorChoices.RATE_OF_CHANGE: gt,
+        OperatorChoices.AVERAGE_ABOVE: gt,
+        OperatorChoices.AVERAGE_BELOW: lt,
+        OperatorChoices.STUCK: ge,
+    }
 
-        if not tags:
-            return
-        
-        # Active alarms for affected tags only
-        active_map = ActivatedAlarm.get_tag_map(tags)
+    @property
+    def is_windowed(self):
+        return self.operator in self.WINDOWED_OPERATORS
 
-        # Alarm configs for affected tags
-        configs_by_tag: dict[int, list[AlarmConfig]] = {}
-        for config in cls.objects.filter(enabled=True, tag__in=tags):
-            configs_by_tag.setdefault(config.tag_id, []).append(config)
+    def get_predicate(self) -> Callable[[Any], bool]:
+        """ Returns a function that tests a tag value against this config's trigger.
+        Windowed operators are tested against the window statistic instead (see `alarm_engine.py`) """
 
-        deactivate = []
-        activate = []
+        compare = self.OPERATORS.get(self.operator)
+        trigger_value = self.trigger_value
 
-        for tag in tags:
-            configs = configs_by_tag.get(tag.id, [])
-            if not configs:
-                continue
-            
-            triggered = [
-                c for c in configs
-                if c.is_activation(tag.current_value)
-            ]
+        # Compares the seconds since the value last changed
+        if self.operator == self.OperatorChoices.STUCK:
+            trigger_value = self.window.total_seconds()
 
-            winning = max(triggered, key=lambda c: cls.ALARM_PRIORITY[c.threat_level], default=None)
-            current: ActivatedAlarm = active_map.get(tag.id)
+        if compare is None:
+            return lambda value: False
 
-            if current and (not winning or current.config_id != winning.id):
-                # Deactivate current alarm for this tag
-                current.is_active = False
-                current.resolved_at = timezone.now()
-                deactivate.append(current)
-                logger.info(f"Alarm Deactivated: {current.config}")
+        def predicate(value):
+            try:
+                return compare(value, trigger_value)
+            except TypeError:
+                return False
 
-            if winning and (not current or current.config_id != winning.id):
-                # Activate the alarm
-                alarm = ActivatedAlarm(config=winning, is_active=True)
-                activate.append(alarm)
-                logger.info(f"Alarm Activated: {winning}")
+        return predicate
 
-        ActivatedAlarm.objects.bulk_update(deactivate, ["is_active", "resolved_at"])
-        ActivatedAlarm.objects.bulk_create(activate)
+    def get_clear_predicate(self) -> Callable[[Any], bool]:
+        """ Returns a function that tests if a tag value is back to normal, allowing for the deadband """
+
+        activation = self.get_predicate()
+        default = lambda value: not activation(value)
+
+        if not self.deadband or self.operator == self.OperatorChoices.STUCK:
+            return default
 
-    def is_activation(self, value):
         try:
-            match self.operator:
-                case self.OperatorChoices.EQUALS:
-                    return (value == self.trigger_value)
-                case self.OperatorChoices.GREATER_THAN:
-                    return (value > self.trigger_value)
-                case self.OperatorChoices.LESS_THAN:
-                    return (value < self.trigger_value)
-                case _:
-                    return False
+            if self.OPERATORS.get(self.operator) is gt:
+                compare, threshold = le, self.trigger_value - self.deadband
+            elif self.OPERATORS.get(self.operator) is lt:
+                compare, threshold = ge, self.trigger_value + self.deadband
+            else:
+                return default
         except TypeError:
-            return False
+            return default
+
+        def predicate(value):
+            try:
+                return compare(value, threshold)
+            except TypeError:
+                return True
+
+        return predicate
+
+    def is_activation(self, value):
+        return self.get_predicate()(value)
 
     class Meta: #TODO shouldn't we prevent multiple alarms for the same value?
         unique_together = ("alias", "tag")
@@ -330,9 +459,14 @@ class AlarmConfig(models.Model):
         signs = { 
             self.OperatorChoices.EQUALS : "==", 
             self.OperatorChoices.GREATER_THAN : ">", 
-            self.OperatorChoices.LESS_THAN : "<" 
+            self.OperatorChoices.LESS_THAN : "<",
+            self.OperatorChoices.RATE_OF_CHANGE : "rate >",
+            self.OperatorChoices.AVERAGE_ABOVE : "average >",
+            self.OperatorChoices.AVERAGE_BELOW : "average <",
+            self.OperatorChoices.STUCK : "stuck for",
         }
-        return f"{self.tag.alias} {signs.get(self.operator)} {self.trigger_value} -> {self.message}"
+        trigger = f"{self.window.total_seconds():g}s" if self.operator == self.OperatorChoices.STUCK else self.trigger_value
+        return f"{self.tag.alias} {signs.get(self.operator)} {trigger} -> {self.message}"
     
     #TODO order by threat level?
     
@@ -353,7 +487,13 @@ class ActivatedAlarm(models.Model):
     class Meta:
         unique_together = ('config', 'timestamp')
         ordering = ["-timestamp"]
-        indexes = [ models.Index(fields=["config", "-timestamp"]) ]
+        indexes = [
+            models.Index(fields=["config", "-timestamp"]),
+            # Alarm list filters, in its keyset pagination order
+            models.Index(fields=["-timestamp"]),
+            models.Index(fields=["is_active", "acknowledged", "-timestamp"]),
+            models.Index(fields=["acknowledged", "-timestamp"]),
+        ]
 
     @classmethod
     def get_tag_map(cls: Self, tags: list[Tag]) -> dict[int, Self]:
@@ -364,9 +504,6 @@ class ActivatedAlarm(models.Model):
                 .select_related("config")
         }
 
-    def should_notify(self):
-        return (self.config.last_notified is None) or (timezone.now() - self.config.last_notified > self.config.notification_cooldown)
-
     def __str__(self):
         return f"ALARM: {self.config.tag.alias} - {self.config.message} (Level {self.config.threat_level})"
     
@@ -393,6 +530,7 @@ class Dashboard(models.Model):
     description = models.TextField(blank=True)
     preview_image = models.ImageField(upload_to='dashboard_previews/', null=True, blank=True)
     column_count = models.PositiveSmallIntegerField(default=20) #TODO use small integer field more often?
+    version = models.PositiveIntegerField(default=0, help_text="Incremented on every save, so editors can detect concurrent changes")
     #external_id = models.UUIDField(default=uuid.uuid4, unique=True)
     #TODO permitted users?
     #created_at = models.DateTimeField(auto_now_add=True)
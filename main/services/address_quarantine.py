@@ -0,0 +1,114 @@
+import time
+import logging
+from dataclasses import dataclass, field
+from django.conf import settings
+from ..models import Device, Tag
+from .metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QuarantinedRange:
+    """ Addresses a device rejected, left out of reads until `retry_at` """
+
+    unit_id: int
+    channel: str
+    start: int
+    end: int # Exclusive
+    tags: list[str] # Aliases of the tags that were in the range, for logging
+    failures: int = 1
+    retry_at: float = 0.0 # time.monotonic()
+    tag_ids: set[int] = field(default_factory=set)
+
+    def overlaps(self, start: int, end: int) -> bool:
+        return self.start < end and start < self.end
+
+    def __str__(self):
+        tags = f" ({', '.join(self.tags)})" if self.tags else ""
+        return f"unit {self.unit_id} {self.channel} {self.start}-{self.end - 1}{tags}"
+
+
+class AddressQuarantine:
+    """ Address ranges each device answered with an exception, so the rest of its tags can still be read
+
+    A range stays quarantined for `POLL_QUARANTINE_BACKOFF` seconds, doubling up to
+    `POLL_QUARANTINE_MAX_BACKOFF` each time it fails again. Once the backoff runs out, the range is
+    read with the others again. If that read succeeds it's released, otherwise the block is bisected
+    down to it again. Ranges a tag was in or next to are dropped when the tag is edited or deleted
+    (see `signals.py`), so they're read again as the tags now are.
+    """
+
+    def __init__(self):
+        self.ranges: dict[int, dict[tuple[int, str, int, int], QuarantinedRange]] = {} # Device id -> key -> range
+        self.aliases: dict[int, str] = {} # Device id -> alias, for logs and metrics
+
+    def clear(self):
+        self.ranges.clear()
+        self.aliases.clear()
+
+    def add(self, device: Device, unit_id: int, channel: str, start: int, end: int, tags: list[Tag]):
+        key = (unit_id, channel, start, end)
+        ranges = self.ranges.setdefault(device.id, {})
+        self.aliases[device.id] = device.alias
+
+        quarantined = ranges.get(key)
+        if quarantined is None:
+            quarantined = ranges[key] = QuarantinedRange(unit_id, channel, start, end, [tag.alias for tag in tags], failures=0, tag_ids={tag.id for tag in tags})
+        quarantined.failures += 1
+
+        backoff = min(settings.POLL_QUARANTINE_BACKOFF * 2 ** (min(quarantined.failures, 32) - 1), settings.POLL_QUARANTINE_MAX_BACKOFF)
+        quarantined.retry_at = time.monotonic() + backoff
+        logger.warning(f"{device.alias} rejected {quarantined}. Leaving it out of reads for {backoff:.0f}s.")
+
+    def release(self, device: Device, unit_id: int, channel: str, start: int, end: int):
+        """ A read of these addresses succeeded, so any ranges within them are healthy again """
+
+        ranges = self.ranges.get(device.id)
+        if not ranges:
+            return
+
+        for key, quarantined in list(ranges.items()):
+            if quarantined.unit_id == unit_id and quarantined.channel == channel and start <= quarantined.start and quarantined.end <= end:
+                del ranges[key]
+                logger.info(f"{device.alias} read {quarantined} again, released it from quarantine")
+
+    def active(self, device: Device) -> dict[tuple[int, str], list[tuple[int, int]]]:
+        """ The ranges to keep out of this cycle's reads, by unit and channel """
+
+        now = time.monotonic()
+        holes: dict[tuple[int, str], list[tuple[int, int]]] = {}
+        for quarantined in list(self.ranges.get(device.id, {}).values()): # Tag signals may drop ranges from another thread
+            if quarantined.retry_at > now:
+                holes.setdefault((quarantined.unit_id, quarantined.channel), []).append((quarantined.start, quarantined.end))
+        return holes
+
+    def forget_tag(self, tag: Tag):
+        """ Drop the ranges that held the tag, or that its addresses are in or next to """
+
+        start, end = tag.address, tag.address + tag.get_read_count()
+        for device_id, ranges in list(self.ranges.items()):
+            for key, quarantined in list(ranges.items()):
+                touches = (
+                    device_id == tag.device_id and quarantined.unit_id == tag.unit_id and quarantined.channel == tag.channel
+                    and quarantined.start <= end and start <= quarantined.end
+                )
+                if touches or tag.id in quarantined.tag_ids:
+                    del ranges[key]
+                    logger.info(f"{tag.alias} changed, reading {quarantined} of {self.aliases[device_id]} again")
+
+    def forget_device(self, device_id: int):
+        self.ranges.pop(device_id, None)
+        self.aliases.pop(device_id, None)
+
+    def counts(self) -> list[tuple[tuple[str], int]]:
+        return [((self.aliases[device_id],), len(ranges)) for device_id, ranges in list(self.ranges.items())]
+
+
+registry.gauge(
+    "modbus_tiles_quarantined_ranges", "Address ranges left out of reads after the device rejected them", ["device"],
+    function=lambda: address_quarantine.counts(),
+)
+
+address_quarantine = AddressQuarantine()
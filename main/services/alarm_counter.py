@@ -0,0 +1,152 @@
+from collections import Counter
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Q
+from ..models import ActivatedAlarm
+
+
+class AlarmCounter:
+    """ Active and unacknowledged alarm counts by threat level, kept up to date as alarms change
+
+    Only alarms that are active or unacknowledged are tracked, so applying a change is O(1)
+    and reading the counts never touches the database after the first load.
+    """
+
+    def __init__(self):
+        self.alarms: dict[int, tuple[str, bool, bool]] = {} # Alarm id -> (threat level, active, unacknowledged)
+        self.active: Counter[str] = Counter()
+        self.unacknowledged: Counter[str] = Counter()
+        self.badge = 0 # Active and unacknowledged
+        self.loaded = False
+        self.sent_counts: dict | None = None
+
+    def invalidate(self):
+        """ Recount from the database on next access """
+        self.loaded = False
+
+    def load(self):
+        self.alarms = {}
+        self.active = Counter()
+        self.unacknowledged = Counter()
+        self.badge = 0
+
+        rows = (ActivatedAlarm.objects
+            .filter(Q(is_active=True) | Q(acknowledged=False))
+            .values_list("id", "config__threat_level", "is_active", "acknowledged"))
+
+        for alarm_id, level, is_active, acknowledged in rows:
+            self._set(alarm_id, (level, is_active, not acknowledged))
+
+        self.loaded = True
+
+    def apply(self, alarms: list[ActivatedAlarm]) -> bool:
+        """ Update the counts with the full saved state of alarms. Returns True if anything changed """
+
+        if not self.loaded:
+            self.load()
+            return True
+
+        changed = False
+        for alarm in alarms:
+            changed |= self._set(alarm.id, (alarm.config.threat_level, alarm.is_active, not alarm.acknowledged))
+        return changed
+
+    def update(self, activated: list[ActivatedAlarm], resolved: list[ActivatedAlarm]) -> bool:
+        """ Count alarm engine changes
+
+        The engine's copies of resolved alarms may have been acknowledged since they were loaded,
+        so only their active state is taken.
+        """
+
+        if not self.loaded:
+            self.load()
+            return True
+
+        changed = self.apply(activated)
+        for alarm in resolved:
+            state = self.alarms.get(alarm.id)
+            if state is not None:
+                changed |= self._set(alarm.id, (state[0], False, state[2]))
+        return changed
+
+    def acknowledge(self, alarm_ids: list[int]) -> bool:
+        """ Count alarms acknowledged by a queryset update. Returns True if anything changed """
+
+        if not self.loaded:
+            return False
+
+        changed = False
+        for alarm_id in alarm_ids:
+            state = self.alarms.get(alarm_id)
+            if state is not None:
+                changed |= self._set(alarm_id, (state[0], state[1], False))
+        return changed
+
+    def discard(self, alarm_id: int) -> bool:
+        """ Stop counting a deleted alarm. Returns True if it was counted """
+
+        if not self.loaded:
+            return False
+        return self._set(alarm_id, None)
+
+    def _set(self, alarm_id: int, state: tuple[str, bool, bool] | None) -> bool:
+        if state is not None and not (state[1] or state[2]):
+            state = None # Resolved and acknowledged alarms aren't counted
+
+        old = self.alarms.get(alarm_id)
+        if old == state:
+            return False
+
+        if old is not None:
+            self._count(old, -1)
+            del self.alarms[alarm_id]
+        if state is not None:
+            self._count(state, 1)
+            self.alarms[alarm_id] = state
+
+        return True
+
+    def _count(self, state: tuple[str, bool, bool], delta: int):
+        level, is_active, unacknowledged = state
+        if is_active:
+            self.active[level] += delta
+        if unacknowledged:
+            self.unacknowledged[level] += delta
+        if is_active and unacknowledged:
+            self.badge += delta
+
+    def snapshot(self) -> dict:
+        if not self.loaded:
+            self.load()
+
+        return {
+            "count": self.badge,
+            "active": {level: n for level, n in self.active.items() if n},
+            "unacknowledged": {level: n for level, n in self.unacknowledged.items() if n},
+        }
+
+    def pending_message(self) -> dict | None:
+        """ The channel layer event for dashboard consumers, or None if the counts were already sent """
+
+        counts = self.snapshot()
+        if counts == self.sent_counts:
+            return None
+
+        self.sent_counts = counts
+        return {"type": "alarm_counts", "counts": counts}
+
+    def broadcast(self):
+        """ Push the current counts from synchronous code once the transaction commits
+
+        Changes within one transaction, like a cascade delete, end up as a single update.
+        """
+        transaction.on_commit(self._send)
+
+    def _send(self):
+        message = self.pending_message()
+        if message:
+            async_to_sync(get_channel_layer().group_send)("poller_broadcast", message)
+
+
+alarm_counter = AlarmCounter()
@@ -0,0 +1,278 @@
+import time
+import logging
+from typing import Any, Callable
+from dataclasses import dataclass, field
+from collections import defaultdict, deque
+from django.utils import timezone
+from ..models import Tag, AlarmConfig, ActivatedAlarm
+
+
+logger = logging.getLogger(__name__)
+
+
+class RollingWindow:
+    """ Time-bounded buffer of numeric samples with a running sum, so window statistics are O(1) per sample
+
+    Samples closer together than `duration / max_buckets` are merged into one bucket, so a long window
+    still spans its whole duration in bounded memory instead of dropping its oldest samples.
+    """
+
+    def __init__(self, duration: float, max_buckets=4096):
+        self.duration = duration
+        self.resolution = duration / max_buckets
+        self.buckets: deque[list[float]] = deque() # [start time, first value, sum, count]
+        self.total = 0.0
+        self.count = 0
+        self.last_value = None
+        self.changed_at: float | None = None
+        self.last_sample: tuple[float, float] | None = None
+
+    def add(self, now: float, value):
+        if self.changed_at is None or value != self.last_value:
+            self.last_value = value
+            self.changed_at = now
+
+        if isinstance(value, (int, float)):
+            if self.buckets and now - self.buckets[-1][0] < self.resolution:
+                bucket = self.buckets[-1]
+                bucket[2] += value
+                bucket[3] += 1
+            else:
+                self.buckets.append([now, value, value, 1])
+            self.total += value
+            self.count += 1
+            self.last_sample = (now, value)
+
+        # Drop samples older than the window
+        cutoff = now - self.duration
+        while self.buckets and self.buckets[0][0] < cutoff:
+            _, _, total, count = self.buckets.popleft()
+            self.total -= total
+            self.count -= count
+
+        if not self.buckets:
+            self.total = 0.0 # Clear accumulated float error
+            self.last_sample = None
+
+    @property
+    def average(self) -> float | None:
+        return self.total / self.count if self.count else None
+
+    @property
+    def rate(self) -> float:
+        """ Change per second between the oldest and newest samples """
+
+        if self.count < 2:
+            return 0.0
+
+        start, first = self.buckets[0][0], self.buckets[0][1]
+        end, last = self.last_sample
+        return (last - first) / (end - start) if end > start else 0.0
+
+    def unchanged_for(self, now: float) -> float:
+        return now - self.changed_at if self.changed_at is not None else 0.0
+
+
+# The window statistic that each windowed operator compares with the trigger
+WINDOW_MEASURES: dict[str, Callable[[RollingWindow, float], Any]] = {
+    AlarmConfig.OperatorChoices.RATE_OF_CHANGE: lambda window, now: abs(window.rate),
+    AlarmConfig.OperatorChoices.AVERAGE_ABOVE: lambda window, now: window.average,
+    AlarmConfig.OperatorChoices.AVERAGE_BELOW: lambda window, now: window.average,
+    AlarmConfig.OperatorChoices.STUCK: lambda window, now: window.unchanged_for(now),
+}
+
+
+@dataclass
+class CompiledAlarm:
+    config: AlarmConfig
+    external_id: str
+    priority: int
+    predicate: Callable[[Any], bool]
+    clear_predicate: Callable[[Any], bool]
+    trigger_sustain: float
+    clear_sustain: float
+    window: RollingWindow | None = None
+    in_alarm: bool = False
+    pending_since: float | None = None
+
+    def evaluate(self, value, now: float) -> bool:
+        """ Update the debounced alarm state with a new value. Returns True while a sustain timer is running """
+
+        if self.window:
+            self.window.add(now, value)
+            value = WINDOW_MEASURES[self.config.operator](self.window, now)
+
+        # Once in alarm, the value has to clear the deadband to count as normal again
+        condition = not self.clear_predicate(value) if self.in_alarm else self.predicate(value)
+
+        if condition == self.in_alarm:
+            self.pending_since = None
+            return False
+
+        if self.pending_since is None:
+            self.pending_since = now
+
+        sustain = self.trigger_sustain if condition else self.clear_sustain
+        if now - self.pending_since >= sustain:
+            self.in_alarm = condition
+            self.pending_since = None
+            return False
+
+        return True
+
+
+@dataclass
+class AlarmChanges:
+    activated: list[ActivatedAlarm] = field(default_factory=list)
+    deactivated: list[ActivatedAlarm] = field(default_factory=list)
+    tags: list[Tag] = field(default_factory=list) # Tags whose active alarm changed
+
+
+class AlarmEngine:
+    """ Evaluates alarm configs for changed tags from memory
+
+    Enabled configs are cached by tag id along with the currently active alarm of each tag,
+    so a poll cycle only touches the database to save activations and deactivations.
+    The cache is rebuilt on the next update after any config changes (see `signals.py`).
+
+    Tags with a running sustain timer are re-evaluated every update until the timer
+    resolves, even if their value doesn't change again. Tags with windowed operators
+    are sampled on every read, changed or not.
+    """
+
+    def __init__(self):
+        self.configs_by_tag: dict[int, list[CompiledAlarm]] = {}
+        self.active: dict[int, ActivatedAlarm] = {}
+        self.alarm_ids: dict[int, str] = {} # Tag id -> active alarm config external id
+        self.pending: dict[int, Tag] = {}
+        self.windowed_tags: set[int] = set()
+        self.version = 0
+        self.loaded_version = -1
+
+    @property
+    def is_stale(self):
+        return self.loaded_version != self.version
+
+    def invalidate(self):
+        """ Reload configs and active alarms before the next update """
+        self.version += 1
+
+    def load(self):
+        version = self.version
+
+        active = {
+            a.config.tag_id: a
+            for a in ActivatedAlarm.objects.filter(is_active=True).select_related("config__tag")
+        }
+        active_config_ids = {a.config_id for a in active.values()}
+
+        # Keep debounce state of configs that still exist
+        previous = {a.config.id: a for alarms in self.configs_by_tag.values() for a in alarms}
+
+        configs_by_tag: dict[int, list[CompiledAlarm]] = defaultdict(list)
+        for config in AlarmConfig.objects.filter(enabled=True).select_related("tag"):
+            alarm = CompiledAlarm(
+                config=config,
+                external_id=str(config.external_id),
+                priority=AlarmConfig.ALARM_PRIORITY[config.threat_level],
+                predicate=config.get_predicate(),
+                clear_predicate=config.get_clear_predicate(),
+                trigger_sustain=config.trigger_sustain.total_seconds(),
+                clear_sustain=config.clear_sustain.total_seconds(),
+                in_alarm=config.id in active_config_ids,
+            )
+            if config.is_windowed:
+                alarm.window = RollingWindow(config.window.total_seconds())
+
+            if config.id in previous:
+                old = previous[config.id]
+                alarm.in_alarm = old.in_alarm
+                alarm.pending_since = old.pending_since
+                if alarm.window and old.window and alarm.window.duration == old.window.duration:
+                    alarm.window = old.window
+
+            configs_by_tag[config.tag_id].append(alarm)
+
+        self.configs_by_tag = dict(configs_by_tag)
+        self.windowed_tags = {
+            tag_id for tag_id, alarms in self.configs_by_tag.items()
+            if any(alarm.window for alarm in alarms)
+        }
+        self.active = active
+        self.alarm_ids = {tag_id: str(a.config.external_id) for tag_id, a in active.items()}
+        self.loaded_version = version
+
+    def update(self, tags: list[Tag], read_tags: list[Tag] = ()) -> AlarmChanges:
+        """ Activate or deactivate alarms for the given changed tags. `read_tags` feeds the windowed operators """
+
+        if self.is_stale:
+            self.load()
+
+        changes = AlarmChanges()
+        activate = changes.activated
+        deactivate = changes.deactivated
+        now = timezone.now()
+        clock = time.monotonic()
+
+        # Changed tags, plus unchanged ones waiting on a sustain timer or sampled by a window
+        evaluate = self.pending
+        self.pending = {}
+        if self.windowed_tags:
+            for tag in read_tags:
+                if tag.id in self.windowed_tags:
+                    evaluate[tag.id] = tag
+        for tag in tags:
+            evaluate[tag.id] = tag
+
+        for tag in evaluate.values():
+            alarms = self.configs_by_tag.get(tag.id)
+            if not alarms:
+                continue
+
+            # Highest priority config in alarm wins
+            value = tag.current_value
+            winning: CompiledAlarm | None = None
+            waiting = False
+            for alarm in alarms:
+                waiting |= alarm.evaluate(value, clock)
+                if alarm.in_alarm and (winning is None or alarm.priority > winning.priority):
+                    winning = alarm
+
+            if waiting:
+                self.pending[tag.id] = tag
+
+            current = self.active.get(tag.id)
+            if (current.config_id if current else None) != (winning.config.id if winning else None):
+                changes.tags.append(tag)
+
+            if current and (not winning or current.config_id != winning.config.id):
+                # Deactivate current alarm for this tag
+                current.is_active = False
+                current.resolved_at = now
+                deactivate.append(current)
+                del self.active[tag.id]
+                del self.alarm_ids[tag.id]
+                logger.info(f"Alarm Deactivated: {current.config}")
+
+            if winning and (not current or current.config_id != winning.config.id):
+                # Activate the alarm
+                alarm = ActivatedAlarm(config=winning.config, is_active=True)
+                activate.append(alarm)
+                self.active[tag.id] = alarm
+                self.alarm_ids[tag.id] = winning.external_id
+                logger.info(f"Alarm Activated: {winning.config}")
+
+        try:
+            if deactivate:
+                ActivatedAlarm.objects.bulk_update(deactivate, ["is_active", "resolved_at"])
+            if activate:
+                ActivatedAlarm.objects.bulk_create(activate)
+        except Exception:
+            # Memory no longer matches the database
+            self.invalidate()
+            raise
+
+        return changes
+
+
+alarm_engine = AlarmEngine()
@@ -0,0 +1,33 @@
+import uuid
+from django.db import transaction
+
+
+class ConfigVersion:
+    """ Generation counter for the plant and dashboard configuration, used to validate cached responses
+
+    Bumped whenever devices, tags, alarm configs, dashboards or widgets are written (see `signals.py`,
+    and the bulk writers which skip the save signals). The boot token keeps ETags from a previous run
+    of the server from matching, since the counter starts over on restart. Like the alarm engine cache,
+    this relies on every write going through the one server process.
+    """
+
+    def __init__(self):
+        self.boot = uuid.uuid4().hex[:8]
+        self.generation = 0
+
+    def changed(self):
+        """ Bump the generation once the current transaction commits
+
+        Bumping before the commit would let a concurrent read tag the old rows with the new generation.
+        """
+        transaction.on_commit(self.bump)
+
+    def bump(self):
+        self.generation += 1
+
+    def etag(self, *parts) -> str:
+        """ A weak ETag for a response built from the current configuration, and anything else in `parts` """
+        return 'W/"' + "-".join(str(p) for p in (self.boot, self.generation, *parts)) + '"'
+
+
+config_version = ConfigVersion()
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from django.conf import settings
+from django.utils import timezone
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class Span:
+    name: str
+    start: float # time.perf_counter() seconds
+    end: float
+    device: str | None = None
+    args: dict = field(default_factory=dict)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+@dataclass
+class CycleTrace:
+    """ Timed phases of one poll cycle """
+
+    number: int
+    started_at: datetime
+    start: float
+    end: float | None = None
+    spans: list[Span] = field(default_factory=list)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def add(self, name: str, start: float, end: float, device: str = None, **args):
+        """ Record a phase that was already timed """
+        self.spans.append(Span(name, start, end, device, args))
+
+    @contextmanager
+    def span(self, name: str, device: str = None, **args):
+        """ Time the phase in the with block """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append(Span(name, start, time.perf_counter(), device, args))
+
+    def phase_totals(self) -> dict[str, float]:
+        """ Seconds spent in each phase, summed over devices and blocks """
+
+        totals = defaultdict(float)
+        for span in self.spans:
+            totals[span.name] += span.duration
+        return dict(totals)
+
+    def summary(self) -> dict:
+        return {
+            "cycle": self.number,
+            "started_at": self.started_at.isoformat(),
+            "duration": self.duration,
+            "phases": self.phase_totals(),
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            **self.summary(),
+            "spans": [
+                {"name": s.name, "device": s.device, "start": s.start - self.start, "duration": s.duration, **s.args}
+                for s in self.spans
+            ],
+        }
+
+
+class CycleTracer:
+    """ Keeps the traces of recent poll cycles, and of slow ones for longer
+
+    The last `keep` cycles are held in a ring buffer. Cycles longer than the slow threshold,
+    the poll interval unless `POLL_TRACE_SLOW_SECONDS` is set, are also kept in a separate
+    buffer and counted for `report()`, which the poller logs periodically with the phase breakdown
+    of the slowest. If `POLL_TRACE_DIR` is set, each slow cycle is also written there in Chrome
+    trace format, from a worker thread.
+    """
+
+    def __init__(self, keep=100, keep_slow=50):
+        self.recent: deque[CycleTrace] = deque(maxlen=keep)
+        self.slow: deque[CycleTrace] = deque(maxlen=keep_slow)
+        self.count = 0
+
+        # Since the last report
+        self.reported_count = 0
+        self.slow_count = 0
+        self.slowest: CycleTrace | None = None
+
+    def start(self) -> CycleTrace:
+        self.count += 1
+        trace = CycleTrace(self.count, timezone.now(), time.perf_counter())
+        self.recent.append(trace)
+        return trace
+
+    async def finish(self, trace: CycleTrace, poll_interval: float):
+        trace.end = time.perf_counter()
+
+        threshold = settings.POLL_TRACE_SLOW_SECONDS or poll_interval
+        if trace.duration <= threshold:
+            return
+
+        self.slow.append(trace)
+        self.slow_count += 1
+        if self.slowest is None or trace.duration > self.slowest.duration:
+            self.slowest = trace
+        logger.debug(f"Slow poll cycle {trace.number}: {trace.duration * 1000:.1f}ms")
+
+        directory = settings.POLL_TRACE_DIR
+        if directory:
+            try:
+                await asyncio.to_thread(self.write, trace, directory)
+            except OSError as e:
+                logger.error(f"Couldn't write poll cycle trace: {e}")
+
+    @staticmethod
+    def write(trace: CycleTrace, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"cycle-{trace.started_at:%Y%m%d-%H%M%S}-{trace.number}.json")
+        with open(path, "w") as file:
+            json.dump(chrome_trace([trace]), file)
+
+    def report(self) -> str | None:
+        """ Describe the slow cycles since the last report, if there were any, and start counting again """
+
+        cycles = self.count - self.reported_count
+        slow_count, slowest = self.slow_count, self.slowest
+        self.reported_count = self.count
+        self.slow_count = 0
+        self.slowest = None
+
+        if not slow_count:
+            return None
+        phases = ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in sorted(slowest.phase_totals().items(), key=lambda p: -p[1]))
+        return (
+            f"{slow_count} of {cycles} poll cycles were slow, "
+            f"the slowest was cycle {slowest.number} at {slowest.duration * 1000:.1f}ms ({phases})"
+        )
+
+    @contextmanager
+    def keeping_all(self):
+        """ Keep every cycle started in the block rather than the last few, for benchmarks """
+
+        recent = self.recent
+        self.recent = deque()
+        try:
+            yield self.recent
+        finally:
+            self.recent = deque(self.recent, maxlen=recent.maxlen)
+
+    def get(self, number: int) -> CycleTrace | None:
+        for trace in (*self.recent, *self.slow):
+            if trace.number == number:
+                return trace
+        return None
+
+
+def chrome_trace(traces: list[CycleTrace]) -> dict:
+    """ Traces in the Chrome trace event format, for chrome://tracing or Perfetto. Each device gets its own row """
+
+    events = []
+    threads = {None: 0}
+
+    for trace in traces:
+        origin = trace.started_at.timestamp() - trace.start # Maps perf_counter to wall time
+
+        events.append({
+            "name": f"cycle {trace.number}", "ph": "X", "pid": 1, "tid": 0,
+            "ts": (trace.start + origin) * 1e6, "dur": trace.duration * 1e6,
+        })
+        for span in trace.spans:
+            tid = threads.setdefault(span.device, len(threads))
+            events.append({
+                "name": span.name, "ph": "X", "pid": 1, "tid": tid,
+                "ts": (span.start + origin) * 1e6, "dur": span.duration * 1e6,
+                "args": span.args,
+            })
+
+    for device, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": device or "poller"}})
+
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+cycle_tracer = CycleTracer()
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from typing import Callable
+from django.conf import settings
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from pymodbus.client.base import ModbusBaseClient
+from pymodbus.constants import ExcCodes
+from ..models import Device, Tag
+
+
+logger = logging.getLogger(__name__)
+
+
+class CapabilityProbe:
+    """ Finds what a device can handle by sending it harmless requests
+
+    Reads are made at the device's lowest configured register. Only an illegal data value response
+    means a read is too long: other errors, like an illegal address past the end of a sparse register
+    map, or no response at all, say nothing about the limit, so they keep the current setting. Mask write support is
+    tested with a mask that leaves the register unchanged. Concurrency is tested by reading on up to
+    `POLL_PROBE_MAX_CONCURRENCY` connections at once, which also finds devices that refuse extra
+    connections. Anything that can't be tested, for lack of a suitable tag, keeps its current setting.
+    """
+
+    def __init__(self, device: Device, client: ModbusBaseClient, create_client: Callable[[Device], ModbusBaseClient]):
+        self.device = device
+        self.client = client
+        self.create_client = create_client
+
+        registers = [
+            tag for tag in device.tags.all()
+            if tag.channel in [Tag.ChannelChoices.HOLDING_REGISTER, Tag.ChannelChoices.INPUT_REGISTER]
+        ]
+        self.register = min(registers, key=lambda tag: tag.address, default=None)
+        self.holding_register = min(
+            (tag for tag in registers if tag.channel == Tag.ChannelChoices.HOLDING_REGISTER),
+            key=lambda tag: tag.address, default=None,
+        )
+
+    async def run(self):
+        if self.register is not None:
+            self.device.max_read_registers = await self.max_read()
+            self.device.max_concurrent_requests = await self.concurrency()
+        if self.holding_register is not None:
+            self.device.supports_mask_write = await self.mask_write()
+
+        self.device.probe_capabilities = False
+        self.device.capabilities_probed_at = timezone.now()
+        await database_sync_to_async(self.device.save)(update_fields=[
+            "max_read_registers", "supports_mask_write", "max_concurrent_requests", "probe_capabilities", "capabilities_probed_at",
+        ])
+
+        logger.info(
+            f"Probed {self.device.alias}: reads up to {self.device.max_read_registers} registers, "
+            f"{self.device.max_concurrent_requests} at a time, mask write {'supported' if self.device.supports_mask_write else 'unsupported'}"
+        )
+
+    async def read_code(self, client: ModbusBaseClient, count: int) -> int | None:
+        """ Returns 0 if the read succeeds, the exception code if the device rejects it, or None without a response """
+
+        read_func = client.read_holding_registers if self.register.channel == Tag.ChannelChoices.HOLDING_REGISTER else client.read_input_registers
+        try:
+            rr = await read_func(self.register.address, count=count, device_id=self.register.unit_id)
+        except Exception:
+            return None
+        if rr.isError():
+            return getattr(rr, "exception_code", None)
+        return 0
+
+    async def read(self, client: ModbusBaseClient, count: int) -> bool:
+        return await self.read_code(client, count) == 0
+
+    async def max_read(self) -> int:
+        """ Binary search for the largest read that succeeds, stopping at any failure other than a read that is too long """
+
+        low, high = 1, min(125, 65536 - self.register.address)
+        if not await self.read(self.client, low):
+            return self.device.max_read_registers
+
+        while low < high:
+            count = (low + high + 1) // 2
+            code = await self.read_code(self.client, count)
+            if code == 0:
+                low = count
+            elif code == ExcCodes.ILLEGAL_VALUE:
+                high = count - 1
+            else:
+                return self.device.max_read_registers
+        return low
+
+    async def concurrency(self) -> int:
+        extra: list[ModbusBaseClient] = []
+        try:
+            for _ in range(settings.POLL_PROBE_MAX_CONCURRENCY - 1):
+                conn = self.create_client(self.device)
+                if not await conn.connect():
+                    break
+                extra.append(conn)
+
+            results = await asyncio.gather(*(self.read(conn, 1) for conn in [self.client, *extra]))
+            return max(1, sum(results))
+
+        finally:
+            for conn in extra:
+                conn.close()
+
+    async def mask_write(self) -> bool:
+        """ AND with all ones and OR with zero, so the register keeps its value """
+
+        try:
+            rr = await self.client.mask_write_register(
+                address=self.holding_register.address, and_mask=0xFFFF, or_mask=0x0000, device_id=self.holding_register.unit_id,
+            )
+        except Exception:
+            return self.device.supports_mask_write
+        if rr.isError():
+            return getattr(rr, "exception_code", None) != ExcCodes.ILLEGAL_FUNCTION and self.device.supports_mask_write
+        return True
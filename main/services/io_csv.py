@@ -1,37 +1,156 @@
 import csv
+import json
 import uuid
+import logging
+from dataclasses import dataclass, field
+from django.core.exceptions import ValidationError
 from django.db import models, transaction
-from django.utils.dateparse import parse_duration
 from ..models import Tag, Device, AlarmConfig
+from .alarm_engine import alarm_engine
+from .alarm_counter import alarm_counter
+from .config_version import config_version
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RowError:
+    line: int
+    errors: dict[str, list[str]]
+
+    def __str__(self):
+        return f"Line {self.line}: " + "; ".join(f"{field}: {' '.join(messages)}" for field, messages in self.errors.items())
+
+
+@dataclass
+class ImportResult:
+    saved: int = 0
+    errors: list[RowError] = field(default_factory=list)
 
 
 class BaseCSVImporter:
+    """ Upserts model rows from a CSV file
+
+    Rows are read and written in chunks of `chunk_size`, so memory use doesn't grow with
+    the file. Each chunk is validated with the model field validators and saved with one
+    `bulk_create` that updates rows matching `lookup_fields`. Invalid rows are skipped
+    and reported in the result instead of aborting the import.
+    """
+
     model: models.Model = None
     fields = []
     required_fields = []
     lookup_fields = []
+    chunk_size = 2000
 
-    def __init__(self, file):
+    def __init__(self, file, chunk_size=None):
         self.file = file
         self.reader = csv.DictReader(self.file)
+        self.chunk_size = chunk_size or self.chunk_size
 
-        missing = set(self.required_fields) - set(self.reader.fieldnames)
+        missing = set(self.required_fields) - set(self.reader.fieldnames or [])
         if missing:
             raise ValueError(f"Missing required columns: {missing}")
 
+        self.columns = [f for f in self.fields if f in self.reader.fieldnames]
+
+        # Foreign keys are resolved by clean_row, and the remaining model fields are left at their defaults
+        self.exclude_validation = [
+            f.name for f in self.model._meta.fields
+            if f.is_relation or f.name not in self.columns
+        ]
+
+    def prepare_chunk(self, rows: list[dict]):
+        """ Override to fetch anything clean_row needs for a chunk of rows in one query """
+        pass
+
     def clean_row(self, row: dict):
-        """ Override for custom cleaning """
-        return {k: row[k] for k in self.fields if k in row}
+        """ Override for custom cleaning. Raise ValidationError to reject the row """
 
-    def save_row(self, cleaned_row: dict):
-        lookup = {f: cleaned_row[f] for f in self.lookup_fields}
-        return self.model.objects.update_or_create(**lookup, defaults=cleaned_row)
+        # Empty cells fall back to the field default
+        return {k: row[k] for k in self.columns if row.get(k) not in ("", None)}
+
+    def build(self, cleaned_row: dict) -> models.Model:
+        obj = self.model(**cleaned_row)
+
+        # Empty cells were dropped for the field default, which may not pass the form-level checks such as blank=False
+        defaulted = [f for f in self.columns if f not in cleaned_row and self.model._meta.get_field(f).has_default()]
+        obj.clean_fields(exclude=self.exclude_validation + defaulted)
+        return obj
+
+    def validate_chunk(self, objs: list[models.Model]) -> list[ValidationError | None]:
+        """ Override for checks that need the whole chunk at once. Returns an error or None per object """
+        return [None] * len(objs)
+
+    def save_chunk(self, objs: list[models.Model]):
+        update_fields = [f for f in self.columns if f not in self.lookup_fields]
+        self.model.objects.bulk_create(
+            objs,
+            update_conflicts=bool(update_fields),
+            ignore_conflicts=not update_fields,
+            unique_fields=self.lookup_fields,
+            update_fields=update_fields or None,
+        )
+
+    def run(self) -> ImportResult:
+        result = ImportResult()
 
-    def run(self):
         with transaction.atomic():
-            for row in self.reader:
-                cleaned = self.clean_row(row)
-                self.save_row(cleaned)
+            for chunk in self._read_chunks():
+                self.prepare_chunk([row for _, row in chunk])
+
+                # Later rows win if a chunk has the same lookup twice, and the earlier one is reported
+                built: dict[tuple, tuple[int, models.Model]] = {}
+                for line, row in chunk:
+                    try:
+                        obj = self.build(self.clean_row(row))
+                    except ValidationError as e:
+                        result.errors.append(RowError(line, _error_dict(e)))
+                        continue
+
+                    key = tuple(getattr(obj, f) for f in self.lookup_attnames)
+                    if key in built:
+                        lookup = ", ".join(self.lookup_fields)
+                        result.errors.append(RowError(built[key][0], {lookup: [f"Replaced by line {line}, which has the same {lookup}"]}))
+                    built[key] = (line, obj)
+
+                lines = [line for line, _ in built.values()]
+                objs = [obj for _, obj in built.values()]
+
+                valid = []
+                for line, obj, error in zip(lines, objs, self.validate_chunk(objs)):
+                    if error:
+                        result.errors.append(RowError(line, _error_dict(error)))
+                    else:
+                        valid.append(obj)
+
+                if valid:
+                    self.save_chunk(valid)
+                    result.saved += len(valid)
+
+        if result.saved:
+            config_version.changed() # Bulk writes skip the save signals
+        if result.errors:
+            logger.warning(f"{self.model.__name__} import skipped {len(result.errors)} invalid rows")
+            for error in result.errors:
+                logger.warning(f"  {error}")
+        logger.info(f"Imported {result.saved} {self.model.__name__} rows")
+        return result
+
+    @property
+    def lookup_attnames(self):
+        return [self.model._meta.get_field(f).attname for f in self.lookup_fields]
+
+    def _read_chunks(self):
+        chunk = []
+        for row in self.reader:
+            chunk.append((self.reader.line_num, row))
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     
 class DeviceImporter(BaseCSVImporter):
@@ -45,62 +164,150 @@ class TagImporter(BaseCSVImporter):
     model = Tag
     fields = ["device", "unit_id", "alias", "description", "channel", "data_type", "address", "bit_index", "is_active", "restricted_write", "history_interval", "history_retention", "external_id"]
     required_fields = ["device", "alias", "channel", "data_type", "address"]
-    lookup_fields = ["external_id"] #TODO?
+    lookup_fields = ["external_id"]
 
-    def clean_row(self, row: dict):
-        row["device"] = Device.objects.get(alias=row["device"]) #TODO just use alias as PK?
+    def __init__(self, file, chunk_size=None):
+        super().__init__(file, chunk_size)
+        self.devices: dict[str, int] = dict(Device.objects.values_list("alias", "id")) #TODO just use alias as PK?
+
+        # Without ids, tags are matched by their location instead
+        if "external_id" not in self.columns:
+            self.lookup_fields = ["device", "channel", "address", "unit_id", "bit_index"]
 
-        row["address"] = int(row["address"])
+    def validate_chunk(self, objs: list[Tag]) -> list[ValidationError | None]:
+        errors = []
+        for obj in objs:
+            try:
+                obj.clean_bit_index()
+                errors.append(None)
+            except ValidationError as e:
+                errors.append(e)
 
-        if "unit_id" in row:
-            row["unit_id"] = int(row["unit_id"])
+        # Rows are matched by id or location, so a tag doesn't overlap the saved row it replaces
+        if "external_id" in self.lookup_fields:
+            identity = None
+        else:
+            identity = lambda tag: (tag.device_id, tag.channel, tag.address, tag.unit_id, tag.bit_index)
 
-        if "bit_index" in row:
-            row["bit_index"] = int(row["bit_index"])
+        checked = [i for i, error in enumerate(errors) if error is None]
+        overlaps = Tag.find_overlaps([objs[i] for i in checked], identity)
 
-        if "history_interval" in row:
-            row["history_interval"] = parse_duration(row["history_interval"]) 
+        for i, other in zip(checked, overlaps):
+            if other:
+                errors[i] = objs[i].get_overlap_error(other)
+        return errors
+
+    def clean_row(self, row: dict):
+        cleaned = super().clean_row(row)
 
-        if "history_retention" in row:
-            row["history_retention"] = parse_duration(row["history_retention"]) 
+        device_id = self.devices.get(cleaned.pop("device"))
+        if device_id is None:
+            raise ValidationError({"device": f"Unknown device '{row['device']}'"})
+        cleaned["device_id"] = device_id
 
-        return super().clean_row(row)
+        return cleaned
     
 
 class AlarmConfigImporter(BaseCSVImporter):
     model = AlarmConfig
-    fields = ["tag", "trigger_value", "operator", "enabled", "alias", "message", "threat_level", "notification_cooldown"]
+    fields = ["tag", "trigger_value", "operator", "enabled", "alias", "message", "threat_level", "notification_cooldown", "trigger_sustain", "clear_sustain", "deadband", "window"]
     required_fields = ["tag", "trigger_value", "alias", "threat_level"]
-    lookup_fields = ["tag", "alias"] #TODO?
+    lookup_fields = ["tag", "alias"]
+
+    def prepare_chunk(self, rows: list[dict]):
+        external_ids = set()
+        for row in rows:
+            try:
+                external_ids.add(uuid.UUID(row["tag"]))
+            except (ValueError, TypeError):
+                pass
+        self.tags: dict[uuid.UUID, int] = dict(Tag.objects.filter(external_id__in=external_ids).values_list("external_id", "id"))
 
     def clean_row(self, row: dict):
-        row["tag"] = Tag.objects.get(external_id=row["tag"]) #TODO just use as PK?
-        if "notification_cooldown" in row:
-            row["notification_cooldown"] = parse_duration(row["notification_cooldown"])
-        return super().clean_row(row)
+        cleaned = super().clean_row(row)
+
+        try:
+            tag_id = self.tags.get(uuid.UUID(cleaned.pop("tag", "")))
+        except ValueError:
+            tag_id = None
+        if tag_id is None:
+            raise ValidationError({"tag": f"Unknown tag '{row['tag']}'"})
+        cleaned["tag_id"] = tag_id
+
+        cleaned["trigger_value"] = parse_value(row["trigger_value"])
+        return cleaned
+
+    def run(self) -> ImportResult:
+        result = super().run()
+
+        # Bulk writes skip the save signals
+        alarm_engine.invalidate()
+        alarm_counter.invalidate()
+        return result
+
+
+def _error_dict(error: ValidationError) -> dict[str, list[str]]:
+    return error.message_dict if hasattr(error, "error_dict") else {"__all__": error.messages}
+
+
+def parse_value(text: str):
+    """ Parse a CSV cell into a tag value. Python style booleans are accepted as well as JSON """
+
+    if text in ("True", "False"):
+        return text == "True"
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
     
 
 class BaseCSVExporter:
+    """ Writes model rows to a CSV file in constant memory
+
+    Rows are projected with `values_list`, following `lookups` for fields that live on
+    related models, and read with a server side cursor. The export is one query however
+    many rows there are.
+    """
+
     model: models.Model = None
     fields = []
+    lookups = {} # Field -> ORM lookup, for fields not stored on the model
+    chunk_size = 2000
 
-    def __init__(self, file, queryset=None):
+    def __init__(self, file=None, queryset=None):
         self.file = file
-        self.writer = csv.DictWriter(self.file, fieldnames=self.fields)
-        self.queryset = queryset or self.get_queryset()
+        self.queryset = queryset if queryset is not None else self.get_queryset()
 
     def get_queryset(self):
         return self.model.objects.all()
 
-    def serialize_row(self, obj):
-        """Override for custom serialization"""
-        return {field: getattr(obj, field) for field in self.fields}
+    def serialize_row(self, values: tuple) -> tuple:
+        """ Override for custom serialization """
+        return values
+
+    def rows(self):
+        yield self.fields
+
+        columns = [self.lookups.get(field, field) for field in self.fields]
+        for values in self.queryset.order_by("pk").values_list(*columns).iterator(chunk_size=self.chunk_size):
+            yield self.serialize_row(values)
+
+    def lines(self):
+        """ Yields the CSV text a line at a time, for streaming responses """
+
+        writer = csv.writer(_Echo())
+        for row in self.rows():
+            yield writer.writerow(row)
 
     def run(self):
-        self.writer.writeheader()
-        for obj in self.queryset:
-            row = self.serialize_row(obj)
-            self.writer.writerow(row)
+        csv.writer(self.file).writerows(self.rows())
+
+
+class _Echo:
+    """ File-like object that returns what is written, so csv.writer can produce lines on demand """
+
+    def write(self, value):
+        return value
 
 
 class DeviceExporter(BaseCSVExporter):
@@ -110,19 +317,11 @@ class DeviceExporter(BaseCSVExporter):
 
 class TagExporter(BaseCSVExporter):
     model = Tag
-    fields = ["device", "alias", "description", "channel", "data_type", "address", "bit_index", "is_active", "restricted_write", "history_interval", "history_retention", "external_id"]
-
-    def serialize_row(self, obj):
-        row = super().serialize_row(obj)
-        row["device"] = row["device"].alias
-        return row
+    fields = ["device", "unit_id", "alias", "description", "channel", "data_type", "address", "bit_index", "is_active", "restricted_write", "history_interval", "history_retention", "external_id"]
+    lookups = {"device": "device__alias"}
 
 
 class AlarmConfigExporter(BaseCSVExporter):
     model = AlarmConfig
-    fields = ["tag", "trigger_value", "operator", "enabled", "alias", "message", "threat_level", "notification_cooldown"]
-
-    def serialize_row(self, obj):
-        row = super().serialize_row(obj)
-        row["tag"] = row["tag"].external_id
-        return row
\ No newline at end of file
+    fields = ["tag", "trigger_value", "operator", "enabled", "alias", "message", "threat_level", "notification_cooldown", "trigger_sustain", "clear_sustain", "deadband", "window"]
+    lookups = {"tag": "tag__external_id"}
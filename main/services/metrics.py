@@ -0,0 +1,202 @@
+import math
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+
+# Latency buckets in seconds, from sub-millisecond Modbus replies to stalled requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(ABC):
+    """ A named family of series, one per combination of label values
+
+    `labels()` looks the series up in a dict, so hot paths should fetch it once and keep it
+    (e.g. once per device per cycle) rather than per value. Updates are plain attribute
+    arithmetic without locks; they're made from the event loop and the single database thread.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series: dict[tuple[str, ...], object] = {}
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        series = self.series.get(key)
+        if series is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {key}")
+            series = self.series[key] = self.new_series()
+        return series
+
+    @abstractmethod
+    def new_series(self):
+        """ A series for one combination of label values """
+
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """ (suffix, label names, label values, value) for every sample to expose """
+        for key, series in self.series.items():
+            yield "", self.labelnames, key, series.value
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1.0):
+        self.value += amount
+
+    def dec(self, amount=1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    """ A value that only goes up, like a count of errors """
+
+    type = "counter"
+
+    def new_series(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """ A value that goes up and down, like a queue depth
+
+    Pass `function` for values that are cheaper to read when scraped than to keep updated.
+    It returns the value, or with labels, an iterable of (label values, value).
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), function: Callable = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def new_series(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1.0):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+        elif self.labelnames:
+            for key, value in self.function():
+                yield "", self.labelnames, tuple(str(v) for v in key), value
+        else:
+            yield "", (), (), self.function()
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # The last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    """ Counts of observed values in cumulative buckets, for latencies and durations """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_series(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        bucket_labels = (*self.labelnames, "le")
+        for key, series in self.series.items():
+            total = 0
+            for bound, count in zip((*series.bounds, math.inf), series.counts):
+                total += count
+                yield "_bucket", bucket_labels, (*key, _format_value(bound)), total
+            yield "_sum", self.labelnames, key, series.sum
+            yield "_count", self.labelnames, key, total
+
+
+class MetricsRegistry:
+    """ All the metrics of the process, rendered in the Prometheus text format for `/metrics` """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        if not metric.labelnames:
+            metric.labels() # Expose unlabeled metrics before their first update
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = (), function: Callable = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation, help=True)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labelnames, labelvalues, value in metric.samples():
+                if labelnames:
+                    labels = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(labelnames, labelvalues))
+                    lines.append(f"{metric.name}{suffix}{{{labels}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{metric.name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(text: str, help=False) -> str:
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    return text if help else text.replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+registry = MetricsRegistry()
@@ -1,33 +1,168 @@
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime
+from dataclasses import dataclass
+from collections import defaultdict
+from django.conf import settings
+from django.core.mail import send_mass_mail
 from django.utils import timezone
+from django.utils.module_loading import import_string
+from channels.db import database_sync_to_async
 from ..models import ActivatedAlarm, AlarmConfig, AlarmSubscription
 
-def send_alarm_notifications():
-    active_alarms = ActivatedAlarm.objects.filter(is_active=True)
-    if not active_alarms:
-        return
-    
-    # Group by config to batch work
-    alarms_by_config: dict[int, list[ActivatedAlarm]] = {}
-    for alarm in active_alarms:
-        alarms_by_config.setdefault(alarm.config_id, []).append(alarm)
 
-    configs = AlarmConfig.objects.in_bulk(alarms_by_config.keys())
+logger = logging.getLogger(__name__)
 
-    for config_id, alarms in alarms_by_config.items():
-        config = configs[config_id]
 
-        if not alarms[0].should_notify():
-            continue
+@dataclass
+class AlarmDigest:
+    """ All the alarms a single recipient should hear about at once """
 
-        subs = AlarmSubscription.objects.filter(
-            alarm_config_id=config_id,
-            email_enabled=True
-        ).select_related("user")
+    recipient: str
+    alarms: list[ActivatedAlarm]
 
-        recipients = [s.user.email for s in subs if s.user.email]
+    @property
+    def subject(self):
+        if len(self.alarms) == 1:
+            config = self.alarms[0].config
+            return f"[{config.get_threat_level_display()}] {config.alias}"
+        return f"{len(self.alarms)} alarms activated"
 
-        #TODO async job
-        print(f"Notify {recipients}: {config.message}")
+    @property
+    def body(self):
+        lines = []
+        for alarm in sorted(self.alarms, key=lambda a: -AlarmConfig.ALARM_PRIORITY[a.config.threat_level]):
+            config = alarm.config
+            lines.append(f"{config.get_threat_level_display()}: {config.tag.alias} - {config.message} ({alarm.timestamp:%Y-%m-%d %H:%M:%S})")
+        return "\n".join(lines)
 
-        config.last_notified = timezone.now()
-        config.save(update_fields=["last_notified"])
\ No newline at end of file
+
+class NotificationBackend(ABC):
+    """ Delivers alarm digests. Point `ALARM_NOTIFICATION_BACKEND` at a subclass to change how """
+
+    @abstractmethod
+    def send(self, digests: list[AlarmDigest]):
+        pass
+
+
+class EmailBackend(NotificationBackend):
+    """ Sends one email per digest over a single connection of the configured Django email backend """
+
+    def send(self, digests: list[AlarmDigest]):
+        messages = [(d.subject, d.body, settings.DEFAULT_FROM_EMAIL, [d.recipient]) for d in digests]
+        send_mass_mail(messages, fail_silently=False)
+
+
+class AlarmNotifier:
+    """ Background worker that notifies alarm subscribers without blocking the poll loop
+
+    Activations are queued by the poller, then collected for `batch_window` seconds so
+    simultaneous alarms reach each recipient as one digest. Cooldowns are tracked in memory,
+    so deciding who to notify doesn't need to read configs back from the database.
+    """
+
+    def __init__(self, backend: NotificationBackend = None, batch_window=2.0, max_batch=500, max_queue=10000):
+        self.backend = backend
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.queue: asyncio.Queue[ActivatedAlarm] = asyncio.Queue(maxsize=max_queue)
+        self.last_notified: dict[int, datetime] = {} # Config id -> last notification time
+        self.running = False
+
+    def notify(self, alarms: list[ActivatedAlarm]):
+        """ Queue activated alarms for notification. Never blocks, and does nothing unless `run()` is consuming the queue """
+
+        if not self.running:
+            return
+
+        for alarm in alarms:
+            try:
+                self.queue.put_nowait(alarm)
+            except asyncio.QueueFull:
+                logger.warning(f"Notification queue full, dropped: {alarm}")
+
+    async def run(self):
+        logger.info("Starting alarm notifier...")
+
+        if self.backend is None:
+            self.backend = import_string(settings.ALARM_NOTIFICATION_BACKEND)()
+
+        self.running = True
+        try:
+            while True:
+                batch = await self._collect_batch()
+                try:
+                    await self.dispatch(batch)
+                except Exception as e:
+                    logger.error(f"Failed to send alarm notifications: {e}")
+        finally:
+            self.running = False
+
+    async def _collect_batch(self) -> list[ActivatedAlarm]:
+        """ Wait for an alarm, then gather whatever else arrives within the batch window """
+
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.batch_window
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def dispatch(self, batch: list[ActivatedAlarm]):
+        """ Send digests for the alarms in the batch that are out of their cooldown """
+
+        @database_sync_to_async
+        def get_recipients(config_ids) -> dict[int, list[str]]:
+            recipients = defaultdict(list)
+            subs = AlarmSubscription.objects.filter(alarm_config_id__in=config_ids, email_enabled=True)
+            for config_id, email in subs.values_list("alarm_config_id", "user__email"):
+                if email:
+                    recipients[config_id].append(email)
+            return recipients
+
+        @database_sync_to_async
+        def save_last_notified(config_ids, now):
+            # Queryset update so the alarm engine isn't invalidated by the save signal
+            AlarmConfig.objects.filter(id__in=config_ids).update(last_notified=now)
+
+        now = timezone.now()
+
+        # One notification per config, skipping configs still in cooldown
+        due: dict[int, ActivatedAlarm] = {}
+        for alarm in batch:
+            config = alarm.config
+            last = self.last_notified.get(config.id, config.last_notified)
+            if last is not None and now - last <= config.notification_cooldown:
+                continue
+            due[config.id] = alarm
+
+        if not due:
+            return
+
+        recipients = await get_recipients(list(due.keys()))
+
+        digests: dict[str, list[ActivatedAlarm]] = defaultdict(list)
+        for config_id, alarm in due.items():
+            for email in recipients.get(config_id, []):
+                digests[email].append(alarm)
+
+        if digests:
+            # Delivery may block on the network, so keep it off the event loop
+            await asyncio.to_thread(self.backend.send, [AlarmDigest(r, alarms) for r, alarms in digests.items()])
+            logger.info(f"Sent {len(digests)} alarm notifications for {len(due)} alarms")
+
+        for config_id in due:
+            self.last_notified[config_id] = now
+        await save_last_notified(list(due.keys()), now)
+
+
+alarm_notifier = AlarmNotifier()
@@ -1,17 +1,27 @@
 import asyncio
 import time
 import logging
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from collections import defaultdict
+from django.conf import settings
 from django.utils import timezone
 from django.db import connection, close_old_connections
 from pymodbus.client import AsyncModbusTcpClient, AsyncModbusUdpClient
 from pymodbus.client.base import ModbusBaseClient
+from pymodbus.constants import ExcCodes
 from channels.layers import get_channel_layer
 from channels.db import database_sync_to_async
-from ..models import Device, Tag, TagWriteRequest, AlarmConfig, ActivatedAlarm
-from ..api.serializers import TagValueSerializer
-from .notify_alarms import send_alarm_notifications #TODO use
+from ..models import Device, Tag, TagWriteRequest, ActivatedAlarm
+from .notify_alarms import alarm_notifier
+from .tag_journal import tag_journal
+from .tag_encoder import tag_encoder
+from .alarm_engine import alarm_engine
+from .alarm_counter import alarm_counter
+from .metrics import registry
+from .cycle_trace import CycleTrace, cycle_tracer
+from .scan_scheduler import scan_scheduler
+from .address_quarantine import address_quarantine
+from .device_probe import CapabilityProbe
 
 
 @dataclass
@@ -24,22 +34,91 @@ class ReadBlock:
 class PollContext:
     updated_tags: list[Tag]
     read_tags: list[Tag]
+    alarm_tags: list[Tag] = field(default_factory=list)
+    activated_alarms: list[ActivatedAlarm] = field(default_factory=list)
+    alarm_counts: dict | None = None
+    trace: CycleTrace = field(default_factory=lambda: CycleTrace(0, timezone.now(), time.perf_counter()))
 
 @dataclass
 class DeviceState:
     failures: int = 0
     next_retry: float = 0.0
     disabled_until: float = 0.0
+    lanes_retry: float = 0.0 # When to try opening more connections for concurrent reads again
 
 logger = logging.getLogger(__name__)
 
 channel_layer = get_channel_layer()
 clients: dict[str, ModbusBaseClient] = {}
+lanes: dict[str, list[ModbusBaseClient]] = {} # Extra connections to devices that take concurrent requests
+probes: dict[str, asyncio.Task] = {}
 device_states: dict[str, DeviceState] = defaultdict(DeviceState)
 
+# Metrics, exposed at `/metrics`
+cycle_seconds = registry.histogram("modbus_tiles_poll_cycle_seconds", "Duration of a whole poll cycle")
+cycle_overruns = registry.counter("modbus_tiles_poll_overruns_total", "Poll cycles that took longer than the poll interval")
+device_seconds = registry.histogram("modbus_tiles_device_poll_seconds", "Time spent on a device in a poll cycle, writes included", ["device"])
+device_overruns = registry.counter("modbus_tiles_device_overruns_total", "Poll cycles in which a device alone took longer than the poll interval", ["device"])
+request_seconds = registry.histogram("modbus_tiles_request_seconds", "Round trip time of Modbus requests", ["device", "function"])
+block_seconds = registry.histogram("modbus_tiles_block_read_seconds", "Time to read and decode a block of registers", ["device"])
+decode_seconds = registry.histogram("modbus_tiles_decode_seconds", "Time to decode the tag values of a block", ["device"])
+errors = registry.counter("modbus_tiles_errors_total", "Failed connections, requests, responses, decodes and writes", ["device", "kind"])
+flush_seconds = registry.histogram("modbus_tiles_db_flush_seconds", "Time to save the results of a poll cycle, by stage", ["stage"])
+write_queue = registry.gauge("modbus_tiles_write_queue_depth", "Write requests that were waiting when a device was last polled", ["device"])
+write_seconds = registry.histogram("modbus_tiles_write_latency_seconds", "Time from a write request being made to its value reaching the device", ["device"])
 
-async def poll_devices(poll_interval=0.25, info_interval=30):
-    """ Gather tag data and process write requests at a steady rate """
+
+class DeviceMetrics:
+    """ A device's series of the metrics above, looked up once rather than for every block """
+
+    def __init__(self, alias: str):
+        self.alias = alias
+        self.poll_seconds = device_seconds.labels(alias)
+        self.overruns = device_overruns.labels(alias)
+        self.block_seconds = block_seconds.labels(alias)
+        self.decode_seconds = decode_seconds.labels(alias)
+        self.write_queue = write_queue.labels(alias)
+        self.write_seconds = write_seconds.labels(alias)
+
+        # By function and kind, added as they first occur so unused ones aren't exposed
+        self.requests: dict[str, object] = {}
+        self.errors: dict[str, object] = {}
+
+    def request(self, function: str):
+        series = self.requests.get(function)
+        if series is None:
+            series = self.requests[function] = request_seconds.labels(self.alias, function)
+        return series
+
+    def error(self, kind: str):
+        series = self.errors.get(kind)
+        if series is None:
+            series = self.errors[kind] = errors.labels(self.alias, kind)
+        return series
+
+
+device_metrics: dict[str, DeviceMetrics] = {}
+
+
+def _get_metrics(device: Device) -> DeviceMetrics:
+    metrics = device_metrics.get(device.alias)
+    if metrics is None:
+        metrics = device_metrics[device.alias] = DeviceMetrics(device.alias)
+    return metrics
+
+
+registry.gauge(
+    "modbus_tiles_device_failures", "Consecutive failed connection attempts", ["device"],
+    function=lambda: [((alias,), state.failures) for alias, state in list(device_states.items())],
+)
+registry.gauge(
+    "modbus_tiles_device_backoff_seconds", "Time until an unreachable device is retried", ["device"],
+    function=lambda: [((alias,), max(0.0, state.disabled_until - time.monotonic())) for alias, state in list(device_states.items())],
+)
+
+
+async def poll_devices(poll_interval=0.25, info_interval=30, duration: float | None = None):
+    """ Gather tag data and process write requests at a steady rate, forever or for `duration` seconds """
 
     @database_sync_to_async
     def get_active_devices() -> list[Device]:
@@ -48,21 +127,34 @@ async def poll_devices(poll_interval=0.25, info_interval=30):
 
     @database_sync_to_async
     def update_tags(context: PollContext):
+        def flushed(stage: str, start: float, **args) -> float:
+            end = time.perf_counter()
+            flush_seconds.labels(stage).observe(end - start)
+            context.trace.add(f"flush {stage}", start, end, **args)
+            return end
+
         connection.ensure_connection()
 
+        lap = time.perf_counter()
         Tag.objects.bulk_update(context.read_tags, ['last_updated'])
+        lap = flushed("last_updated", lap, rows=len(context.read_tags))
+
         Tag.objects.bulk_update(context.updated_tags, ['current_value'])
+        lap = flushed("values", lap, rows=len(context.updated_tags))
+
         Tag.bulk_create_history(context.updated_tags)
+        lap = flushed("history", lap)
 
-        AlarmConfig.update_alarms(context.updated_tags)
-    
-    @database_sync_to_async
-    def get_tag_data(context: PollContext):
-        serialized = TagValueSerializer(
-            context.updated_tags, many=True, 
-            context={"alarm_map": ActivatedAlarm.get_tag_map(context.updated_tags)}
-        )
-        return serialized.data
+        changes = alarm_engine.update(context.updated_tags, context.read_tags)
+        context.activated_alarms = changes.activated
+        flushed("alarms", lap)
+
+        if alarm_counter.update(changes.activated, changes.deactivated):
+            context.alarm_counts = alarm_counter.pending_message()
+
+        # Unchanged tags can still change alarm state once a sustain timer runs out
+        updated_ids = {tag.id for tag in context.updated_tags}
+        context.alarm_tags = [tag for tag in changes.tags if tag.id not in updated_ids]
     
     async def log_duration(): #TODO more logging info?
         """ Notify if we're keeping up with the target frequency """
@@ -77,61 +169,148 @@ async def poll_devices(poll_interval=0.25, info_interval=30):
                 else:
                     logger.info(msg)
 
+            if shed := scan_scheduler.report():
+                logger.warning(shed)
+            if slow := cycle_tracer.report():
+                logger.warning(slow)
+
             total_duration = iteration_count = 0
             await asyncio.sleep(info_interval)
 
     logger.info("Starting Async Poller...")
 
     total_duration = iteration_count = 0
-    asyncio.create_task(log_duration())
+    log_task = asyncio.create_task(log_duration())
+    stop_at = None if duration is None else time.monotonic() + duration
     
-    while True:
+    while stop_at is None or time.monotonic() < stop_at:
         start_time = time.monotonic()
+        trace = cycle_tracer.start()
 
-        devices = await get_active_devices()
-        context = PollContext(updated_tags=[], read_tags=[])
+        with trace.span("load config"):
+            devices = await get_active_devices()
+        context = PollContext(updated_tags=[], read_tags=[], trace=trace)
         
         # Process devices concurrently
-        tasks = [_poll_device(d, context) for d in devices]
-        await asyncio.gather(*tasks)
-        await update_tags(context)
-
-        # Send data to the websocket using the tag serializer
-        tag_data = await get_tag_data(context)
-        await channel_layer.group_send(
-            "poller_broadcast", {
-                "type": "tag_update",
-                "updates": tag_data
-            }
-        )
+        with trace.span("devices"):
+            tasks = [_poll_device(d, context, poll_interval) for d in devices]
+            await asyncio.gather(*tasks)
+
+        with trace.span("update_tags"):
+            await update_tags(context)
+        alarm_notifier.notify(context.activated_alarms)
+
+        # Send data to the websocket using the same shape as the tag value serializer
+        with trace.span("serialize"):
+            tag_data = tag_encoder.encode(context.updated_tags + context.alarm_tags, alarm_engine.alarm_ids)
+            seq = tag_journal.record(tag_data)
+
+        with trace.span("group_send"):
+            await channel_layer.group_send(
+                "poller_broadcast", {
+                    "type": "tag_update",
+                    "updates": tag_data,
+                    "seq": seq,
+                }
+            )
+
+            if context.alarm_counts:
+                await channel_layer.group_send("poller_broadcast", context.alarm_counts)
+
+        await cycle_tracer.finish(trace, poll_interval)
 
         # Sleep
         elapsed = time.monotonic() - start_time
         sleep_time = max(0, poll_interval - elapsed)
 
+        cycle_seconds.observe(elapsed)
+        if elapsed > poll_interval:
+            cycle_overruns.inc()
+
         total_duration += elapsed
         iteration_count += 1
 
         await asyncio.sleep(sleep_time)
 
+    log_task.cancel()
 
-async def _poll_device(device: Device, context: PollContext):
+
+def close_clients():
+    """ Disconnect from all devices, so a stopped poller doesn't leave connections open """
+
+    for task in probes.values():
+        task.cancel()
+    probes.clear()
+    for conn in [*clients.values(), *(conn for extra in lanes.values() for conn in extra)]:
+        conn.close()
+    clients.clear()
+    lanes.clear()
+    device_states.clear()
+    scan_scheduler.clear()
+    address_quarantine.clear()
+
+
+async def _poll_device(device: Device, context: PollContext, poll_interval: float):
     """ Process read and writes for a device """
     if time.monotonic() < device_states[device.alias].disabled_until:
         return
     
+    trace = context.trace
+    start = time.perf_counter()
     try:
-        client = await _get_client(device)
+        with trace.span("connect", device.alias):
+            client = await _get_client(device)
     except Exception as e:
+        _get_metrics(device).error("connect").inc()
         logger.warning(f"Couldn't connect to device {device}: {e}")
         return
     
-    await _process_writes(client, device)
+    # Probe in the background, reading with the current settings until it's done
+    if device.probe_capabilities:
+        if device.alias not in probes:
+            probes[device.alias] = asyncio.create_task(_probe(device, client))
+    else:
+        probes.pop(device.alias, None)
+
+    with trace.span("writes", device.alias):
+        await _process_writes(client, device)
     
-    tags: list[Tag] = [t for t in device.tags.all() if t.is_active]
+    holes = address_quarantine.active(device)
+    tags: list[Tag] = [t for t in device.tags.all() if t.is_active and not _quarantined(t, holes)]
+    budget = poll_interval * settings.POLL_DEVICE_BUDGET - (time.perf_counter() - start)
+    tags = scan_scheduler.select(device.alias, tags, poll_interval, budget)
+
+    # Each connection takes the next block as soon as it's done with its last
+    connections = await _get_lanes(device, client)
+    blocks = iter(_build_read_blocks(tags, max_size=device.max_read_registers, holes=holes))
+
+    async def read_blocks(conn: ModbusBaseClient):
+        for block in blocks:
+            block_start = time.perf_counter()
+            await _read_block(block, conn, context, device)
+            scan_scheduler.charge(device.alias, block.tags, (time.perf_counter() - block_start) / len(connections))
+
+    await asyncio.gather(*(read_blocks(conn) for conn in connections))
+    scan_scheduler.finish(device.alias)
 
-    for block in _build_read_blocks(tags):
-        await _process_block(block, client, context)
+    end = time.perf_counter()
+    trace.add("device", start, end, device.alias)
+    elapsed = end - start
+    metrics = _get_metrics(device)
+    metrics.poll_seconds.observe(elapsed)
+    if elapsed > poll_interval:
+        metrics.overruns.inc()
+
+
+def _create_client(device: Device) -> ModbusBaseClient:
+    match device.protocol:
+        case Device.ProtocolChoices.MODBUS_TCP:
+            return AsyncModbusTcpClient(device.ip_address, port=device.port, retries=0)
+
+        case Device.ProtocolChoices.MODBUS_UDP:
+            return AsyncModbusUdpClient(device.ip_address, port=device.port, retries=0)
+        #case Device.ProtocolChoices.MODBUS_RTU:
+        #    return ModbusSerialClient(device.port)
 
 
 async def _get_client(device: Device, base_backoff_seconds=2, max_backoff_seconds=60) -> ModbusBaseClient | None:
@@ -141,14 +320,7 @@ async def _get_client(device: Device, base_backoff_seconds=2, max_backoff_second
     conn = clients.get(device.alias)
 
     if conn is None or not conn.connected:
-        match device.protocol:
-            case Device.ProtocolChoices.MODBUS_TCP:
-                conn = AsyncModbusTcpClient(device.ip_address, port=device.port, retries=0)
-
-            case Device.ProtocolChoices.MODBUS_UDP:
-                conn = AsyncModbusUdpClient(device.ip_address, port=device.port, retries=0)
-            #case Device.ProtocolChoices.MODBUS_RTU:
-            #    conn = ModbusSerialClient(device.port)
+        conn = _create_client(device)
         if await conn.connect():
             state.failures = 0
             clients[device.alias] = conn
@@ -165,20 +337,56 @@ async def _get_client(device: Device, base_backoff_seconds=2, max_backoff_second
     return conn
 
 
-def _build_read_blocks(tags: list[Tag], max_gap=8, max_size=128) -> list[ReadBlock]:
-    """ Create blocks of contiguous registers in memory """
+async def _get_lanes(device: Device, client: ModbusBaseClient, retry_seconds=60) -> list[ModbusBaseClient]:
+    """ The connections to read from the device on, one for each request it takes at a time """
+
+    state = device_states[device.alias]
+    extra = [conn for conn in lanes.get(device.alias, []) if conn.connected]
+    for conn in extra[device.max_concurrent_requests - 1:]:
+        conn.close()
+    extra = extra[:device.max_concurrent_requests - 1]
+
+    while len(extra) < device.max_concurrent_requests - 1 and time.monotonic() >= state.lanes_retry:
+        conn = _create_client(device)
+        if await conn.connect():
+            extra.append(conn)
+        else:
+            state.lanes_retry = time.monotonic() + retry_seconds
+            logger.warning(f"{device.alias} refused connection {len(extra) + 2} of {device.max_concurrent_requests}, reading on {len(extra) + 1} for now")
+
+    lanes[device.alias] = extra
+    return [client, *extra]
+
+
+async def _probe(device: Device, client: ModbusBaseClient):
+    try:
+        await CapabilityProbe(device, client, _create_client).run()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Couldn't probe {device.alias}: {e}")
+
+
+def _quarantined(tag: Tag, holes: dict[tuple[int, str], list[tuple[int, int]]]) -> bool:
+    end = tag.address + tag.get_read_count()
+    return any(start < end and tag.address < hole_end for start, hole_end in holes.get((tag.unit_id, tag.channel), []))
+
+
+def _build_read_blocks(tags: list[Tag], max_gap=8, max_size=125, holes: dict[tuple[int, str], list[tuple[int, int]]] | None = None) -> list[ReadBlock]:
+    """ Create blocks of contiguous registers in memory, without reading across any of the `holes` """
     #if not all(tag.device == tags[0].device for tag in tags):
     #    raise Exception("Tag device mismatch when building read block")
 
-    # Group tags by channel
+    # Group tags by unit and channel, since a request reads one channel of one unit
     grouped_tags = defaultdict(list[Tag])
     for tag in tags:
-        grouped_tags[tag.channel].append(tag)
+        grouped_tags[(tag.unit_id, tag.channel)].append(tag)
 
     blocks = []
 
-    for channel, channel_tags in grouped_tags.items():
+    for key, channel_tags in grouped_tags.items():
         channel_tags.sort(key=lambda x: x.address)
+        channel_holes = (holes or {}).get(key, [])
 
         # First block
         block_tags = [channel_tags[0]]
@@ -191,8 +399,9 @@ def _build_read_blocks(tags: list[Tag], max_gap=8, max_size=128) -> list[ReadBlo
 
             close_enough = (tag.address - block_end) <= max_gap
             within_size = (tag.address + length - block_start) <= max_size
+            clear = not any(start < tag.address + length and block_end < end for start, end in channel_holes)
 
-            if close_enough and within_size:
+            if close_enough and within_size and clear:
                 # Extend current block
                 block_tags.append(tag)
                 block_end = max(block_end, tag.address + length)
@@ -210,9 +419,53 @@ def _build_read_blocks(tags: list[Tag], max_gap=8, max_size=128) -> list[ReadBlo
     return blocks
 
 
-async def _process_block(block: ReadBlock, client: ModbusBaseClient, context: PollContext):
-    """ Read the given data from the device connection and update associated tags """
+def _span(tags: list[Tag]) -> ReadBlock:
+    """ The block covering all the given tags """
+
+    start = min(tag.address for tag in tags)
+    end = max(tag.address + tag.get_read_count() for tag in tags)
+    return ReadBlock(start, end - start, tags)
+
 
+async def _read_block(block: ReadBlock, client: ModbusBaseClient, context: PollContext, device: Device) -> bool:
+    """ Read a block, bisecting it if the device rejects its addresses so the tags it does have are still read
+
+    The addresses found to be at fault are quarantined: a tag's own registers, or the unused registers
+    between two halves that each read fine. Returns whether anything was quarantined.
+    """
+
+    if not await _process_block(block, client, context, device):
+        return False
+
+    tag = block.tags[0]
+    addresses = sorted({tag.address for tag in block.tags})
+    if len(addresses) == 1:
+        address_quarantine.add(device, tag.unit_id, tag.channel, block.start, block.start + block.length, block.tags)
+        return True
+
+    middle = addresses[len(addresses) // 2]
+    left = _span([t for t in block.tags if t.address < middle])
+    right = _span([t for t in block.tags if t.address >= middle])
+    found = [await _read_block(half, client, context, device) for half in (left, right)]
+
+    if any(found):
+        return True
+
+    if left.start + left.length < right.start:
+        address_quarantine.add(device, tag.unit_id, tag.channel, left.start + left.length, right.start, [])
+        return True
+
+    logger.warning(f"{device.alias} rejected the block starting at {block.start}, but read both its halves")
+    return False
+
+
+async def _process_block(block: ReadBlock, client: ModbusBaseClient, context: PollContext, device: Device) -> bool:
+    """ Read the given data from the device connection and update associated tags
+
+    Returns whether the device rejected the block's addresses, as opposed to reading it or failing some other way
+    """
+
+    metrics = _get_metrics(device)
     read_func = {
         Tag.ChannelChoices.COIL: client.read_coils,
         Tag.ChannelChoices.DISCRETE_INPUT: client.read_discrete_inputs,
@@ -221,23 +474,36 @@ async def _process_block(block: ReadBlock, client: ModbusBaseClient, context: Po
     }[block.tags[0].channel]
 
     # Get register data for this block
+    start = time.perf_counter()
     try:
-        rr = await read_func(block.start, count=block.length, device_id=0)
+        rr = await read_func(block.start, count=block.length, device_id=block.tags[0].unit_id)
     except Exception as e:
+        metrics.error("request").inc()
         logger.error(f"Error reading block: {e}")
-        return
+        return False
+    finally:
+        end = time.perf_counter()
+        metrics.request(read_func.__name__).observe(end - start)
+        context.trace.add("request", start, end, device.alias, function=read_func.__name__, address=block.start, count=block.length)
     
     if rr.isError():
+        metrics.error("response").inc()
         logger.error(f"Modbus error while reading block starting at {block.start} (Tags: {block.tags})")
-        return
+        return getattr(rr, "exception_code", None) in [ExcCodes.ILLEGAL_ADDRESS, ExcCodes.ILLEGAL_VALUE]
     
     if len(rr.registers) > 0:
         block_data = rr.registers
     elif len(rr.bits) > 0:
         block_data = rr.bits
     else:
+        metrics.error("response").inc()
         logger.error("Modbus response contained no data")
-        return
+        return False
+
+    address_quarantine.release(device, block.tags[0].unit_id, block.tags[0].channel, block.start, block.start + block.length)
+
+    read_time = timezone.now()
+    decode_start = time.perf_counter()
 
     # For each tag, get the associated value found in the register data 
     for tag in block.tags:
@@ -247,6 +513,7 @@ async def _process_block(block: ReadBlock, client: ModbusBaseClient, context: Po
             length = tag.get_read_count() #TODO
 
             if offset + length > len(block_data):
+                metrics.error("decode").inc()
                 logger.error(f"Tag {tag} out of bounds in block read")
                 continue
             
@@ -271,12 +538,19 @@ async def _process_block(block: ReadBlock, client: ModbusBaseClient, context: Po
                 tag.current_value = values
                 context.updated_tags.append(tag)
             
-            tag.last_updated = timezone.now()
+            tag.last_updated = read_time
             context.read_tags.append(tag)
 
         except Exception as e:
+            metrics.error("decode").inc()
             logger.error(f"Error processing tag {tag.alias}: {e}")
 
+    end = time.perf_counter()
+    context.trace.add("decode", decode_start, end, device.alias, tags=len(block.tags))
+    metrics.decode_seconds.observe(end - decode_start)
+    metrics.block_seconds.observe(end - start)
+    return False
+
 
 async def _process_writes(client, device: Device):
     """ Queries all PLC write requests and attempts to fullfill them """
@@ -295,18 +569,25 @@ async def _process_writes(client, device: Device):
         TagWriteRequest.objects.bulk_update(requests, ['processed'])
 
     writes = await get_pending_writes(device)
+    metrics = _get_metrics(device)
+    metrics.write_queue.set(len(writes))
 
     if not writes:
         return
 
     for req in writes:
         # Try to actually write the requested value
+        start = time.perf_counter()
         try:
             await _write_value(client, req.tag, req.value)
+            metrics.write_seconds.observe((timezone.now() - req.timestamp).total_seconds())
             logger.info(f"Processed write request for tag {req.tag}")
 
         except Exception as e:
+            metrics.error("write").inc()
             logger.error(f"Write failed for {req.tag}: {e}") #TODO mark write status as failed
+        finally:
+            metrics.request("write").observe(time.perf_counter() - start)
             #TODO 
 
         # Mark as done
@@ -343,7 +624,15 @@ async def _write_value(client: ModbusBaseClient, tag: Tag, values):
                 bit_mask = 1 << tag.bit_index
                 and_mask = 0xFFFF ^ bit_mask
                 or_mask = bit_mask if values[0] else 0x0000
-                result = await client.mask_write_register(address=tag.address, and_mask=and_mask, or_mask=or_mask, device_id=tag.unit_id)
+                if tag.device.supports_mask_write:
+                    result = await client.mask_write_register(address=tag.address, and_mask=and_mask, or_mask=or_mask, device_id=tag.unit_id)
+
+                # Read, modify and write back, which can undo changes the PLC makes to the other bits in between
+                else:
+                    rr = await client.read_holding_registers(tag.address, count=1, device_id=tag.unit_id)
+                    if rr.isError():
+                        raise Exception(f"Modbus error: {rr}")
+                    result = await client.write_register(tag.address, (rr.registers[0] & and_mask) | or_mask, device_id=tag.unit_id)
 
             # Normal direct write
             else:
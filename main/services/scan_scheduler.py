@@ -0,0 +1,163 @@
+import time
+from enum import IntEnum
+from dataclasses import dataclass
+from collections import Counter, defaultdict
+from django.conf import settings
+from ..models import Tag
+from .alarm_engine import alarm_engine
+from .tag_subscriptions import tag_subscriptions
+from .metrics import registry
+
+
+class Priority(IntEnum):
+    ALARM = 0 # Tags with alarms configured
+    SUBSCRIBED = 1 # Tags on an open dashboard
+    HISTORY = 2 # Everything else, only logged
+
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+
+@dataclass
+class ScanGroup:
+    """ The tags of one priority on one device, read together """
+
+    device: str
+    priority: Priority
+    last_scan: float = 0.0 # time.monotonic() of the last cycle it was read in
+    cost: float = 0.0 # Moving average of seconds spent reading it
+    spent: float = 0.0 # Seconds spent reading it this cycle
+    scanned: bool = False
+    shed: int = 0 # Cycles skipped in a row
+
+    def deadline(self, poll_interval: float) -> float:
+        return self.last_scan + poll_interval * settings.POLL_MAX_STRETCH[self.priority.label]
+
+
+scan_shed = registry.counter("modbus_tiles_scan_groups_shed_total", "Scan groups deferred to a later cycle to keep a device within its budget", ["priority"])
+registry.gauge(
+    "modbus_tiles_scan_lag_seconds", "Longest time since a scan group of each priority was read", ["priority"],
+    function=lambda: scan_scheduler.lags(),
+)
+
+
+class ScanScheduler:
+    """ Decides which tags each device reads in a cycle, earliest deadline first
+
+    The tags of a device are split by priority into scan groups. Each priority may fall behind by
+    up to `POLL_MAX_STRETCH` poll intervals, which sets the deadline of its groups. If a device's
+    groups are estimated to take longer than its share of the poll interval (`POLL_DEVICE_BUDGET`),
+    they're taken in deadline order until the budget is spent, and the rest wait for a later cycle
+    unless that would miss their deadline. Lower priorities have later deadlines, so they're
+    stretched first but never past their limit. A device that keeps up reads every group every cycle.
+    """
+
+    smoothing = 0.3 # Weight of the latest cycle in the cost average
+
+    def __init__(self):
+        self.groups: dict[tuple[str, Priority], ScanGroup] = {}
+        self.priorities: dict[str, dict[int, Priority]] = {} # Device -> tag id -> priority, for charging reads
+        self.shed_since_report: Counter[tuple[str, Priority]] = Counter()
+
+    def clear(self):
+        """ Forget every device's scan history, so a restarted poller starts by reading everything """
+
+        self.groups.clear()
+        self.priorities.clear()
+        self.shed_since_report.clear()
+
+    def priority(self, tag: Tag) -> Priority:
+        if tag.id in alarm_engine.configs_by_tag:
+            return Priority.ALARM
+        if tag.external_id in tag_subscriptions:
+            return Priority.SUBSCRIBED
+        return Priority.HISTORY
+
+    def select(self, device: str, tags: list[Tag], poll_interval: float, budget: float) -> list[Tag]:
+        """ The tags to read this cycle """
+
+        now = time.monotonic()
+        priorities = {tag.id: self.priority(tag) for tag in tags}
+        self.priorities[device] = priorities
+
+        tags_by_priority: dict[Priority, list[Tag]] = defaultdict(list)
+        for tag in tags:
+            tags_by_priority[priorities[tag.id]].append(tag)
+
+        groups: list[ScanGroup] = []
+        for priority in Priority:
+            key = (device, priority)
+            if priority not in tags_by_priority:
+                self.groups.pop(key, None)
+                continue
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = ScanGroup(device, priority)
+            groups.append(group)
+
+        selected: list[Tag] = []
+        planned = 0.0
+        for group in sorted(groups, key=lambda g: (g.deadline(poll_interval), g.priority)):
+            # Waiting another cycle would miss the deadline, so read it even over budget
+            due = group.deadline(poll_interval) <= now + poll_interval
+            group.scanned = due or planned + group.cost <= budget
+
+            if group.scanned:
+                selected.extend(tags_by_priority[group.priority])
+                planned += group.cost
+                group.shed = 0
+            else:
+                group.shed += 1
+                self.shed_since_report[(device, group.priority)] += 1
+                scan_shed.labels(group.priority.label).inc()
+
+        return selected
+
+    def charge(self, device: str, tags: list[Tag], seconds: float):
+        """ Split the time taken to read a block between the groups of its tags """
+
+        priorities = self.priorities.get(device, {})
+        for priority, count in Counter(priorities.get(tag.id, Priority.HISTORY) for tag in tags).items():
+            group = self.groups.get((device, priority))
+            if group is not None:
+                group.spent += seconds * count / len(tags)
+
+    def finish(self, device: str):
+        """ Update the cost estimates and scan times of the groups read this cycle """
+
+        now = time.monotonic()
+        for priority in Priority:
+            group = self.groups.get((device, priority))
+            if group is None or not group.scanned:
+                continue
+            group.cost = group.spent if group.last_scan == 0 else self.smoothing * group.spent + (1 - self.smoothing) * group.cost
+            group.spent = 0.0
+            group.last_scan = now
+
+    def lags(self) -> list[tuple[tuple[str], float]]:
+        now = time.monotonic()
+        lags = {priority: 0.0 for priority in Priority}
+        for group in list(self.groups.values()):
+            if group.last_scan:
+                lags[group.priority] = max(lags[group.priority], now - group.last_scan)
+        return [((priority.label,), lag) for priority, lag in lags.items()]
+
+    def report(self) -> str | None:
+        """ Which groups were shed since the last report, or None if none were """
+
+        if not self.shed_since_report:
+            return None
+
+        devices_by_priority: dict[Priority, list[str]] = defaultdict(list)
+        for device, priority in self.shed_since_report:
+            devices_by_priority[priority].append(device)
+        self.shed_since_report.clear()
+
+        return "Shedding scans to keep up: " + "; ".join(
+            f"{priority.label} tags on {len(devices)} device(s) ({', '.join(sorted(devices)[:5])}{', ...' if len(devices) > 5 else ''})"
+            for priority, devices in sorted(devices_by_priority.items())
+        )
+
+
+scan_scheduler = ScanScheduler()
@@ -0,0 +1,65 @@
+from datetime import datetime
+from django.utils import timezone
+from ..models import Tag
+
+
+class TagValueEncoder:
+    """ Produces the same payload as TagValueSerializer for the poller broadcast, without DRF field machinery
+
+    The UUID string of each tag is cached after the first encode, since it never changes
+    for a given tag and formatting it is one of the more expensive parts of serializing.
+    """
+
+    def __init__(self):
+        self.external_ids: dict[int, str] = {}
+
+    def encode(self, tags: list[Tag], alarm_map: dict[int, str]) -> list[dict]:
+        """ Returns the value payload for the given tags. `alarm_map` maps tag ids to active alarm config ids """
+
+        now = timezone.now()
+        tz = timezone.get_current_timezone()
+        external_ids = self.external_ids
+        times: dict[datetime, str] = {}
+        data = []
+
+        for tag in tags:
+            external_id = external_ids.get(tag.id)
+            if external_id is None:
+                external_id = external_ids[tag.id] = str(tag.external_id)
+
+            last_updated = tag.last_updated
+            if last_updated is None:
+                time = None
+                age = "Infinity"
+            else:
+                # Tags read in the same block share a timestamp
+                time = times.get(last_updated)
+                if time is None:
+                    time = times[last_updated] = _format_datetime(last_updated, tz)
+                age = (now - last_updated).total_seconds() * 1000
+
+            data.append({
+                "id": external_id,
+                "value": tag.current_value,
+                "time": time,
+                "age": age,
+                "alarm": alarm_map.get(tag.id),
+            })
+
+        return data
+
+    def forget(self, tag_id: int):
+        """ Drop cached state for a deleted tag, since the database may reuse its id """
+        self.external_ids.pop(tag_id, None)
+
+
+def _format_datetime(value: datetime, tz) -> str:
+    """ Same output as DRF's ISO 8601 DateTimeField representation """
+
+    value = value.astimezone(tz).isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return value
+
+
+tag_encoder = TagValueEncoder()
@@ -0,0 +1,70 @@
+import time
+import uuid
+from collections import deque
+from itertools import islice
+from django.conf import settings
+
+
+class TagJournal:
+    """ Bounded in-memory log of tag value updates, each stamped with a global sequence number
+
+    Lets a reconnecting websocket client catch up on the changes it missed instead of
+    refetching every value. The epoch changes whenever the server restarts, since the
+    sequence numbers of the previous process mean nothing to this one. It holds
+    `POLL_JOURNAL_ENTRIES` updates unless `max_entries` is given.
+    """
+
+    def __init__(self, max_entries: int = None):
+        max_entries = max_entries or settings.POLL_JOURNAL_ENTRIES
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.entries: deque[dict] = deque(maxlen=max_entries)
+        self.recorded: deque[float] = deque(maxlen=max_entries) # time.monotonic() of each entry, to age it on replay
+
+    @property
+    def first_seq(self) -> int:
+        """ The oldest sequence number still held by the journal """
+        return self.entries[0]["seq"] if self.entries else self.seq + 1
+
+    def record(self, updates: list[dict]) -> int:
+        """ Stamp each update with the next sequence number and keep it. Returns the latest sequence number """
+
+        now = time.monotonic()
+        for update in updates:
+            self.seq += 1
+            update["seq"] = self.seq
+            self.entries.append(update)
+            self.recorded.append(now)
+
+        return self.seq
+
+    def since(self, epoch: str, seq: int) -> list[dict] | None:
+        """ Returns the latest update per tag recorded after the given sequence number,
+        or None if the client has fallen off the journal and needs a full snapshot.
+        Ages are brought up to date, since they were computed when the update was recorded """
+
+        if epoch != self.epoch or seq is None or seq > self.seq:
+            return None
+
+        if seq < self.first_seq - 1:
+            return None
+
+        # Sequence numbers are contiguous, so the position can be computed directly
+        start = seq - self.first_seq + 1
+        latest: dict[str, tuple[dict, float]] = {}
+        for update, recorded in zip(islice(self.entries, start, None), islice(self.recorded, start, None)):
+            latest[update["id"]] = (update, recorded)
+
+        now = time.monotonic()
+        return [_aged(update, (now - recorded) * 1000) for update, recorded in latest.values()]
+
+
+def _aged(update: dict, elapsed_ms: float) -> dict:
+    """ Copy of a recorded update, older by `elapsed_ms`. The entry itself is left alone, since the broadcast shares it """
+
+    if not isinstance(update.get("age"), (int, float)):
+        return update
+    return {**update, "age": update["age"] + elapsed_ms}
+
+
+tag_journal = TagJournal()
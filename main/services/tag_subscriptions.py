@@ -0,0 +1,37 @@
+import uuid
+from collections import Counter
+
+
+class TagSubscriptions:
+    """ How many open dashboards are subscribed to each tag, so the poller can favour tags someone is watching """
+
+    def __init__(self):
+        self.counts: Counter[uuid.UUID] = Counter()
+
+    def add(self, external_ids: set[str]):
+        for external_id in _parse_ids(external_ids):
+            self.counts[external_id] += 1
+
+    def remove(self, external_ids: set[str]):
+        for external_id in _parse_ids(external_ids):
+            self.counts[external_id] -= 1
+            if self.counts[external_id] <= 0:
+                del self.counts[external_id]
+
+    def __contains__(self, external_id: uuid.UUID) -> bool:
+        return external_id in self.counts
+
+
+def _parse_ids(external_ids: set[str]) -> list[uuid.UUID]:
+    """ Parse the tag ids sent by a client, skipping any that aren't UUIDs """
+
+    parsed = []
+    for external_id in external_ids:
+        try:
+            parsed.append(uuid.UUID(str(external_id)))
+        except ValueError:
+            pass
+    return parsed
+
+
+tag_subscriptions = TagSubscriptions()
@@ -0,0 +1,57 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Device, Tag, AlarmConfig, ActivatedAlarm, Dashboard, DashboardWidget
+from .services.tag_encoder import tag_encoder
+from .services.alarm_engine import alarm_engine
+from .services.alarm_counter import alarm_counter
+from .services.config_version import config_version
+from .services.address_quarantine import address_quarantine
+
+
+@receiver(post_delete, sender=Tag)
+def forget_deleted_tag(sender, instance: Tag, **kwargs):
+    tag_encoder.forget(instance.id)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def recheck_quarantined_addresses(sender, instance: Tag, **kwargs):
+    address_quarantine.forget_tag(instance)
+
+
+@receiver(post_delete, sender=Device)
+def forget_deleted_device(sender, instance: Device, **kwargs):
+    address_quarantine.forget_device(instance.id)
+
+
+@receiver(post_save, sender=AlarmConfig)
+@receiver(post_delete, sender=AlarmConfig)
+def invalidate_alarm_engine(sender, instance: AlarmConfig, **kwargs):
+    alarm_engine.invalidate()
+    alarm_counter.invalidate() # The threat level may have changed
+
+
+@receiver(post_save, sender=ActivatedAlarm)
+def count_saved_alarm(sender, instance: ActivatedAlarm, **kwargs):
+    if alarm_counter.apply([instance]):
+        alarm_counter.broadcast()
+
+
+@receiver(post_delete, sender=ActivatedAlarm)
+def count_deleted_alarm(sender, instance: ActivatedAlarm, **kwargs):
+    if alarm_counter.discard(instance.id):
+        alarm_counter.broadcast()
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=AlarmConfig)
+@receiver(post_delete, sender=AlarmConfig)
+@receiver(post_save, sender=Dashboard)
+@receiver(post_delete, sender=Dashboard)
+@receiver(post_save, sender=DashboardWidget)
+@receiver(post_delete, sender=DashboardWidget)
+def bump_config_version(sender, instance, **kwargs):
+    config_version.changed()
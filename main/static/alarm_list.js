@@ -1,62 +1,102 @@
 import { requestServer, refreshData, serverCache } from "./global.js";
-/** @import { ActivatedAlarmObject } from "./types.js" */
-
-/** 
- * Populate table with ActivatedAlarm objects from the server 
- */
-async function loadAlarms() {
-    const activeTbody = document.querySelector('#active-alarms-table tbody');
-    const resolvedTbody = document.querySelector('#resolved-alarms-table tbody');
-
-    requestServer('/api/activated-alarms/', 'GET', null, /** @param {ActivatedAlarmObject[]} data */ (data) => {
-        activeTbody.innerHTML = '';
-        resolvedTbody.innerHTML = '';
-        data.forEach(alarm => {
-            const row = createAlarmRow(alarm);
-            const body = alarm.is_active ? activeTbody : resolvedTbody;
-            body.appendChild(row);
-        });
-    });
-}
+/** @import { ActivatedAlarmObject, ActivatedAlarmPage } from "./types.js" */
 
 /**
- * Create a table row from the given alarm
- * @param {ActivatedAlarmObject} alarm 
+ * A table of alarms loaded one page at a time from `/api/activated-alarms/`
  */
-function createAlarmRow(alarm) {
-    const alarmConfig = serverCache.alarms[alarm.config];
-    const tag = serverCache.tags[alarmConfig.tag];
-
-    const tr = document.createElement('tr');
-    tr.className = `row-${alarmConfig.threat_level}`;
-
-    const time = new Date(alarm.timestamp).toLocaleString();
-    const timeHeard = alarm.acknowledged ? new Date(alarm.acknowledged_at).toLocaleString() : "";
-    //const timeResolved = alarm.is_active ? "" : new Date(alarm.resolved_at).toLocaleString();
-    //const status = alarm.is_active ? "ACTIVE" : "Resolved";
-
-    tr.appendChild(td({"low": "🔔 Low", "high": "⚠️ High", "crit": "‼️ Critical"}[alarmConfig.threat_level], "threat-level"));
-    tr.appendChild(td(time));
-    tr.appendChild(td(tag.alias, null, tag.description));
-
-    const messageTd = document.createElement('td');
-    messageTd.textContent = alarmConfig.message + " ";
-    tr.appendChild(messageTd);
-
-    const actionTd = document.createElement('td');
-    if (alarm.acknowledged) {
-        tr.appendChild(td(`Heard by ${alarm.acknowledged_by_username || 'Unknown'}`, "user", `Heard at ${timeHeard}`))
-    } 
-    else {
-        const btn = document.createElement('button');
-        btn.className = "form-button ack-btn";
-        btn.textContent = "Acknowledge";
-        btn.addEventListener('click', () => acknowledge(alarm.id));
-        actionTd.appendChild(btn);
+class AlarmTable {
+    /**
+     * @param {HTMLTableElement} table 
+     * @param {HTMLButtonElement} moreButton Loads the next page
+     * @param {Object} filters Query parameters for the alarm list
+     */
+    constructor(table, moreButton, filters) {
+        this.tbody = table.querySelector('tbody');
+        this.moreButton = moreButton;
+        this.filters = filters;
+
+        /** @type {string | null} URL of the next page */
+        this.next = null;
+
+        /** @type {Set<number>} Ids of the checked unacknowledged alarms */
+        this.selected = new Set();
+
+        this.moreButton.addEventListener('click', () => this.loadMore());
+    }
+
+    /**
+     * Clear the table and load the first page
+     */
+    reload() {
+        this.tbody.innerHTML = '';
+        this.selected.clear();
+        this.next = null;
+        requestServer('/api/activated-alarms/', 'GET', this.filters, (data) => this.addPage(data));
     }
 
-    tr.appendChild(actionTd);
-    return tr;
+    loadMore() {
+        if (this.next)
+            requestServer(this.next, 'GET', null, (data) => this.addPage(data));
+    }
+
+    /**
+     * @param {ActivatedAlarmPage} page 
+     */
+    addPage(page) {
+        page.results.forEach(alarm => this.tbody.appendChild(this.createRow(alarm)));
+        this.next = page.next;
+        this.moreButton.style.display = page.next ? '' : 'none';
+    }
+
+    /**
+     * Create a table row from the given alarm
+     * @param {ActivatedAlarmObject} alarm 
+     */
+    createRow(alarm) {
+        const alarmConfig = serverCache.alarms[alarm.config];
+        const tag = serverCache.tags[alarmConfig.tag];
+
+        const tr = document.createElement('tr');
+        tr.className = `row-${alarmConfig.threat_level}`;
+
+        const time = new Date(alarm.timestamp).toLocaleString();
+        const timeHeard = alarm.acknowledged ? new Date(alarm.acknowledged_at).toLocaleString() : "";
+
+        const selectTd = document.createElement('td');
+        if (!alarm.acknowledged) {
+            const checkbox = document.createElement('input');
+            checkbox.type = 'checkbox';
+            checkbox.addEventListener('change', () => {
+                if (checkbox.checked) this.selected.add(alarm.id);
+                else this.selected.delete(alarm.id);
+            });
+            selectTd.appendChild(checkbox);
+        }
+        tr.appendChild(selectTd);
+
+        tr.appendChild(td({"low": "🔔 Low", "high": "⚠️ High", "crit": "‼️ Critical"}[alarmConfig.threat_level], "threat-level"));
+        tr.appendChild(td(time));
+        tr.appendChild(td(tag.alias, null, tag.description));
+
+        const messageTd = document.createElement('td');
+        messageTd.textContent = alarmConfig.message + " ";
+        tr.appendChild(messageTd);
+
+        const actionTd = document.createElement('td');
+        if (alarm.acknowledged) {
+            tr.appendChild(td(`Heard by ${alarm.acknowledged_by_username || 'Unknown'}`, "user", `Heard at ${timeHeard}`))
+        } 
+        else {
+            const btn = document.createElement('button');
+            btn.className = "form-button ack-btn";
+            btn.textContent = "Acknowledge";
+            btn.addEventListener('click', () => acknowledge(alarm.id));
+            actionTd.appendChild(btn);
+        }
+
+        tr.appendChild(actionTd);
+        return tr;
+    }
 }
 
 /**
@@ -73,10 +113,48 @@ function td(text, className, title) {
     return cell;
 }
 
+const activeTable = new AlarmTable(
+    document.getElementById('active-alarms-table'),
+    document.getElementById('active-alarms-more'),
+    { is_active: true },
+);
+const resolvedTable = new AlarmTable(
+    document.getElementById('resolved-alarms-table'),
+    document.getElementById('resolved-alarms-more'),
+    { is_active: false },
+);
+
+function loadAlarms() {
+    activeTable.reload();
+    resolvedTable.reload();
+}
+
 function acknowledge(id) {
     requestServer(`/api/activated-alarms/${id}/acknowledge/`, 'POST', null, () => loadAlarms());
 }
 
+/**
+ * Acknowledge every checked alarm in a single request
+ */
+function acknowledgeSelected() {
+    const ids = [...activeTable.selected, ...resolvedTable.selected];
+    if (ids.length === 0)
+        return;
+    requestServer('/api/activated-alarms/acknowledge/', 'POST', { ids: ids }, () => loadAlarms());
+}
+
+/**
+ * Acknowledge every active alarm, including ones on pages not loaded yet
+ */
+function acknowledgeAllActive() {
+    if (!confirm("Acknowledge all active alarms?"))
+        return;
+    requestServer('/api/activated-alarms/acknowledge/?is_active=true', 'POST', { all: true }, () => loadAlarms());
+}
+
+document.getElementById('ack-selected').addEventListener('click', acknowledgeSelected);
+document.getElementById('ack-all').addEventListener('click', acknowledgeAllActive);
+
 await refreshData();
 loadAlarms();
-//setInterval(loadAlarms, 5000);
\ No newline at end of file
+//setInterval(loadAlarms, 5000);
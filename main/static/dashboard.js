@@ -1,9 +1,9 @@
 import { WidgetRegistry } from "./widgets.js";
 import { TagListener } from "./tag_listener.js";
 import { GridStack } from 'https://cdn.jsdelivr.net/npm/gridstack@12.3.3/+esm'
-import { refreshData, requestServer, serverCache } from "./global.js";
+import { refreshData, requestServer, serverCache, cacheBootstrap, cacheTags } from "./global.js";
 import { Inspector } from "./inspector.js";
-/** @import { DashboardWidgetInfoObject, DashboardConfigObject, DashboardObject } from "./types.js" */
+/** @import { DashboardWidgetInfoObject, DashboardConfigObject, DashboardObject, DashboardBootstrapObject } from "./types.js" */
 /** @import { Widget } from "./widgets.js" */
 
 /**
@@ -31,11 +31,9 @@ export class Dashboard {
 
         /** @type {Inspector} */
         this.tagForm = new Inspector(document.getElementById('tag-form'));
-        this.tagForm.inspectTag();
 
         /** @type {Inspector} */
         this.alarmForm = new Inspector(document.getElementById('alarm-form'));
-        this.alarmForm.inspectAlarm();
 
         /** @type {DashboardObject} */
         this.config = null;
@@ -192,7 +190,7 @@ export class Dashboard {
         console.log("Widgets:", widgetData);
 
         // Add widgets to the gridstack grid
-        widgetData.forEach(wData => this.createWidget(wData.widget_type, serverCache.tags[wData.tag], wData.config));
+        widgetData.forEach(wData => this.createWidget(wData.widget_type, serverCache.tags[wData.tag], wData.config, wData.external_id));
     }
 
     /**
@@ -200,8 +198,9 @@ export class Dashboard {
      * @param {string} typeName 
      * @param {TagObject} tag 
      * @param {Object} config 
+     * @param {string} [externalId] The UUID of the saved widget this is, if any
      */
-    createWidget(typeName, tag, config) {
+    createWidget(typeName, tag, config, externalId = null) {
         // Copy widget contents from the palette populated by Django
         const palette = document.getElementById('palette');
         const gridPaletteElem = palette.querySelector(`[data-type="${typeName}"]`);
@@ -214,6 +213,7 @@ export class Dashboard {
         if(widgetClass) {
             // Create widget class instance
             const newWidget = new widgetClass(gridElem, config, tag);
+            newWidget.externalId = externalId;
 
             // Create gridstack item
             this.canvasGridStack.makeWidget(gridElem, {
@@ -231,6 +231,14 @@ export class Dashboard {
         }
     }
 
+    /**
+     * Rebuild the tag and alarm forms from {@link serverCache}
+     */
+    _setupForms() {
+        this.tagForm.inspectTag();
+        this.alarmForm.inspectAlarm();
+    }
+
     /**
      * Enable or disable edit mode
      * @param {boolean} flag
@@ -250,6 +258,13 @@ export class Dashboard {
             
             this.canvasGridStack.setStatic(false); // Enable Drag/Drop
 
+            // The page loads only what the dashboard uses, the editor needs every alarm and device. Tags are searched for
+            if(!serverCache.complete) {
+                refreshData({ tags: false }).then(loaded => {
+                    if(loaded) this._setupForms();
+                });
+            }
+
             this._getWidgets().forEach(widget => {
                 widget.clear();
                 widget.setAlarm(null); //TODO add to clear()?
@@ -323,17 +338,22 @@ export class Dashboard {
      */
     async load(alias) {
         try {
-            const [metaResp, widgetResp] = await Promise.all([
-                fetch(`/api/dashboards/${alias}`),
-                fetch(`/api/dashboard-widgets/?dashboard=${alias}`)
-            ]);
+            // One request for everything, which the browser revalidates with its ETag
+            const response = await fetch(`/api/dashboards/${alias}/bootstrap/`);
+            if(!response.ok)
+                throw new Error(response.statusText);
+
+            /** @type {DashboardBootstrapObject} */
+            const data = await response.json();
+            cacheBootstrap(data);
+            this._setupForms();
 
             /** @type {DashboardWidgetInfoObject[]} */
-            const widgets = await widgetResp.json();
+            const widgets = data.widgets;
 
             /** @type {DashboardObject} */
-            const meta = await metaResp.json();
-            this.config = { alias: alias, title: meta.title, description: meta.description, column_count: meta.column_count };
+            const meta = data.dashboard;
+            this.config = { alias: alias, title: meta.title, description: meta.description, column_count: meta.column_count, version: meta.version };
 
             // Set up recieved info
             await this.setupWidgets(widgets, this.config.column_count);
@@ -370,8 +390,12 @@ export class Dashboard {
         formData.append('title', config.title);
         formData.append('description', config.description);
         formData.append('column_count', config.column_count);
+        formData.append('version', config.version);
         formData.append('widgets', JSON.stringify(config.widgets));
 
+        // Widgets in the order they were sent, to match up the ids the server replies with
+        const widgets = this._getWidgets();
+
         // Get image data
         const imageBlob = await this._getPreview(); //TODO only do if widgets changed? Would need a better dirty flag system
         if (imageBlob) formData.append('preview_image', imageBlob, 'preview.jpg');
@@ -379,6 +403,8 @@ export class Dashboard {
         requestServer(`/api/dashboards/${this.config.alias}/save-data/`, 'POST', formData, (data) => {
             this.isDirty = false;
             this.config.alias = data.new_alias;
+            this.config.version = data.version;
+            widgets.forEach((widget, i) => widget.externalId = data.widgets[i]);
             const titleElem = document.getElementById('dashboard-title');
             titleElem.innerText = this.config.title;
             titleElem.title = this.config.description;
@@ -417,7 +443,12 @@ export class Dashboard {
             /** @type {DashboardConfigObject} */
             const config = JSON.parse(text);
             const confirm = window.confirm(`Replace all widgets with ${config.widgets.length} new widgets?`)
-            if(confirm) this.setupWidgets(config.widgets, config.column_count);
+            if(!confirm)
+                return;
+
+            // The widgets may use tags that this dashboard doesn't
+            await cacheTags(config.widgets.map(w => w.tag));
+            this.setupWidgets(config.widgets, config.column_count);
         } 
         catch (err) {
             alert("Error importing configuration: " + err.message);
@@ -430,6 +461,7 @@ export class Dashboard {
     _getFullConfig() {
         return { ...this.config,
             widgets: this._getWidgets().map(widget => ({ //TODO widget method or nah?
+                external_id: widget.externalId,
                 tag: widget.tag?.external_id || null,
                 widget_type: widget.gridElem.dataset.type,
                 config: widget.config
@@ -517,7 +549,5 @@ document.querySelectorAll('.tab-buttons button').forEach(btn => {
     });
 });
 
-await refreshData();
-
 const alias = document.getElementById('dashboard-container').dataset.alias; // Set by Django
 var dashboard = new Dashboard(alias);
\ No newline at end of file
@@ -1,3 +1,4 @@
+/** @import { AlarmCountsObject } from "./types.js" */
 import { requestServer } from "./global.js";
 
 /**
@@ -13,19 +14,47 @@ function createDashboard() {
     });
 }
 
-function checkAlarms() {
-    requestServer('/api/activated-alarms/active_count/', 'GET', null, (data) => {
-        const badge = document.getElementById('alarm-badge');
-        if (data.count > 0) {
-            badge.textContent = data.count;
-            badge.style.display = 'inline-block';
-        } 
-        else {
-            badge.style.display = 'none';
+/**
+ * Show the number of active, unacknowledged alarms on the badge
+ * @param {number} count 
+ */
+function setAlarmCount(count) {
+    const badge = document.getElementById('alarm-badge');
+    if (count > 0) {
+        badge.textContent = count;
+        badge.style.display = 'inline-block';
+    } 
+    else {
+        badge.style.display = 'none';
+    }
+}
+
+/**
+ * Keep the alarm badge up to date with counts pushed by the server, reconnecting if the stream drops
+ */
+function watchAlarms() {
+    const protocol = window.location.protocol === "https:" ? "wss://" : "ws://";
+    const socket = new WebSocket(`${protocol}${window.location.host}/ws/dashboard/`);
+
+    socket.onopen = () => {
+        socket.send(JSON.stringify({ type: "subscribe_alarm_counts" }));
+    };
+
+    socket.onmessage = (e) => {
+        const payload = JSON.parse(e.data);
+
+        // main.consumers.alarm_counts
+        if (payload.type === "alarm_counts") {
+            /** @type {AlarmCountsObject} */
+            const counts = payload.data;
+            setAlarmCount(counts.count);
         }
-    });
+    };
+
+    socket.onclose = () => {
+        setTimeout(watchAlarms, 2000);
+    };
 }
-checkAlarms();
-//setInterval(checkAlarms, 10000);
+watchAlarms();
 
-document.getElementById("create-dashboard").onclick = createDashboard;
\ No newline at end of file
+document.getElementById("create-dashboard").onclick = createDashboard;
@@ -1,4 +1,4 @@
-/** @import { ServerCacheObject, TagObject, AlarmConfigObject } from "./types.js" */
+/** @import { ServerCacheObject, TagObject, AlarmConfigObject, DashboardBootstrapObject } from "./types.js" */
 
 /** 
  * Collection of object metadata from the server
@@ -10,37 +10,40 @@ export const serverCache = {
     devices: [],
     tagOptions: [],
     alarmOptions: [],
+    complete: false,
 }
 
 /**
  * Requests an update for {@link serverCache}
  * 
  * Called on page load or when an alarm or tag is created
+ * @param {{ tags?: boolean }} [options] Pass `tags: false` to keep the cached tags, for pages that search for tags instead of listing them all
  */
-export async function refreshData() { //TODO options?
+export async function refreshData({ tags = true } = {}) {
     try {
         // Fetch Tags and Devices in parallel
         const [tagsResp, alarmsResp, devicesResp, tagOptions, alarmOptions] = await Promise.all([
-            fetch('/api/tags/'),
+            tags ? fetch('/api/tags/') : null,
             fetch('/api/alarms/'),
             fetch('/api/devices/'),
             fetch('/api/tag-options/'),
             fetch('/api/alarm-options/')
         ]);
 
-        /** @type {TagObject[]} */
-        const tagList = await tagsResp.json();
         /** @type {AlarmConfigObject[]} */
         const alarmList = await alarmsResp.json();
-
-        const tagMap = Object.fromEntries(tagList.map(tag => [tag.external_id, tag]));
         const alarmMap = Object.fromEntries(alarmList.map(alarm => [alarm.external_id, alarm]));
 
-        serverCache.tags = tagMap
+        if(tagsResp) {
+            /** @type {TagObject[]} */
+            const tagList = await tagsResp.json();
+            serverCache.tags = Object.fromEntries(tagList.map(tag => [tag.external_id, tag]));
+        }
         serverCache.alarms = alarmMap
         serverCache.devices = await devicesResp.json();
         serverCache.tagOptions = await tagOptions.json();
         serverCache.alarmOptions = await alarmOptions.json();
+        serverCache.complete = true;
         console.log("Data loaded:", serverCache);
         return true;
     } 
@@ -52,6 +55,36 @@ export async function refreshData() { //TODO options?
     }
 }
 
+/**
+ * Fills {@link serverCache} from a dashboard bootstrap response, which only has the tags and alarms the dashboard uses.
+ * Call {@link refreshData} before anything needs the rest
+ * @param {DashboardBootstrapObject} data 
+ */
+export function cacheBootstrap(data) {
+    serverCache.tags = Object.fromEntries(data.tags.map(tag => [tag.external_id, tag]));
+    serverCache.alarms = Object.fromEntries(data.alarms.map(alarm => [alarm.external_id, alarm]));
+    serverCache.devices = data.devices;
+    serverCache.tagOptions = data.tag_options;
+    serverCache.alarmOptions = data.alarm_options;
+    serverCache.complete = false;
+    console.log("Dashboard data loaded:", serverCache);
+}
+
+/**
+ * Makes sure the given tags are in {@link serverCache}, fetching any that aren't with one request
+ * @param {string[]} ids Tag external ids
+ * @returns {Promise<boolean>} False if the request failed
+ */
+export async function cacheTags(ids) {
+    const missing = [...new Set(ids)].filter(id => id && !serverCache.tags[id]);
+    if(missing.length === 0)
+        return true;
+
+    return requestServer('/api/tags/', 'GET', { ids: missing.join(",") }, (/** @type {TagObject[]} */ tags) => {
+        tags.forEach(tag => serverCache.tags[tag.external_id] = tag);
+    });
+}
+
 /**
  * Get the value of a cookie by name
  * @param {string} name 
@@ -1,5 +1,5 @@
-import { serverCache, requestServer } from "./global.js";
-/** @import { InspectorFieldDefinition, ChoiceObject, DataType, TagObject, ChannelType, InspectorDataType, AlarmConfigObject } from "./types.js" */
+import { serverCache, requestServer, cacheTags } from "./global.js";
+/** @import { InspectorFieldDefinition, ChoiceObject, DataType, TagObject, ChannelType, InspectorDataType, AlarmConfigObject, TagPage } from "./types.js" */
 /** @import { Widget } from "./widgets.js" */
 /** @import { Dashboard } from "./dashboard.js" */
 
@@ -7,6 +7,9 @@ import { serverCache, requestServer } from "./global.js";
  * Manages a form to edit widgets and dashboards, or create tags and alarms
  */
 export class Inspector {
+    /** How many tags a tag search shows */
+    static tagSearchPageSize = 50;
+
     /**
      * @param {HTMLElement} container 
      */
@@ -112,6 +115,8 @@ export class Inspector {
         // Delegate rendering strategy
         if (def.type === "select")
             inputObj = this._createSelect(def.options, currentValue);
+        else if (def.type === "tag")
+            inputObj = this._createTagSearch(currentValue, def.filters);
         else if (def.type === "enum")
             inputObj = this._createEnum(currentValue, onChange);
         else
@@ -163,6 +168,87 @@ export class Inspector {
         };
     }
 
+    /**
+     * A search box with a dropdown of the matching tags, which are searched for on the server
+     * since there may be too many to list
+     * @param {string | null} currentValue The external id of the selected tag
+     * @param {Object} [filters] Extra `/api/tags/` query parameters, like `channel` or `data_type`
+     */
+    _createTagSearch(currentValue, filters) {
+        const element = document.createElement("div");
+
+        const input = document.createElement("input");
+        input.type = "search";
+        input.placeholder = "Search tags";
+        input.classList.add("form-input");
+
+        const selectObj = this._createSelect([], currentValue);
+        const select = selectObj.element;
+        element.append(input, select);
+
+        /**
+         * Replace the options with the given tags, keeping the selected one
+         * @param {TagObject[]} tags 
+         */
+        const setOptions = (tags) => {
+            const value = select.value;
+            const selected = select.selectedIndex > 0 ? select.options[select.selectedIndex] : null;
+
+            select.length = 1; // Keep the default option
+            if(selected && !tags.some(tag => tag.external_id === value))
+                select.appendChild(selected);
+
+            tags.forEach(tag => {
+                const el = document.createElement('option');
+                el.value = tag.external_id;
+                el.text = Inspector.getTagLabel(tag);
+                select.appendChild(el);
+            });
+            select.value = value;
+        };
+
+        let searchCount = 0;
+        const search = () => {
+            const count = ++searchCount;
+            const params = { ...filters, q: input.value.trim(), page_size: Inspector.tagSearchPageSize };
+
+            requestServer('/api/tags/', 'GET', params, (/** @type {TagPage} */ data) => {
+                if(count !== searchCount)
+                    return; // A newer search was sent
+
+                data.results.forEach(tag => serverCache.tags[tag.external_id] = tag);
+                setOptions(data.results);
+            });
+        };
+
+        // Wait for typing to pause before searching
+        let timer = null;
+        input.addEventListener("input", () => {
+            clearTimeout(timer);
+            timer = setTimeout(search, 250);
+        });
+        input.addEventListener("change", (e) => e.stopPropagation()); // Only the dropdown changes the value
+
+        // Show the current tag before the first results arrive
+        if(currentValue) {
+            const el = document.createElement('option');
+            el.value = currentValue;
+            el.text = serverCache.tags[currentValue] ? Inspector.getTagLabel(serverCache.tags[currentValue]) : currentValue;
+            select.appendChild(el);
+            select.value = currentValue;
+            cacheTags([currentValue]).then(() => {
+                if(serverCache.tags[currentValue])
+                    el.text = Inspector.getTagLabel(serverCache.tags[currentValue]);
+            });
+        }
+        search();
+
+        return {
+            element: element,
+            getValue: selectObj.getValue
+        };
+    }
+
     /**
      * 
      * @param {string} type 
@@ -332,13 +418,9 @@ export class Inspector {
             }
 
             // Create dropdown with tags that are compatible with this widget
-            const compatibleTags = Object.values(serverCache.tags).filter(tag => {
-                return widgetClass.allowedTypes.includes(tag.data_type) 
-                    && widgetClass.allowedChannels.includes(tag.channel);
-            });
-            const tagOptions = compatibleTags.map(tag => ({ value: tag.external_id, label: Inspector.getTagLabel(tag) }));
+            const compatible = { data_type: widgetClass.allowedTypes.join(","), channel: widgetClass.allowedChannels.join(",") };
 
-            this.addField({ label: "Control Tag", type: "select", options: tagOptions }, widget.tag?.external_id, (newID) => {
+            this.addField({ label: "Control Tag", type: "tag", filters: compatible }, widget.tag?.external_id, (newID) => {
                 widget.tag = serverCache.tags[newID];
                 widget.applyConfig();
                 createTagTypedFields(newID); // Update the tag based fields
@@ -388,8 +470,7 @@ export class Inspector {
         this.clear();
         const tagSelectSection = this.addSection();
 
-        const tagOptions = Object.values(serverCache.tags).map(tag => ({ value: tag.external_id, label: Inspector.getTagLabel(tag) }));
-        this.addField({ label: "Tag", type: "select", options: tagOptions }, tag?.external_id, (tagID) => {
+        this.addField({ label: "Tag", type: "tag" }, tag?.external_id, (tagID) => {
             this.inspectTag(serverCache.tags[tagID])
         }, tagSelectSection);
 
@@ -559,13 +640,17 @@ export class Inspector {
             
             const tag = serverCache.tags[tagID];
 
-            if(!tag)
+            if(!tag) {
+                // The alarm's tag may not be loaded yet
+                if(tagID)
+                    cacheTags([tagID]).then(() => serverCache.tags[tagID] && onTagChanged(tagID));
                 return;
+            }
 
             // Show choices for trigger operator
             let operatorChoices = serverCache.alarmOptions.operator_choices;
             if(tag.data_type === "bool") 
-                operatorChoices = operatorChoices.filter(t => { return t.value === "equals" });
+                operatorChoices = operatorChoices.filter(t => { return ["equals", "stuck"].includes(t.value) });
 
             // Create an input with the same value type as the selected tag
             const fieldType = Inspector.getFieldType(tag.data_type);
@@ -581,8 +666,7 @@ export class Inspector {
         }
         onTagChanged(alarm?.tag);
 
-        const tagOptions = Object.values(serverCache.tags).map(tag => ({ value: tag.external_id, label: Inspector.getTagLabel(tag)}));
-        const tag = this.addField({ label: "Control Tag", type: "select", options: tagOptions }, alarm?.tag, onTagChanged, alarmSection);
+        const tag = this.addField({ label: "Control Tag", type: "tag" }, alarm?.tag, onTagChanged, alarmSection);
 
         alarmSection.appendChild(operatorContainer);
         alarmSection.appendChild(triggerContainer);
@@ -595,6 +679,24 @@ export class Inspector {
             alarm?.message, null, alarmSection
         );
 
+        const debounceSection = this.addSection();
+        const triggerSustain = this.addField({ label: "Trigger Delay (Seconds)", type: "int",
+                description: "How long the trigger condition must hold before the alarm activates" },
+            alarm?.trigger_sustain || 0, null, debounceSection
+        );
+        const clearSustain = this.addField({ label: "Clear Delay (Seconds)", type: "int",
+                description: "How long the value must stay back to normal before the alarm resolves" },
+            alarm?.clear_sustain || 0, null, debounceSection
+        );
+        const deadband = this.addField({ label: "Deadband", type: "number",
+                description: "How far back past the trigger value the tag must go before the alarm resolves" },
+            alarm?.deadband || 0, null, debounceSection
+        );
+        const windowField = this.addField({ label: "Window (Seconds)", type: "int",
+                description: "Time span used by the rate of change, average and stuck value operators" },
+            alarm?.window ?? 60, null, debounceSection
+        );
+
         /**
          * Post alarm configuration to the server
          * @param {boolean} create If alarm should be created or updated
@@ -607,6 +709,10 @@ export class Inspector {
                 operator: getOperatorValue(), // Use latest getValue
                 trigger_value: getTriggerValue(), // Use latest getValue
                 message: message.getValue(),
+                trigger_sustain: triggerSustain.getValue(),
+                clear_sustain: clearSustain.getValue(),
+                deadband: deadband.getValue(),
+                window: windowField.getValue(),
             }
             
             if(create) {
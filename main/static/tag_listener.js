@@ -1,4 +1,3 @@
-import { requestServer } from "./global.js";
 /** @import { TagValueObject } from "./types.js" */
 /** @import { Widget } from "./widgets.js" */
 
@@ -15,6 +14,12 @@ export class TagListener {
 
         /** @type {number} */
         this.retryInterval = 2000;
+
+        /** @type {string | null} The server journal epoch the sequence number belongs to */
+        this.epoch = null;
+
+        /** @type {number | null} The last update sequence number recieved */
+        this.seq = null;
     }
 
     /**
@@ -29,14 +34,12 @@ export class TagListener {
 
     /**
      * Establishes a WebSocket connection to the dashboard tag stream, retrying if failed.
-     * Fetches current values before subscribing to live updates
+     * The server replies to the subscription with current values, or only the missed ones when reconnecting
      */
     async connect() {
         const protocol = window.location.protocol === "https:" ? "wss://" : "ws://";
         const path = `${protocol}${window.location.host}/ws/dashboard/`;
 
-        await this.fetchAll();
-
         this.socket = new WebSocket(path);
 
         this.socket.onopen = () => {
@@ -50,6 +53,8 @@ export class TagListener {
 
             // main.consumers.tag_update
             if (payload.type === "tag_update") {
+                this.epoch = payload.epoch;
+                this.seq = payload.seq;
                 payload.data.forEach(update => {
                     this.onUpdate(update);
                 });
@@ -64,21 +69,7 @@ export class TagListener {
     }
 
     /**
-     * Fetches the current values for all registered tags and sends them to widgets
-     */
-    async fetchAll() {
-        const tagIds = Object.keys(this.tagMap).join(",");
-        if (tagIds.length === 0) return;
-
-        await requestServer('/api/values/', 'GET', { tags: tagIds }, (response) => {
-            response.forEach(update => {
-                this.onUpdate(update);
-            });
-        });
-    }
-
-    /**
-     * Sends a list of tags to the server to recieve updates for
+     * Sends a list of tags to the server to recieve updates for, along with the last seen sequence number
      */
     sendSubscription() {
         if (!this.socket || this.socket.readyState !== WebSocket.OPEN)
@@ -89,7 +80,9 @@ export class TagListener {
 
         this.socket.send(JSON.stringify({
             type: "subscribe",
-            tags: tagIds
+            tags: tagIds,
+            epoch: this.epoch,
+            seq: this.seq,
         }));
     }
 
@@ -113,6 +106,8 @@ export class TagListener {
     clear() {
         console.log("WebSocket stopped");
         this.tagMap = {};
+        this.epoch = null;
+        this.seq = null;
         if(this.socket) {
             this.socket.onclose = null;
             this.socket.close();
@@ -3,7 +3,7 @@
 /** @typedef {'low' | 'high' | 'crit'} ThreatLevel */
 /** @typedef {'tcp' | 'udp' | 'rtu'} DeviceProtocol */
 /** @typedef {'big' | 'little'} DeviceWordOrder */
-/** @typedef {'bool' | 'int' | 'number' | 'text' | 'color' | 'select' | 'enum'} InspectorDataType */
+/** @typedef {'bool' | 'int' | 'number' | 'text' | 'color' | 'select' | 'enum' | 'tag'} InspectorDataType */
 
 /**
  * Object for storing an html option
@@ -15,11 +15,12 @@
 /**
  * Object for storting server data
  * @typedef {Object} ServerCacheObject
- * @property {Record<string, TagObject>} tags All tags registered on the server
+ * @property {Record<string, TagObject>} tags Tags loaded so far. All of them after `refreshData()`, otherwise those a page has used or searched for
  * @property {Record<string, AlarmConfigObject>} alarms All alarms registered on the server
  * @property {DeviceListObject[]} devices All devices registered on the server
  * @property {TagOptionsObject} tagOptions Choice collection for tag attributes
  * @property {AlarmOptionsObject} alarmOptions Choice collection for alarm attributes
+ * @property {boolean} complete False while only the tags, alarms and devices of a dashboard are loaded
 */
 
 /** 
@@ -31,6 +32,7 @@
  * @property {string} label The text to display above the input
  * @property {string} [description] The html title to apply to the label
  * @property {ChoiceObject[]} [options]
+ * @property {Object} [filters] Query parameters to narrow a tag search with
  */
 
 /**
@@ -39,16 +41,21 @@
  * @property {string} tag The UUID of the tag
  * @property {string} external_id The UUID of the alarm config
  * @property {*} trigger_value Value to compare with
- * @property {'equals' | 'greater_than' | 'less_than'} operator Operator for comparing tag value with trigger_value
+ * @property {'equals' | 'greater_than' | 'less_than' | 'rate_of_change' | 'average_above' | 'average_below' | 'stuck'} operator Operator for comparing tag value with trigger_value
  * @property {boolean} enabled If the alarm is triggerable
  * @property {string} alias Name of the alarm config
  * @property {string} message Message that subscribers to the alarm recieve
  * @property {ThreatLevel} threat_level The urgency of the alarm
+ * @property {number} trigger_sustain Seconds the trigger condition must hold before activating
+ * @property {number} clear_sustain Seconds the value must stay normal before resolving
+ * @property {number} deadband How far back past the trigger value the tag must go to resolve
+ * @property {number} window Seconds covered by the rate of change, average and stuck value operators
  */
 
 /**
  * Object recieved from `api.serializers.ActivatedAlarmSerializer` through `/api/activated-alarms/`
  * @typedef {Object} ActivatedAlarmObject
+ * @property {number} id The database id of the alarm
  * @property {string} config The UUID of this activation's alarm config
  * @property {boolean} is_active If the alarm is on
  * @property {boolean} acknowledged If the alarm has been marked as heard by a user
@@ -58,6 +65,14 @@
  * @property {string} resolved_at The time the alarm was resolved, if any
  */
 
+/**
+ * A page of alarms from `/api/activated-alarms/`, newest first
+ * @typedef {Object} ActivatedAlarmPage
+ * @property {string | null} next URL of the next page, if any
+ * @property {string | null} previous URL of the previous page, if any
+ * @property {ActivatedAlarmObject[]} results
+ */
+
 /**
  * Object recieved from `api.serializers.TagValueSerializer` through `/api/values/tags=${tag1},${tag2}...`
  * @typedef {Object} TagValueObject
@@ -65,6 +80,15 @@
  * @property {string|number|boolean} value The current value of the tag
  * @property {number} age The age in seconds of the tag value
  * @property {string} alarm The alarm ID associated with this tag, if active
+ * @property {number} [seq] The journal sequence number of this update, if sent by the poller
+ */
+
+/**
+ * Alarm counts pushed by `main.consumers.DashboardConsumer` or fetched from `/api/activated-alarms/active_count/`
+ * @typedef {Object} AlarmCountsObject
+ * @property {number} count Number of active, unacknowledged alarms
+ * @property {{ [threat_level: string]: number }} active Active alarms by threat level
+ * @property {{ [threat_level: string]: number }} unacknowledged Unacknowledged alarms by threat level
  */
 
 /**
@@ -115,16 +139,39 @@
  * @property {string} title The display name
  * @property {string} description User given description of dashboard, if any
  * @property {number} column_count The number of columns in the GridStack grid
+ * @property {number} version Incremented on every save, sent back when saving to detect concurrent edits
  */
 
 /**  
  * Object recieved from `api.serializers.DashboardWidgetSerializer` through `/api/dashboard-widgets/?dashboard=${alias}`
  * @typedef {Object} DashboardWidgetInfoObject
+ * @property {string | null} external_id The UUID of the widget, null for widgets not saved yet
  * @property {string} tag The UUID of the tag assigned to the widget
  * @property {string} widget_type The name of the widget class (mapped in `WidgetRegistry` in `widgets.js`)
  * @property {Object} config The config object of the widget (position, scale, default and custom fields)
  */
 
+/**
+ * Page of tags recieved from `/api/tags/` when given a `cursor`, `page_size` or search query
+ * @typedef {Object} TagPage
+ * @property {string | null} next URL of the next page
+ * @property {string | null} previous URL of the previous page
+ * @property {TagObject[]} results
+ */
+
+/**
+ * Object recieved from `api.views.DashboardViewSet.bootstrap` through `/api/dashboards/${alias}/bootstrap/`
+ * @typedef {Object} DashboardBootstrapObject
+ * @property {DashboardObject} dashboard
+ * @property {DashboardWidgetInfoObject[]} widgets
+ * @property {TagObject[]} tags The tags the widgets use, without their values
+ * @property {AlarmConfigObject[]} alarms The alarm configs of those tags
+ * @property {DeviceListObject[]} devices All devices registered on the server
+ * @property {TagOptionsObject} tag_options
+ * @property {AlarmOptionsObject} alarm_options
+ * @property {{ protocols: { value: string, label: string }[], word_orders: { value: string, label: string }[] }} device_options
+ */
+
 /**
  * Object used in `api.views.DashboardViewSet.save_data` through `/api/dashboards/${alias}/save-data/`
  * @typedef {DashboardObject & { widgets: DashboardWidgetInfoObject[] }} DashboardConfigObject
@@ -59,6 +59,9 @@ export class Widget {
         /**@type {TagObject} meta describing the tag this widget should use */
         this.tag = tag;
 
+        /** @type {string | null} The UUID of the saved widget, null until first saved */
+        this.externalId = null;
+
         /** The entries for defaultFields, customFields, etc. Fields not provided are set to default */
         /** @type {Object} */
         this.config = config;
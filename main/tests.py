@@ -1,3 +1,1280 @@
-from django.test import TestCase
+import io
+import os
+import json
+import time
+import random
+import asyncio
+import tempfile
+from unittest import mock
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from datetime import timedelta
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, IntegrityError
+from django.utils import timezone
+from django.core import mail
+from django.contrib.auth import get_user_model
+from rest_framework.test import APIClient
+from .models import Device, Tag, TagHistoryEntry, TagWriteRequest, AlarmConfig, ActivatedAlarm, AlarmSubscription, Dashboard, DashboardWidget
+from .consumers import DashboardConsumer
+from pymodbus.constants import ExcCodes
+from .management.commands.benchmark import poller_benchmark, create_plant, SimulatedPlant, _percentile
+from .management.commands.base_simulator import AddressFault, FaultProfile
+from .services.scan_scheduler import ScanScheduler, Priority
+from .services.address_quarantine import address_quarantine
+from .services.tag_journal import TagJournal
+from .services.tag_encoder import TagValueEncoder, tag_encoder
+from .services.alarm_engine import RollingWindow, AlarmEngine
+from .services.metrics import Metric, MetricsRegistry
+from .services.cycle_trace import CycleTracer, CycleTrace
+from .services.notify_alarms import AlarmNotifier, EmailBackend
+from .services.alarm_counter import AlarmCounter, alarm_counter
+from .services.io_csv import DeviceImporter, TagImporter, AlarmConfigImporter, DeviceExporter, TagExporter, AlarmConfigExporter
+from .api.serializers import TagValueSerializer
+from .services import poll_devices
+from .services.poll_devices import _build_read_blocks
 
-# Create your tests here.
+
+class PollerBenchmarkTests(TransactionTestCase):
+    """ Short runs of the poller benchmark, to catch regressions that break polling or its measurements """
+
+    def run_benchmark(self, **options):
+        options = {
+            "devices": 2, "tags_per_device": 20, "duration": 1.0, "interval": 0.1,
+            "data_type": Tag.DataTypeChoices.FLOAT32, "base_port": 15120, **options,
+        }
+        return poller_benchmark(**options)
+
+    def test_reads_every_tag(self):
+        result = self.run_benchmark()
+
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["cycles"], 1)
+        self.assertGreater(result["tags_per_second"], 0)
+        self.assertFalse(Tag.objects.filter(current_value__isnull=True).exists())
+        self.assertGreater(TagHistoryEntry.objects.count(), 0)
+
+    def test_result_is_json(self):
+        result = self.run_benchmark(devices=1, tags_per_device=5, duration=0.5, data_type=Tag.DataTypeChoices.INT32, base_port=15140)
+
+        data = json.loads(json.dumps(result))
+        self.assertEqual(data["tags"], 5)
+        self.assertLessEqual(data["cycle_ms"]["p50"], data["cycle_ms"]["max"])
+        self.assertIn("update_tags", data["phase_ms_per_cycle"])
+
+    def test_device_metrics(self):
+        self.run_benchmark(devices=1, tags_per_device=5, duration=0.5, base_port=15200)
+
+        # Series are looked up once per device and shared with the registry
+        metrics = poll_devices.device_metrics["bench-0"]
+        self.assertIs(metrics.request("read_holding_registers"), poll_devices.request_seconds.labels("bench-0", "read_holding_registers"))
+        self.assertIs(metrics.block_seconds, poll_devices.block_seconds.labels("bench-0"))
+        self.assertGreater(sum(metrics.block_seconds.counts), 0)
+
+class FaultInjectionTests(TransactionTestCase):
+    """ The poller against simulated devices that answer slowly or with exceptions """
+
+    def run_benchmark(self, faults: FaultProfile, base_port: int):
+        return poller_benchmark(
+            devices=1, tags_per_device=10, duration=1.0, interval=0.1,
+            data_type=Tag.DataTypeChoices.FLOAT32, base_port=base_port, faults=faults,
+        )
+
+    def test_latency(self):
+        result = self.run_benchmark(FaultProfile(latency=0.03, distribution="fixed"), 15160)
+
+        self.assertEqual(result["errors"], 0)
+        self.assertGreaterEqual(result["phase_ms_per_cycle"]["request"], 30)
+
+    def test_exception_range(self):
+        result = self.run_benchmark(FaultProfile(exceptions=[AddressFault.parse("3:4-5:2")]), 15180)
+
+        # Only the tag on the rejected addresses goes unread, and once it's quarantined the rest read without errors
+        self.assertGreater(result["errors"], 0)
+        self.assertLess(result["errors"], result["cycles"])
+        self.assertGreater(result["tags_per_second"], 0)
+        self.assertEqual(list(Tag.objects.filter(current_value__isnull=True).values_list("address", flat=True)), [4])
+
+
+class DeviceCapabilityTests(TransactionTestCase):
+    """ Probing simulated devices for their limits, and polling within them """
+
+    def poll(self, devices: list[Device], tags: list[Tag], faults: FaultProfile = None):
+        async def run():
+            await poll_devices.poll_devices(poll_interval=0.1, duration=1.0)
+            poll_devices.close_clients()
+
+        with SimulatedPlant(devices, tags, 0.1, faults) as plant:
+            asyncio.run(run())
+        return plant
+
+    def test_probe(self):
+        devices, tags = create_plant(1, 10, Tag.DataTypeChoices.FLOAT32, 15220)
+        Device.objects.update(probe_capabilities=True, supports_mask_write=False)
+
+        # Reads reaching register 100 are refused as too long
+        self.poll(devices, tags, FaultProfile(exceptions=[AddressFault.parse("3:100-199:3")]))
+
+        device = Device.objects.get()
+        self.assertFalse(device.probe_capabilities)
+        self.assertIsNotNone(device.capabilities_probed_at)
+        self.assertEqual(device.max_read_registers, 100)
+        self.assertTrue(device.supports_mask_write)
+        self.assertGreater(device.max_concurrent_requests, 1)
+
+    def test_probe_sparse_map(self):
+        devices, tags = create_plant(1, 10, Tag.DataTypeChoices.FLOAT32, 15230)
+        Device.objects.update(probe_capabilities=True, max_read_registers=60)
+
+        # Registers from 100 on don't exist, which says nothing about the longest read
+        self.poll(devices, tags, FaultProfile(exceptions=[AddressFault.parse("3:100-199:2")]))
+
+        device = Device.objects.get()
+        self.assertFalse(device.probe_capabilities)
+        self.assertEqual(device.max_read_registers, 60)
+
+    def test_bit_write_without_mask_write(self):
+        devices, tags = create_plant(1, 10, Tag.DataTypeChoices.INT16, 15240)
+        Device.objects.update(supports_mask_write=False, max_concurrent_requests=2)
+        bit = Tag.objects.create(device=devices[0], alias="bit", channel=Tag.ChannelChoices.HOLDING_REGISTER, data_type=Tag.DataTypeChoices.BOOL, address=50, bit_index=3)
+        TagWriteRequest.objects.create(tag=bit, value=True)
+
+        plant = self.poll(Device.objects.all(), tags)
+
+        self.assertEqual(plant.stores[devices[0].alias].getValues(3, 50, 1), [0b1000])
+        self.assertTrue(Tag.objects.get(id=bit.id).current_value)
+        self.assertFalse(Tag.objects.filter(current_value__isnull=True).exists())
+
+
+class AddressFaultTests(SimpleTestCase):
+    def test_parse(self):
+        fault = AddressFault.parse("3:100-119:2")
+        self.assertEqual((fault.function_code, fault.start, fault.end, fault.code), (3, 100, 119, ExcCodes.ILLEGAL_ADDRESS))
+        self.assertIsNone(AddressFault.parse("*:7:4").function_code)
+        with self.assertRaises(ValueError):
+            AddressFault.parse("3:100")
+
+    def test_matches_overlapping_requests(self):
+        fault = AddressFault.parse("3:100-119:2")
+        self.assertTrue(fault.matches(3, 90, 11))
+        self.assertTrue(fault.matches(3, 119, 5))
+        self.assertFalse(fault.matches(3, 90, 10))
+        self.assertFalse(fault.matches(3, 120, 5))
+        self.assertFalse(fault.matches(4, 100, 1))
+
+
+class AddressQuarantineTests(TransactionTestCase):
+    def setUp(self):
+        address_quarantine.clear()
+        self.addCleanup(address_quarantine.clear)
+        self.plc, self.other = Device.objects.create(alias="plc"), Device.objects.create(alias="other")
+        self.tags = [Tag.objects.create(device=self.plc, alias=f"tag{a}", channel="hr", data_type="int16", address=a) for a in [4, 8, 20]]
+
+    def quarantine(self, device: Device, start: int, end: int, tags: list[Tag] = ()):
+        address_quarantine.add(device, 1, "hr", start, end, tags)
+
+    def ranges(self, device: Device) -> list[tuple[int, int]]:
+        return sorted((start, end) for _, _, start, end in address_quarantine.ranges.get(device.id, {}))
+
+    def test_tag_changes_drop_their_ranges(self):
+        with self.assertLogs("main.services.address_quarantine", "WARNING"):
+            self.quarantine(self.plc, 4, 5, self.tags[:1])
+            self.quarantine(self.plc, 10, 20)
+            self.quarantine(self.other, 4, 5)
+        self.assertEqual(self.ranges(self.plc), [(4, 5), (10, 20)])
+        self.assertEqual(address_quarantine.active(self.plc), {(1, "hr"): [(4, 5), (10, 20)]})
+
+        # Saving a tag elsewhere leaves them alone
+        self.tags[1].description = "Unrelated"
+        self.tags[1].save()
+        self.assertEqual(self.ranges(self.plc), [(4, 5), (10, 20)])
+
+        # A moved tag frees its old range
+        self.tags[0].address = 40
+        self.tags[0].save()
+        self.assertEqual(self.ranges(self.plc), [(10, 20)])
+
+        # The gap next to a deleted tag
+        self.tags[2].delete()
+        self.assertEqual(self.ranges(self.plc), [])
+        self.assertEqual(self.ranges(self.other), [(4, 5)])
+
+        self.other.delete()
+        self.assertEqual(address_quarantine.counts(), [(("plc",), 0)])
+
+
+class ReadBlockTests(SimpleTestCase):
+    def tags(self, *addresses: int) -> list[Tag]:
+        return [Tag(alias=f"tag{a}", channel=Tag.ChannelChoices.HOLDING_REGISTER, data_type=Tag.DataTypeChoices.INT16, address=a) for a in addresses]
+
+    def test_merges_nearby_tags(self):
+        blocks = _build_read_blocks(self.tags(0, 1, 5, 20))
+        self.assertEqual([(b.start, b.length) for b in blocks], [(0, 6), (20, 1)])
+
+    def test_splits_around_holes(self):
+        holes = {(1, Tag.ChannelChoices.HOLDING_REGISTER): [(2, 4)]}
+        blocks = _build_read_blocks(self.tags(0, 1, 5, 6), holes=holes)
+        self.assertEqual([(b.start, b.length) for b in blocks], [(0, 2), (5, 2)])
+
+
+class ScanSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = ScanScheduler()
+        self.tags = [Tag(id=i, alias=f"tag{i}") for i in range(4)]
+        priorities = {0: Priority.ALARM, 1: Priority.ALARM, 2: Priority.HISTORY, 3: Priority.HISTORY}
+        self.scheduler.priority = lambda tag: priorities[tag.id]
+
+    def read(self, budget: float, costs: dict[Priority, float], last_scan: dict[Priority, float]) -> list[int]:
+        for priority in Priority:
+            if group := self.scheduler.groups.get(("plc", priority)):
+                group.cost = costs[priority]
+                group.last_scan = last_scan[priority]
+        return [tag.id for tag in self.scheduler.select("plc", self.tags, 0.1, budget)]
+
+    def test_reads_everything_within_budget(self):
+        self.assertEqual(self.read(0.1, {}, {}), [0, 1, 2, 3])
+        now = time.monotonic()
+        self.assertEqual(self.read(0.1, {Priority.ALARM: 0.02, Priority.HISTORY: 0.05}, {Priority.ALARM: now, Priority.HISTORY: now}), [0, 1, 2, 3])
+
+    def test_sheds_lower_priority_until_due(self):
+        self.read(0.1, {}, {})
+        now = time.monotonic()
+        costs = {Priority.ALARM: 0.05, Priority.HISTORY: 0.2}
+
+        self.assertEqual(self.read(0.1, costs, {Priority.ALARM: now, Priority.HISTORY: now}), [0, 1])
+        self.assertIn("history tags on 1 device(s) (plc)", self.scheduler.report())
+
+        # History may stretch to 10 intervals, so one more missed cycle would be too late
+        self.assertCountEqual(self.read(0.1, costs, {Priority.ALARM: now, Priority.HISTORY: now - 0.95}), [0, 1, 2, 3])
+        self.assertIsNone(self.scheduler.report())
+
+
+class PercentileTests(SimpleTestCase):
+    def test_nearest_rank(self):
+        values = [float(v) for v in range(1, 101)]
+        self.assertEqual(_percentile(values, 50), 50)
+        self.assertEqual(_percentile(values, 99), 99)
+        self.assertEqual(_percentile(values, 100), 100)
+        self.assertEqual(_percentile([3.0], 90), 3.0)
+        self.assertIsNone(_percentile([], 50))
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        requests = registry.counter("requests_total", "Requests sent")
+        depth = registry.gauge("queue_depth", "Queued \\ items\nper device", ["device"])
+        latency = registry.histogram("latency_seconds", "Request latency", ["device"], buckets=[0.1, 1])
+
+        requests.inc()
+        requests.inc(2)
+        depth.labels('plc "a"').set(4)
+        depth.labels("plc b").set(0.5)
+        for value in [0.05, 0.1, 0.5, 3]:
+            latency.labels("plc").observe(value)
+
+        self.assertEqual(registry.render(), "\n".join([
+            "# HELP requests_total Requests sent",
+            "# TYPE requests_total counter",
+            "requests_total 3",
+            "# HELP queue_depth Queued \\\\ items\\nper device",
+            "# TYPE queue_depth gauge",
+            'queue_depth{device="plc \\"a\\""} 4',
+            'queue_depth{device="plc b"} 0.5',
+            "# HELP latency_seconds Request latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{device="plc",le="0.1"} 2',
+            'latency_seconds_bucket{device="plc",le="1"} 3',
+            'latency_seconds_bucket{device="plc",le="+Inf"} 4',
+            'latency_seconds_sum{device="plc"} 3.65',
+            'latency_seconds_count{device="plc"} 4',
+        ]) + "\n")
+
+    def test_labels(self):
+        registry = MetricsRegistry()
+        depth = registry.gauge("queue_depth", "Queued items", ["device"])
+
+        self.assertIs(depth.labels("plc"), depth.labels("plc"))
+        with self.assertRaises(ValueError):
+            depth.labels("plc", "extra")
+        with self.assertRaises(ValueError):
+            registry.gauge("queue_depth", "Again")
+        with self.assertRaises(TypeError):
+            Metric("base", "Not a metric type")
+
+
+class CycleTracerTests(SimpleTestCase):
+    def run_cycles(self, tracer: CycleTracer, *durations: float):
+        async def run():
+            for duration in durations:
+                trace = tracer.start()
+                trace.start -= duration
+                trace.add("devices", trace.start, trace.start + duration / 2)
+                await tracer.finish(trace, poll_interval=0.5)
+
+        asyncio.run(run())
+
+    def test_report(self):
+        tracer = CycleTracer()
+        with tempfile.TemporaryDirectory() as directory, override_settings(POLL_TRACE_DIR=directory):
+            self.run_cycles(tracer, 0.1, 0.8, 0.2, 1.2)
+            files = os.listdir(directory)
+
+        self.assertEqual([trace.number for trace in tracer.slow], [2, 4])
+        self.assertEqual(len(files), 2)
+        self.assertTrue(tracer.report().startswith("2 of 4 poll cycles were slow, the slowest was cycle 4 at 1200."))
+
+        self.run_cycles(tracer, 0.1)
+        self.assertIsNone(tracer.report())
+
+    @override_settings(POLL_TRACE_SLOW_SECONDS=0.05)
+    def test_threshold(self):
+        tracer = CycleTracer()
+        self.run_cycles(tracer, 0.1)
+        self.assertIn("devices 50.0ms", tracer.report())
+
+
+class TagJournalTests(SimpleTestCase):
+    def test_replays_latest_update_per_tag(self):
+        journal = TagJournal()
+        seq = journal.record([{"id": "a", "value": 1, "age": 0}])
+        journal.record([{"id": "a", "value": 2, "age": 0}, {"id": "b", "value": 3, "age": 0}])
+
+        updates = journal.since(journal.epoch, seq)
+        self.assertEqual([(u["id"], u["value"]) for u in updates], [("a", 2), ("b", 3)])
+        self.assertEqual(journal.since(journal.epoch, journal.seq), [])
+
+    def test_needs_snapshot(self):
+        journal = TagJournal(max_entries=2)
+        journal.record([{"id": str(i), "age": 0} for i in range(3)])
+
+        self.assertIsNone(journal.since("other", 2))
+        self.assertIsNone(journal.since(journal.epoch, None))
+        self.assertIsNone(journal.since(journal.epoch, journal.seq + 1))
+        self.assertIsNone(journal.since(journal.epoch, 0)) # The first update was evicted
+        self.assertEqual(len(journal.since(journal.epoch, 1)), 2)
+
+    def test_ages_replayed_updates(self):
+        journal = TagJournal()
+        journal.record([{"id": "a", "age": 100}, {"id": "b", "age": "Infinity"}])
+        journal.recorded[0] -= 2
+
+        a, b = journal.since(journal.epoch, 0)
+        self.assertAlmostEqual(a["age"], 2100, delta=50)
+        self.assertEqual(b["age"], "Infinity")
+        self.assertEqual(journal.entries[0]["age"], 100)
+
+    @override_settings(POLL_JOURNAL_ENTRIES=3)
+    def test_size_setting(self):
+        journal = TagJournal()
+        journal.record([{"id": str(i), "value": i} for i in range(5)])
+
+        self.assertEqual(journal.first_seq, 3)
+        self.assertIsNone(journal.since(journal.epoch, 1))
+        self.assertEqual(len(journal.since(journal.epoch, 2)), 3)
+
+
+class ConsumerClient:
+    """ A websocket client of DashboardConsumer, driven through the ASGI interface """
+
+    def __init__(self):
+        self.communicator = ApplicationCommunicator(DashboardConsumer.as_asgi(), {
+            "type": "websocket", "path": "/ws/dashboard/", "headers": [], "subprotocols": [],
+        })
+
+    async def connect(self):
+        await self.communicator.send_input({"type": "websocket.connect"})
+        message = await self.communicator.receive_output(timeout=5)
+        assert message["type"] == "websocket.accept", message
+
+    async def send(self, data: dict):
+        await self.communicator.send_input({"type": "websocket.receive", "text": json.dumps(data)})
+
+    async def receive(self) -> dict:
+        message = await self.communicator.receive_output(timeout=5)
+        return json.loads(message["text"])
+
+    async def receives_nothing(self) -> bool:
+        return await self.communicator.receive_nothing(timeout=0.2)
+
+    async def disconnect(self):
+        await self.communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await self.communicator.wait(timeout=5)
+
+
+class DashboardConsumerTests(TransactionTestCase):
+    def setUp(self):
+        alarm_counter.invalidate() # Counts loaded by other tests are stale after their rows were flushed
+        devices, self.tags = create_plant(1, 3, Tag.DataTypeChoices.INT16, 0)
+        self.ids = [str(tag.external_id) for tag in self.tags]
+
+    def subscribe(self, journal: TagJournal, epoch: str, seq: int, tags: list[str]) -> dict:
+        async def run():
+            client = ConsumerClient()
+            await client.connect()
+            await client.send({"type": "subscribe", "tags": tags, "epoch": epoch, "seq": seq})
+            message = await client.receive()
+            await client.disconnect()
+            return message
+
+        with mock.patch("main.consumers.tag_journal", journal):
+            return asyncio.run(run())
+
+    def test_resume_sends_missed_updates_of_subscribed_tags(self):
+        journal = TagJournal()
+        seq = journal.record([{"id": self.ids[0], "value": 1, "age": 0}])
+        journal.record([{"id": tag_id, "value": 2, "age": 0} for tag_id in self.ids])
+
+        message = self.subscribe(journal, journal.epoch, seq, self.ids[:2])
+
+        self.assertEqual(message["seq"], journal.seq)
+        self.assertEqual([(u["id"], u["value"]) for u in message["data"]], [(self.ids[0], 2), (self.ids[1], 2)])
+
+    def test_other_epoch_gets_snapshot(self):
+        journal = TagJournal()
+        journal.record([{"id": self.ids[0], "value": 1, "age": 0}])
+
+        message = self.subscribe(journal, "previous-process", 1, self.ids[:2])
+
+        self.assertEqual(message["epoch"], journal.epoch)
+        self.assertCountEqual([u["id"] for u in message["data"]], self.ids[:2])
+        self.assertTrue(all(u["value"] is None for u in message["data"]))
+
+    def test_malformed_position_gets_snapshot(self):
+        journal = TagJournal()
+        journal.record([{"id": self.ids[0], "value": 1, "age": 0}])
+
+        for epoch, seq in [(journal.epoch, "0"), (journal.epoch, True), (None, 0), (["epoch"], 0)]:
+            message = self.subscribe(journal, epoch, seq, self.ids[:1])
+            self.assertEqual([(u["id"], u["value"]) for u in message["data"]], [(self.ids[0], None)])
+
+    def test_alarm_count_broadcasts(self):
+        async def run():
+            subscribed, other = ConsumerClient(), ConsumerClient()
+            await subscribed.connect()
+            await other.connect()
+
+            await subscribed.send({"type": "subscribe_alarm_counts"})
+            snapshot = await subscribed.receive()
+
+            counts = {"count": 1, "active": {"high": 1}, "unacknowledged": {"high": 1}}
+            await get_channel_layer().group_send("poller_broadcast", {"type": "alarm_counts", "counts": counts})
+            update = await subscribed.receive()
+            other_received_nothing = await other.receives_nothing()
+
+            # Both are still connected and handling messages
+            await get_channel_layer().group_send("poller_broadcast", {"type": "tag_update", "updates": [], "seq": 0})
+            await subscribed.disconnect()
+            await other.disconnect()
+            return snapshot, update, other_received_nothing
+
+        snapshot, update, other_received_nothing = asyncio.run(run())
+
+        self.assertEqual(snapshot, {"type": "alarm_counts", "data": {"count": 0, "active": {}, "unacknowledged": {}}})
+        self.assertEqual(update["data"]["active"], {"high": 1})
+        self.assertTrue(other_received_nothing)
+
+    def test_evicted_position_gets_snapshot(self):
+        journal = TagJournal(max_entries=2)
+        journal.record([{"id": tag_id, "value": 2, "age": 0} for tag_id in self.ids])
+
+        message = self.subscribe(journal, journal.epoch, 0, self.ids)
+
+        self.assertCountEqual([u["id"] for u in message["data"]], self.ids)
+        self.assertTrue(all(u["value"] is None for u in message["data"]))
+
+
+class TagValueEncoderTests(TransactionTestCase):
+    def setUp(self):
+        devices, self.tags = create_plant(1, 2, Tag.DataTypeChoices.INT16, 0)
+        self.tags[0].current_value = 5
+        self.tags[0].last_updated = timezone.now() - timedelta(seconds=1)
+
+    def test_matches_serializer(self):
+        encoded = TagValueEncoder().encode(self.tags, {self.tags[0].id: "alarm-id"})
+        serialized = TagValueSerializer(self.tags, many=True).data
+
+        for data, expected in zip(encoded, serialized):
+            self.assertEqual({k: v for k, v in data.items() if k not in ["age", "alarm"]}, {k: v for k, v in expected.items() if k not in ["age", "alarm"]})
+        self.assertAlmostEqual(encoded[0]["age"], serialized[0]["age"], delta=100)
+        self.assertEqual(encoded[1]["age"], "Infinity")
+        self.assertEqual([data["alarm"] for data in encoded], ["alarm-id", None])
+
+    def test_caches_ids_until_deleted(self):
+        tag = self.tags[0]
+        tag_encoder.encode([tag], {})
+        self.assertEqual(tag_encoder.external_ids[tag.id], str(tag.external_id))
+
+        tag_id = tag.id
+        tag.delete()
+        self.assertNotIn(tag_id, tag_encoder.external_ids)
+
+
+class RollingWindowTests(SimpleTestCase):
+    def test_short_window(self):
+        window = RollingWindow(1.0)
+        for i in range(10):
+            window.add(i * 0.25, float(i))
+
+        # Samples from 1.25s on are within a second of 2.25s
+        self.assertEqual(window.average, 7.0)
+        self.assertEqual(window.rate, 4.0)
+
+    def test_long_window_keeps_its_whole_span(self):
+        window = RollingWindow(3600, max_buckets=1000)
+        for i in range(2 * 3600 * 4):
+            window.add(i * 0.25, i * 0.25)
+
+        # An hour of a ramp of 1 per second, polled 4 times a second
+        self.assertLessEqual(len(window.buckets), 1001)
+        self.assertAlmostEqual(window.rate, 1.0, places=6)
+        self.assertAlmostEqual(window.average, 7199.75 - 1800, delta=4)
+
+    def test_unchanged_for(self):
+        window = RollingWindow(10)
+        window.add(0, "on")
+        window.add(5, "on")
+        self.assertEqual(window.unchanged_for(7), 7)
+        self.assertIsNone(window.average)
+
+
+class AlarmEngineTests(TransactionTestCase):
+    """ The engine, with a clock the tests move forward """
+
+    def setUp(self):
+        self.engine = AlarmEngine()
+        self.clock = 0.0
+        for patcher in [
+            mock.patch("main.signals.alarm_engine", self.engine),
+            mock.patch("main.services.alarm_engine.time", mock.Mock(monotonic=lambda: self.clock)),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        device = Device.objects.create(alias="plc")
+        self.tag = Tag.objects.create(device=device, alias="level", channel="hr", data_type="int16", address=0)
+
+    def config(self, trigger_value=10, operator="greater_than", alias="high", threat_level="high", **kwargs) -> AlarmConfig:
+        return AlarmConfig.objects.create(tag=self.tag, alias=alias, trigger_value=trigger_value, operator=operator, threat_level=threat_level, **kwargs)
+
+    def update(self, value=None, after=0.0, changed=True):
+        """ Move the clock forward, then run an update with the tag changed to `value`, or with no changes """
+        self.clock += after
+        if not changed:
+            return self.engine.update([])
+        self.tag.current_value = value
+        return self.engine.update([self.tag], [self.tag])
+
+    def read(self, after=1.0, times=1):
+        """ Poll the tag without its value changing, which only windowed configs see """
+        for _ in range(times):
+            self.clock += after
+            self.engine.update([], [self.tag])
+
+    def active(self) -> str | None:
+        """ The alias of the tag's active alarm, checked against the database """
+        alias = self.engine.active[self.tag.id].config.alias if self.tag.id in self.engine.active else None
+        saved = list(ActivatedAlarm.objects.filter(is_active=True).values_list("config__alias", flat=True))
+        self.assertEqual(saved, [alias] if alias else [])
+        return alias
+
+    def test_activation(self):
+        config = self.config()
+
+        changes = self.update(50)
+        self.assertEqual([a.config for a in changes.activated], [config])
+        self.assertEqual(changes.tags, [self.tag])
+        self.assertEqual(self.engine.alarm_ids, {self.tag.id: str(config.external_id)})
+        self.assertEqual(self.active(), "high")
+
+        # Still in alarm, nothing to write
+        changes = self.update(60)
+        self.assertEqual((changes.activated, changes.deactivated, changes.tags), ([], [], []))
+
+        changes = self.update(5)
+        self.assertEqual(len(changes.deactivated), 1)
+        self.assertEqual(self.engine.alarm_ids, {})
+        self.assertIsNone(self.active())
+        self.assertIsNotNone(ActivatedAlarm.objects.get().resolved_at)
+
+    def test_highest_priority_wins(self):
+        self.config(10, alias="high", threat_level="high")
+        self.config(50, alias="critical", threat_level="crit")
+        self.config(20, alias="low", threat_level="low")
+
+        self.update(30)
+        self.assertEqual(self.active(), "high")
+        self.update(60)
+        self.assertEqual(self.active(), "critical")
+        self.update(30)
+        self.assertEqual(self.active(), "high")
+        self.assertEqual(ActivatedAlarm.objects.count(), 3)
+
+    def test_config_changes_reload_the_cache(self):
+        config = self.config()
+        self.update(50)
+        self.assertFalse(self.engine.is_stale)
+
+        config.trigger_value = 100
+        config.save()
+        self.assertTrue(self.engine.is_stale)
+        self.update(50)
+        self.assertIsNone(self.active())
+
+        self.config(40, alias="lower")
+        self.update(50)
+        self.assertEqual(self.active(), "lower")
+
+        config.delete()
+        self.assertTrue(self.engine.is_stale)
+        self.update(50)
+        self.assertEqual(self.active(), "lower")
+        self.assertEqual(list(self.engine.configs_by_tag), [self.tag.id])
+
+    def test_trigger_sustain(self):
+        self.config(trigger_sustain=timedelta(seconds=5))
+
+        # Too short to count
+        self.update(50)
+        self.update(5, after=3)
+        self.assertIsNone(self.active())
+        self.assertEqual(self.engine.pending, {})
+
+        # Held long enough without the value changing again
+        self.update(50, after=1)
+        self.update(after=4, changed=False)
+        self.assertIsNone(self.active())
+        self.assertIn(self.tag.id, self.engine.pending)
+        self.update(after=1.5, changed=False)
+        self.assertEqual(self.active(), "high")
+
+    def test_deadband_and_clear_sustain(self):
+        self.config(deadband=2, clear_sustain=timedelta(seconds=5))
+        self.update(11)
+        self.assertEqual(self.active(), "high")
+
+        # Back under the trigger, but not past the deadband
+        self.update(9, after=10)
+        self.assertEqual(self.engine.pending, {})
+
+        # Past the deadband, then back inside it before the clear sustain passes
+        self.update(8, after=1)
+        self.update(after=4, changed=False)
+        self.update(9, after=0.5)
+        self.assertEqual(self.active(), "high")
+
+        self.update(7, after=1)
+        self.update(after=5, changed=False)
+        self.assertIsNone(self.active())
+
+        below = AlarmConfig(trigger_value=10, operator="less_than", deadband=2).get_clear_predicate()
+        self.assertEqual([below(v) for v in [9, 11, 12]], [False, False, True])
+
+    def test_zero_sustain(self):
+        self.config()
+
+        self.update(11)
+        self.assertEqual(self.active(), "high")
+        self.update(10)
+        self.assertIsNone(self.active())
+        self.assertEqual(self.engine.pending, {})
+
+    def test_cycle_without_values(self):
+        self.assertEqual(self.update(changed=False).activated, [])
+
+        # A running sustain timer still resolves when nothing is read
+        self.config(trigger_sustain=timedelta(seconds=5))
+        self.update(50)
+        self.assertEqual(self.update(after=6, changed=False).tags, [self.tag])
+        self.assertEqual(self.active(), "high")
+        self.assertEqual(self.engine.pending, {})
+
+    def test_rate_of_change(self):
+        self.config(2, "rate_of_change", window=timedelta(seconds=10))
+
+        self.update(0)
+        self.update(10, after=1)
+        self.assertEqual(self.active(), "high")
+
+        # The rate is measured across the window, so it falls as the jump gets older
+        self.read(times=3)
+        self.assertEqual(self.active(), "high")
+        self.read()
+        self.assertIsNone(self.active())
+
+    def test_average(self):
+        self.config(50, "average_above", alias="above", window=timedelta(seconds=10))
+        self.config(20, "average_below", alias="below", window=timedelta(seconds=10))
+
+        self.update(40)
+        self.update(80, after=1)
+        self.assertEqual(self.active(), "above")
+
+        self.update(0, after=1)
+        self.read(times=2)
+        self.assertIsNone(self.active())
+        self.read(times=4)
+        self.assertEqual(self.active(), "below")
+
+        # Older samples leave the window
+        self.update(100, after=1)
+        self.read(times=10)
+        self.assertEqual(self.active(), "above")
+
+    def test_stuck(self):
+        # The window is the stuck duration, the trigger value isn't used
+        self.config(1000, "stuck", window=timedelta(seconds=5))
+
+        self.update(3)
+        self.read(after=3)
+        self.assertIsNone(self.active())
+        self.read(after=3)
+        self.assertEqual(self.active(), "high")
+
+        self.update(4, after=1)
+        self.assertIsNone(self.active())
+
+
+class AlarmNotifierTests(TransactionTestCase):
+    def setUp(self):
+        devices, tags = create_plant(1, 2, Tag.DataTypeChoices.INT16, 0)
+        self.configs = [
+            AlarmConfig.objects.create(tag=tag, alias=f"alarm-{i}", trigger_value=1, threat_level=AlarmConfig.ThreatLevelChoices.HIGH)
+            for i, tag in enumerate(tags)
+        ]
+        users = [get_user_model().objects.create(username=name, email=f"{name}@example.com") for name in ["ann", "bob"]]
+        AlarmSubscription.objects.create(user=users[0], alarm_config=self.configs[0])
+        AlarmSubscription.objects.create(user=users[0], alarm_config=self.configs[1])
+        AlarmSubscription.objects.create(user=users[1], alarm_config=self.configs[1])
+
+    def activate(self) -> list[ActivatedAlarm]:
+        return [ActivatedAlarm.objects.create(config=config, is_active=True) for config in self.configs]
+
+    def test_sends_one_digest_per_recipient(self):
+        notifier = AlarmNotifier(EmailBackend())
+        asyncio.run(notifier.dispatch(self.activate()))
+
+        subjects = {message.to[0]: message.subject for message in mail.outbox}
+        self.assertEqual(subjects, {"ann@example.com": "2 alarms activated", "bob@example.com": "[High] alarm-1"})
+        body = next(message.body for message in mail.outbox if message.to == ["ann@example.com"])
+        self.assertEqual([line.split(" - ")[0] for line in body.splitlines()], ["High: bench-0-tag-0", "High: bench-0-tag-1"])
+        self.assertTrue(all(config.last_notified for config in AlarmConfig.objects.all()))
+
+    def test_cooldown(self):
+        notifier = AlarmNotifier(EmailBackend())
+        asyncio.run(notifier.dispatch(self.activate()))
+        asyncio.run(notifier.dispatch(self.activate()))
+        self.assertEqual(len(mail.outbox), 2)
+
+        AlarmConfig.objects.update(notification_cooldown=timedelta(0))
+        notifier = AlarmNotifier(EmailBackend())
+        asyncio.run(notifier.dispatch(self.activate()))
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_batches_alarms_queued_together(self):
+        notifier = AlarmNotifier(EmailBackend(), batch_window=0.2)
+        alarms = self.activate()
+
+        async def run():
+            task = asyncio.create_task(notifier.run())
+            await asyncio.sleep(0.05)
+            for alarm in alarms:
+                notifier.notify([alarm])
+            await asyncio.sleep(0.5)
+            task.cancel()
+
+        asyncio.run(run())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertFalse(notifier.running)
+
+    def test_ignores_alarms_without_a_worker(self):
+        notifier = AlarmNotifier(EmailBackend(), max_queue=1)
+        with self.assertNoLogs("main.services.notify_alarms", "WARNING"):
+            notifier.notify(self.activate())
+        self.assertTrue(notifier.queue.empty())
+
+
+class ApiTestCase(TransactionTestCase):
+    """ Requests made by a logged in staff user """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username="admin", is_staff=True, is_superuser=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+class AlarmCountTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        alarm_counter.invalidate()
+        devices, tags = create_plant(1, 3, Tag.DataTypeChoices.INT16, 0)
+        levels = [AlarmConfig.ThreatLevelChoices.LOW, AlarmConfig.ThreatLevelChoices.HIGH, AlarmConfig.ThreatLevelChoices.HIGH]
+        configs = [AlarmConfig.objects.create(tag=tag, alias=f"alarm-{i}", trigger_value=1, threat_level=level) for i, (tag, level) in enumerate(zip(tags, levels))]
+        self.alarms = [ActivatedAlarm.objects.create(config=config, is_active=True) for config in configs]
+
+    def assertCountsMatchDatabase(self):
+        fresh = AlarmCounter()
+        self.assertEqual(alarm_counter.snapshot(), fresh.snapshot())
+
+    def test_apply(self):
+        self.assertEqual(alarm_counter.snapshot(), {"count": 3, "active": {"low": 1, "high": 2}, "unacknowledged": {"low": 1, "high": 2}})
+
+        alarm = self.alarms[1]
+        alarm.is_active = False
+        alarm.save()
+        self.assertEqual(alarm_counter.snapshot(), {"count": 2, "active": {"low": 1, "high": 1}, "unacknowledged": {"low": 1, "high": 2}})
+
+        alarm.acknowledged = True
+        alarm.save()
+        alarm.delete()
+        self.assertCountsMatchDatabase()
+
+    def test_acknowledge_ids(self):
+        alarm_counter.snapshot()
+        response = self.client.post("/api/activated-alarms/acknowledge/", {"ids": [self.alarms[0].id, self.alarms[1].id]}, format="json")
+
+        self.assertEqual(response.json(), {"acknowledged": 2})
+        self.assertEqual(alarm_counter.snapshot(), {"count": 1, "active": {"low": 1, "high": 2}, "unacknowledged": {"high": 1}})
+        self.assertCountsMatchDatabase()
+
+        response = self.client.post("/api/activated-alarms/acknowledge/", {"ids": ["x"]}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_acknowledge_filtered(self):
+        response = self.client.post("/api/activated-alarms/acknowledge/?threat_level=high", {"all": True}, format="json")
+
+        self.assertEqual(response.json(), {"acknowledged": 2})
+        self.assertEqual(self.client.get("/api/activated-alarms/active_count/").json()["unacknowledged"], {"low": 1})
+        self.assertCountsMatchDatabase()
+
+    def test_list_pages_and_filters(self):
+        page = self.client.get("/api/activated-alarms/?page_size=2").json()
+        self.assertEqual([a["id"] for a in page["results"]], [self.alarms[2].id, self.alarms[1].id])
+
+        page = self.client.get(page["next"]).json()
+        self.assertEqual([a["id"] for a in page["results"]], [self.alarms[0].id])
+        self.assertIsNone(page["next"])
+
+        page = self.client.get("/api/activated-alarms/?threat_level=low&is_active=true").json()
+        self.assertEqual([a["id"] for a in page["results"]], [self.alarms[0].id])
+        self.assertEqual(self.client.get("/api/activated-alarms/?is_active=maybe").status_code, 400)
+
+
+class TagOverlapTests(TransactionTestCase):
+    def setUp(self):
+        self.device = Device.objects.create(alias="plc")
+
+    def tag(self, address: int, data_type=Tag.DataTypeChoices.INT16, bit_index=0, save=False, **kwargs) -> Tag:
+        tag = Tag(device=self.device, alias=f"tag{address}", channel=Tag.ChannelChoices.HOLDING_REGISTER,
+            data_type=data_type, address=address, bit_index=bit_index, **kwargs)
+        if save:
+            tag.save()
+        return tag
+
+    def overlaps(self, a: Tag, b: Tag) -> bool:
+        if a.is_bit_indexed and b.is_bit_indexed and a.address == b.address and a.bit_index != b.bit_index:
+            return False
+        return a.address < b.address + b.get_read_count() and b.address < a.address + a.get_read_count()
+
+    def test_overlap_behind_a_longer_range(self):
+        saved = self.tag(12, save=True)
+        a = self.tag(9, Tag.DataTypeChoices.FLOAT64)
+        b = self.tag(10, Tag.DataTypeChoices.FLOAT64)
+
+        self.assertEqual(Tag.find_overlaps([a, b]), [saved, a])
+
+    def test_chained_overlaps(self):
+        # Each float64 reaches into the next, and all of them into the saved tag
+        saved = self.tag(3, save=True)
+        tags = [self.tag(address, Tag.DataTypeChoices.FLOAT64) for address in [0, 1, 2]]
+        self.assertEqual(Tag.find_overlaps(tags), [saved, tags[0], tags[0]])
+
+        # Each float64 only reaches into the next
+        tags = [self.tag(address, Tag.DataTypeChoices.FLOAT64) for address in [8, 11, 14, 17]]
+        self.assertEqual(Tag.find_overlaps(tags), [None, tags[0], tags[1], tags[2]])
+
+    def test_bit_indexed_tags(self):
+        saved = self.tag(5, Tag.DataTypeChoices.BOOL, bit_index=0, save=True)
+        tags = [
+            self.tag(5, Tag.DataTypeChoices.BOOL, bit_index=1),
+            self.tag(5, Tag.DataTypeChoices.BOOL, bit_index=0),
+            self.tag(6, Tag.DataTypeChoices.BOOL, bit_index=0),
+        ]
+        self.assertEqual(Tag.find_overlaps(tags), [None, saved, None])
+
+        # Reading several registers covers every bit of them
+        spanning = self.tag(6, Tag.DataTypeChoices.BOOL, bit_index=2, read_amount=2)
+        self.assertEqual(Tag.find_overlaps([self.tag(7, Tag.DataTypeChoices.BOOL, bit_index=3), spanning]), [spanning, None])
+
+    def test_matches_pairwise_check(self):
+        rng = random.Random(0)
+        saved = []
+        for address in rng.sample(range(60), 10):
+            tag = self.tag(address, rng.choice([Tag.DataTypeChoices.INT16, Tag.DataTypeChoices.FLOAT32]))
+            if not any(self.overlaps(tag, other) for other in saved):
+                tag.save()
+                saved.append(tag)
+
+        for _ in range(20):
+            tags = [self.tag(rng.randrange(60), rng.choice(Tag.DataTypeChoices.values), rng.randrange(16)) for _ in range(8)]
+            overlaps = Tag.find_overlaps(tags)
+
+            for tag, other in zip(tags, overlaps):
+                if other:
+                    self.assertTrue(self.overlaps(tag, other))
+            for i, tag in enumerate(tags):
+                for other in saved:
+                    if self.overlaps(tag, other):
+                        self.assertIsNotNone(overlaps[i])
+                for j in range(i):
+                    if self.overlaps(tag, tags[j]):
+                        self.assertTrue(overlaps[i] or overlaps[j])
+
+
+class TagImporterTests(TransactionTestCase):
+    def setUp(self):
+        Device.objects.create(alias="plc")
+
+    def run_import(self, *rows: str, **kwargs):
+        text = "device,alias,channel,data_type,address,external_id\n" + "\n".join(rows)
+        return TagImporter(io.StringIO(text), **kwargs).run()
+
+    def test_reports_invalid_rows(self):
+        with self.assertLogs("main.services.io_csv", "WARNING") as logs:
+            result = self.run_import(
+                "plc,a,hr,int16,0,",
+                "nowhere,b,hr,int16,1,",
+                "plc,c,hr,nonsense,2,",
+                "plc,,hr,int16,3,",
+            )
+
+        self.assertEqual(result.saved, 1)
+        self.assertEqual([error.line for error in result.errors], [3, 4, 5])
+        self.assertIn("Line 3: device: Unknown device 'nowhere'", "\n".join(logs.output))
+        self.assertIn("Line 4: data_type:", "\n".join(logs.output))
+
+    def test_upserts_by_external_id(self):
+        external_id = "6f1c2a8e-4b4d-4a55-9a43-0c5b8f3e2d17"
+        self.run_import(f"plc,a,hr,int16,0,{external_id}")
+        result = self.run_import(f"plc,renamed,hr,int16,5,{external_id}", "plc,b,hr,int16,1,", chunk_size=1)
+
+        self.assertEqual(result.saved, 2)
+        self.assertEqual(sorted(Tag.objects.values_list("alias", "address")), [("b", 1), ("renamed", 5)])
+
+    def test_reports_replaced_rows(self):
+        external_id = "6f1c2a8e-4b4d-4a55-9a43-0c5b8f3e2d17"
+        with self.assertLogs("main.services.io_csv", "WARNING") as logs:
+            result = self.run_import(f"plc,a,hr,int16,0,{external_id}", "plc,b,hr,int16,1,", f"plc,c,hr,int16,2,{external_id}")
+
+        self.assertEqual(result.saved, 2)
+        self.assertEqual([error.line for error in result.errors], [2])
+        self.assertIn("Line 2: external_id: Replaced by line 4, which has the same external_id", "\n".join(logs.output))
+        self.assertEqual(sorted(Tag.objects.values_list("alias", flat=True)), ["b", "c"])
+
+    def test_rejects_overlapping_rows(self):
+        self.run_import("plc,saved,hr,int16,12,")
+        with self.assertLogs("main.services.io_csv", "WARNING"):
+            result = self.run_import("plc,a,hr,float64,9,", "plc,b,hr,float64,10,", "plc,c,hr,int16,13,")
+
+        self.assertEqual([error.line for error in result.errors], [2, 3, 4])
+        self.assertEqual(list(Tag.objects.values_list("alias", flat=True)), ["saved"])
+
+
+class TagListTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        plc = Device.objects.create(alias="plc")
+        boiler = Device.objects.create(alias="boiler")
+        for address, (device, alias, description) in enumerate([
+            (plc, "Pump 1", ""), (plc, "pump 2", ""), (plc, "Valve", ""),
+            (boiler, "Tank level", "Next to the pump room"), (boiler, "Burner", ""),
+        ]):
+            Tag.objects.create(device=device, alias=alias, description=description, channel="hr", data_type="int16", address=address)
+
+    def list(self, **params) -> dict | list:
+        response = self.client.get("/api/tags/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_plain_list_without_paging_params(self):
+        self.assertEqual(len(self.list()), 5)
+
+    def test_pages(self):
+        aliases = []
+        page = self.list(page_size=2)
+        while True:
+            self.assertLessEqual(len(page["results"]), 2)
+            aliases += [tag["alias"] for tag in page["results"]]
+            if not page["next"]:
+                break
+            response = self.client.get(page["next"])
+            page = response.json()
+
+        self.assertEqual(aliases, ["Burner", "Pump 1", "pump 2", "Tank level", "Valve"])
+
+    def test_fields(self):
+        tags = self.list(fields="alias,device", device="boiler")
+        self.assertEqual(tags, [{"alias": "Tank level", "device": "boiler"}, {"alias": "Burner", "device": "boiler"}])
+
+        response = self.client.get("/api/tags/", {"fields": "alias,secret"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_search(self):
+        def search(query):
+            return [tag["alias"] for tag in self.list(q=query, fields="alias")["results"]]
+
+        # Short queries only match the start of aliases
+        self.assertEqual(search("pu"), ["Pump 1", "pump 2"])
+        self.assertEqual(search("ve"), [])
+        self.assertEqual(search("pump"), ["Pump 1", "pump 2", "Tank level"])
+        self.assertEqual(search("boil"), ["Burner", "Tank level"])
+
+    def test_filters(self):
+        tag = Tag.objects.get(alias="Valve")
+        self.assertEqual([t["alias"] for t in self.list(ids=str(tag.external_id))], ["Valve"])
+        self.assertEqual(len(self.list(channel="hr,ir", data_type="float32")), 0)
+        self.assertEqual(self.client.get("/api/tags/", {"ids": "nonsense"}).status_code, 400)
+
+
+class TagBulkTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        device = Device.objects.create(alias="plc")
+        self.saved = Tag.objects.create(device=device, alias="saved", channel="hr", data_type="int16", address=12)
+
+    def bulk(self, **items):
+        return self.client.post("/api/tags/bulk/", items, format="json")
+
+    def item(self, alias: str, address: int, data_type="float64") -> dict:
+        return {"device": "plc", "alias": alias, "channel": "hr", "data_type": data_type, "address": address}
+
+    def test_rejects_overlaps(self):
+        response = self.bulk(create=[self.item("a", 9), self.item("b", 10), self.item("c", 0)])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([bool(errors) for errors in response.data["create"]], [True, True, False])
+
+        response = self.bulk(create=[self.item("a", 0), self.item("b", 0)])
+        self.assertEqual(response.status_code, 400)
+
+        response = self.bulk(update=[{"external_id": str(self.saved.external_id), "data_type": "float64", "address": 10}], create=[self.item("a", 13, "int16")])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Tag.objects.count(), 1)
+
+    def test_reuses_deleted_location(self):
+        response = self.bulk(delete=[str(self.saved.external_id)], create=[self.item("a", 12, "int16")])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(Tag.objects.values_list("alias", "address")), [("a", 12)])
+
+
+class AlarmBulkTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        devices, self.tags = create_plant(1, 2, Tag.DataTypeChoices.INT16, 0)
+
+    def bulk(self, **items):
+        return self.client.post("/api/alarms/bulk/", items, format="json")
+
+    def item(self, alias: str, tag: Tag) -> dict:
+        return {"tag": str(tag.external_id), "alias": alias, "trigger_value": 1, "threat_level": "high"}
+
+    def test_duplicates_in_request(self):
+        response = self.bulk(create=[self.item("high", self.tags[0]), self.item("high", self.tags[1]), self.item("high", self.tags[0])])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["create"][:2], [{}, {}])
+        self.assertEqual(response.data["create"][2], {"alias": ["Same alias, tag as create[0] in this request"]})
+        self.assertFalse(AlarmConfig.objects.exists())
+
+        saved = AlarmConfig.objects.create(tag=self.tags[0], alias="saved", trigger_value=1, threat_level="high")
+        response = self.bulk(create=[{"alias": "bad"}, self.item("low", self.tags[0])], update=[{"external_id": str(saved.external_id), "alias": "low"}])
+        self.assertEqual(response.data["update"], [{"alias": ["Same alias, tag as create[1] in this request"]}])
+
+    def test_conflicts_while_writing(self):
+        # Such as a row saved by another request between validation and writing
+        alarm = AlarmConfig.objects.create(tag=self.tags[0], alias="a", trigger_value=1, threat_level="high")
+
+        with mock.patch.object(AlarmConfig.objects, "bulk_update", side_effect=IntegrityError("UNIQUE constraint failed: main_alarmconfig.alias")):
+            with self.assertLogs("main.api.views", "ERROR"):
+                response = self.bulk(update=[{"external_id": str(alarm.external_id), "alias": "b"}])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn("main_alarmconfig", json.dumps(response.data))
+
+
+class DashboardSaveTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        devices, self.tags = create_plant(1, 2, Tag.DataTypeChoices.INT16, 0)
+        self.dashboard = Dashboard.objects.create(owner=self.user, title="Plant")
+        self.led = DashboardWidget.objects.create(dashboard=self.dashboard, tag=self.tags[0], widget_type="led", config={"x": 0})
+        self.label = DashboardWidget.objects.create(dashboard=self.dashboard, widget_type="label", config={"text": "Pump"})
+
+    def save(self, **data):
+        return self.client.post(f"/api/dashboards/{self.dashboard.alias}/save-data/", data, format="json")
+
+    def item(self, widget: DashboardWidget, **changes) -> dict:
+        return {
+            "external_id": str(widget.external_id), "tag": str(widget.tag.external_id) if widget.tag else None,
+            "widget_type": widget.widget_type, "config": widget.config, **changes,
+        }
+
+    def test_writes_only_differences(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.save(version=0, widgets=[
+                self.item(self.led),
+                {"tag": str(self.tags[1].external_id), "widget_type": "switch", "config": {}},
+            ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["version"], 1)
+        self.assertEqual(response.data["widgets"][0], str(self.led.external_id))
+
+        widget_writes = [q["sql"].split()[0] for q in queries.captured_queries if "main_dashboardwidget" in q["sql"] and not q["sql"].startswith("SELECT")]
+        self.assertEqual(widget_writes, ["DELETE", "INSERT"])
+        self.assertEqual(
+            sorted(str(w.external_id) for w in self.dashboard.widgets.all()),
+            sorted(response.data["widgets"]),
+        )
+
+        response = self.save(widgets=[self.item(self.led, config={"x": 1})])
+        self.assertEqual(response.data["version"], 2)
+        self.assertEqual(DashboardWidget.objects.get(pk=self.led.pk).config, {"x": 1})
+        self.assertEqual(self.dashboard.widgets.count(), 1)
+
+    def test_ids_from_other_dashboards_are_not_reused(self):
+        other = Dashboard.objects.create(owner=self.user, title="Other")
+        foreign = DashboardWidget.objects.create(dashboard=other, widget_type="label", config={})
+
+        response = self.save(widgets=[self.item(foreign), self.item(self.label), self.item(self.label)])
+
+        self.assertEqual(response.status_code, 200)
+        ids = response.data["widgets"]
+        self.assertEqual(ids[1], str(self.label.external_id))
+        self.assertEqual(len(set(ids) | {str(foreign.external_id)}), 4)
+        self.assertEqual(DashboardWidget.objects.get(pk=foreign.pk).dashboard, other)
+
+    def test_empty_widgets(self):
+        for widgets in [[], "", None]:
+            response = self.save(widgets=widgets)
+            self.assertEqual(response.status_code, 200)
+            self.assertIsNone(response.data["widgets"])
+            self.assertEqual(self.dashboard.widgets.count(), 2)
+
+        # As the editor sends it
+        response = self.save(widgets="[]")
+        self.assertEqual(response.data["widgets"], [])
+        self.assertEqual(self.dashboard.widgets.count(), 0)
+
+    def test_version_conflict(self):
+        self.assertEqual(self.save(version=0, description="First").status_code, 200)
+
+        response = self.save(version=0, description="Second", widgets=[])
+        self.assertEqual(response.status_code, 409)
+
+        dashboard = Dashboard.objects.get(pk=self.dashboard.pk)
+        self.assertEqual((dashboard.description, dashboard.version), ("First", 1))
+        self.assertEqual(dashboard.widgets.count(), 2)
+
+        self.assertEqual(self.save(version="one").status_code, 400)
+
+
+class DashboardBootstrapTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        devices, self.tags = create_plant(1, 2, Tag.DataTypeChoices.INT16, 0)
+        self.dashboard = Dashboard.objects.create(owner=self.user, title="Plant")
+        DashboardWidget.objects.create(dashboard=self.dashboard, tag=self.tags[0], widget_type="led", config={})
+
+    def bootstrap(self, etag: str = None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get(f"/api/dashboards/{self.dashboard.alias}/bootstrap/", **headers)
+
+    def test_etag(self):
+        response = self.bootstrap()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([tag["alias"] for tag in response.data["tags"]], [self.tags[0].alias])
+        self.assertIn("no-cache", response["Cache-Control"])
+        etag = response["ETag"]
+
+        response = self.bootstrap(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # Configuration changes and dashboard saves both invalidate it
+        self.tags[0].description = "Changed"
+        self.tags[0].save()
+        response = self.bootstrap(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["tags"][0]["description"], "Changed")
+        etag = response["ETag"]
+
+        self.client.post(f"/api/dashboards/{self.dashboard.alias}/save-data/", {"version": 0}, format="json")
+        response = self.bootstrap(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["dashboard"]["version"], 1)
+
+    def test_live_values_leave_etag_unchanged(self):
+        etag = self.bootstrap()["ETag"]
+
+        Tag.objects.filter(pk=self.tags[0].pk).update(current_value=5, last_updated=timezone.now())
+
+        self.assertEqual(self.bootstrap(etag).status_code, 304)
+
+
+class PollTraceViewTests(ApiTestCase):
+    def test_cycles_started_while_listing(self):
+        tracer = CycleTracer()
+        for _ in range(3):
+            trace = tracer.start()
+            asyncio.run(tracer.finish(trace, poll_interval=1))
+
+        summary = CycleTrace.summary
+        def summary_during_poll(trace):
+            tracer.start()
+            return summary(trace)
+
+        with mock.patch("main.api.views.cycle_tracer", tracer), mock.patch.object(CycleTrace, "summary", summary_during_poll):
+            response = self.client.get("/api/poll-traces/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([cycle["cycle"] for cycle in response.data], [3, 2, 1])
+
+
+class ExportTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        devices, self.tags = create_plant(2, 3, Tag.DataTypeChoices.FLOAT32, 0)
+        AlarmConfig.objects.create(tag=self.tags[4], alias="high", trigger_value=1.5, operator="greater_than", threat_level="high", window=timedelta(seconds=90))
+
+    def export(self, kind: str) -> str:
+        response = self.client.get(f"/api/export/{kind}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        async def read():
+            return b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+        return asyncio.run(read())
+
+    def test_one_query_per_export(self):
+        for exporter_class in [DeviceExporter, TagExporter, AlarmConfigExporter]:
+            with self.assertNumQueries(1):
+                lines = list(exporter_class().lines())
+            self.assertEqual(len(lines), exporter_class.model.objects.count() + 1)
+
+    def test_round_trip(self):
+        exports = {kind: self.export(kind) for kind in ["devices", "tags", "alarms"]}
+        tags_before = sorted(Tag.objects.values_list("external_id", "device__alias", "alias", "address", "data_type"))
+        alarms_before = list(AlarmConfig.objects.values_list("tag__external_id", "alias", "trigger_value", "operator", "window"))
+
+        Device.objects.all().delete()
+        for importer_class, kind in [(DeviceImporter, "devices"), (TagImporter, "tags"), (AlarmConfigImporter, "alarms")]:
+            result = importer_class(io.StringIO(exports[kind])).run()
+            self.assertEqual(result.errors, [])
+
+        self.assertEqual(sorted(Tag.objects.values_list("external_id", "device__alias", "alias", "address", "data_type")), tags_before)
+        self.assertEqual(list(AlarmConfig.objects.values_list("tag__external_id", "alias", "trigger_value", "operator", "window")), alarms_before)
+
+    def test_unknown_kind(self):
+        self.assertEqual(self.client.get("/api/export/widgets/").status_code, 404)
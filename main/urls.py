@@ -5,5 +5,6 @@ urlpatterns = [
     path("dashboard/<slug:alias>/", views.dashboard_view, name="dashboard"),
     path("dashboards/", views.dashboard_list, name="dashboards"),
     path("alarms/", views.alarm_list_view, name="alarms"),
+    path("metrics", views.metrics_view, name="metrics"),
     path("", views.home_view, name="home")
 ]
\ No newline at end of file
@@ -4,6 +4,9 @@ from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.cache import never_cache
 from django.shortcuts import redirect
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from .services.metrics import registry
 
 
 def home_view(request):
@@ -31,4 +34,16 @@ def dashboard_view(request, alias):
 
 @login_required
 def alarm_list_view(request):
-    return render(request, "alarm_list.html")
\ No newline at end of file
+    return render(request, "alarm_list.html")
+
+
+@never_cache
+async def metrics_view(request):
+    """ Prometheus scrape endpoint. Open to staff, and to scrapers at `METRICS_ALLOWED_IPS` """
+
+    if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+        user = await request.auser()
+        if not user.is_staff:
+            return HttpResponseForbidden()
+
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -161,6 +161,64 @@ MEDIA_URL = 'media/'
 
 MEDIA_ROOT = BASE_DIR / '.media'
 
+# Alarm notifications
+# Run a local debug server with `python -m aiosmtpd -n -l localhost:1025` to see sent emails
+
+ALARM_NOTIFICATION_BACKEND = 'main.services.notify_alarms.EmailBackend'
+
+EMAIL_HOST = 'localhost'
+
+EMAIL_PORT = 1025
+
+DEFAULT_FROM_EMAIL = 'alarms@modbustiles.local'
+
+# Metrics
+# `/metrics` is served to staff users, and without logging in to these addresses
+
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# Tag listing
+# `/api/tags/` returns pages when given a `cursor`, `page_size` or search query `q`
+
+TAG_PAGE_SIZE = 100
+
+TAG_MAX_PAGE_SIZE = 1000
+
+TAG_SEARCH_MIN_SUBSTRING = 3 # Shorter queries only match the start of tag aliases
+
+# Poll scheduling
+# When a device can't read all its tags within its budget, the lower priorities are read less often,
+# down to once every this many poll intervals
+
+POLL_DEVICE_BUDGET = 0.8 # Fraction of the poll interval a device's reads may take
+
+POLL_MAX_STRETCH = {
+    "alarm": 1,
+    "subscribed": 2,
+    "history": 10,
+}
+
+# Addresses a device rejects are left out of its reads for this long, doubling each time they fail again
+POLL_QUARANTINE_BACKOFF = 30
+POLL_QUARANTINE_MAX_BACKOFF = 600
+
+# Most connections a device's capability probe opens to test how many concurrent requests it takes
+POLL_PROBE_MAX_CONCURRENCY = 4
+
+# Websocket resume journal
+# Reconnecting dashboards are sent the tag updates they missed while these are still held, and a full snapshot otherwise.
+# Size it as tags changing per poll cycle x poll cycles per second x seconds of disconnection to cover, e.g. 10k changing
+# tags polled every 0.25s need 2.4M entries to cover a minute. Each entry is one serialized update of a few hundred bytes
+
+POLL_JOURNAL_ENTRIES = 200000 # 5 seconds of 10k changing tags every 0.25s
+
+# Poll cycle tracing
+# Cycles slower than this, or than the poll interval when None, are counted in the periodic poll log and kept at `/api/poll-traces/`
+
+POLL_TRACE_SLOW_SECONDS = None
+
+POLL_TRACE_DIR = None # Also save slow cycles here in Chrome trace format, for chrome://tracing or Perfetto
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 